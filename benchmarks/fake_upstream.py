@@ -0,0 +1,225 @@
+"""
+模拟的OpenAI/Anthropic兼容服务，用于压测时替代真实的服务商，只测量网关本身的开销。
+
+    FAKE_LATENCY=0.2 FAKE_RATE_LIMIT_RATE=0.01 uvicorn benchmarks.fake_upstream:app --port 9100
+
+配置通过环境变量（FAKE_前缀，见FakeConfig）传入，接口：
+- POST /v1/chat/completions，支持stream与stream_options.include_usage
+- POST /v1/embeddings
+- POST /v1/messages（Anthropic），支持stream
+- GET /v1/models
+- GET /stats：收到的请求数与注入的错误数，用于计算网关的重试放大
+"""
+
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+from collections import Counter
+from dataclasses import dataclass, fields
+from typing import AsyncIterator, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+@dataclass
+class FakeConfig:
+    latency: float = 0.2  # 响应（或流式的首个chunk）前的等待时间，秒
+    jitter: float = 0.0  # 延迟的随机波动比例，0.1表示±10%
+    chunks: int = 20  # 流式响应的chunk数
+    chunk_interval: float = 0.01  # 流式响应chunk之间的间隔，秒
+    error_rate: float = 0.0  # 返回500的比例
+    rate_limit_rate: float = 0.0  # 返回429的比例
+    retry_after: float = 1.0  # 429响应的retry-after，秒
+    completion_tokens: int = 20
+    dimensions: int = 1536
+
+    @classmethod
+    def from_env(cls) -> "FakeConfig":
+        config = cls()
+        for field in fields(cls):
+            value = os.getenv(f"FAKE_{field.name.upper()}")
+            if value is not None:
+                setattr(config, field.name, field.type(value))  # type: ignore
+        return config
+
+    def env(self) -> dict[str, str]:
+        return {
+            f"FAKE_{field.name.upper()}": str(getattr(self, field.name)) for field in fields(self)
+        }
+
+    @property
+    def stream_duration(self) -> float:
+        return self.latency + self.chunks * self.chunk_interval
+
+
+def prompt_tokens(body: dict) -> int:
+    # 粗略估算，避免模拟服务本身成为瓶颈
+    return len(json.dumps(body.get("messages", body.get("input", "")), ensure_ascii=False)) // 4
+
+
+def create_app(config: FakeConfig) -> FastAPI:
+    app = FastAPI(title="fake upstream")
+    stats: Counter = Counter()
+
+    async def delay(seconds: float):
+        if seconds > 0:
+            await asyncio.sleep(seconds * (1 + random.uniform(-config.jitter, config.jitter)))
+
+    def injected_error(anthropic: bool) -> Optional[JSONResponse]:
+        """按比例注入429与500错误"""
+        roll = random.random()
+        if roll < config.rate_limit_rate:
+            status, type, headers = (
+                429,
+                "rate_limit_error",
+                {"retry-after": str(config.retry_after)},
+            )
+        elif roll < config.rate_limit_rate + config.error_rate:
+            status, type, headers = 500, "api_error", {}
+        else:
+            return None
+        stats[f"status_{status}"] += 1
+        error = {"type": type, "message": f"injected {status}"}
+        content = {"type": "error", "error": error} if anthropic else {"error": error}
+        return JSONResponse(content, status_code=status, headers=headers)
+
+    def words(count: int):
+        return [f"token{i} " for i in range(count)]
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats["chat"] += 1
+        if error := injected_error(anthropic=False):
+            return error
+        id, model = f"chatcmpl-{uuid.uuid4().hex}", body["model"]
+        usage = {
+            "prompt_tokens": prompt_tokens(body),
+            "completion_tokens": config.completion_tokens,
+            "total_tokens": prompt_tokens(body) + config.completion_tokens,
+        }
+        if body.get("stream"):
+            include_usage = (body.get("stream_options") or {}).get("include_usage")
+            return StreamingResponse(
+                chat_stream(id, model, usage if include_usage else None),
+                media_type="text/event-stream",
+            )
+        await delay(config.latency)
+        return {
+            "id": id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(words(config.chunks))},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": usage,
+        }
+
+    async def chat_stream(id: str, model: str, usage: Optional[dict]) -> AsyncIterator[str]:
+        def chunk(delta: dict, finish_reason: Optional[str] = None, **extra) -> str:
+            choice = {"index": 0, "delta": delta, "finish_reason": finish_reason}
+            data = {
+                "id": id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [choice] if delta is not None else [],
+                **extra,
+            }
+            return f"data: {json.dumps(data)}\n\n"
+
+        await delay(config.latency)
+        yield chunk({"role": "assistant", "content": ""})
+        for word in words(config.chunks):
+            yield chunk({"content": word})
+            await delay(config.chunk_interval)
+        yield chunk({}, "stop")
+        if usage:
+            yield chunk(None, usage=usage)  # type: ignore
+        yield "data: [DONE]\n\n"
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        stats["embeddings"] += 1
+        if error := injected_error(anthropic=False):
+            return error
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        await delay(config.latency)
+        dimensions = body.get("dimensions") or config.dimensions
+        return {
+            "object": "list",
+            "model": body["model"],
+            "data": [
+                {"object": "embedding", "index": i, "embedding": [0.01] * dimensions}
+                for i in range(len(inputs))
+            ],
+            "usage": {"prompt_tokens": prompt_tokens(body), "total_tokens": prompt_tokens(body)},
+        }
+
+    @app.post("/v1/messages")
+    async def messages(request: Request):
+        body = await request.json()
+        stats["messages"] += 1
+        if error := injected_error(anthropic=True):
+            return error
+        message = {
+            "id": f"msg_{uuid.uuid4().hex}",
+            "type": "message",
+            "role": "assistant",
+            "model": body["model"],
+            "content": [],
+            "stop_reason": None,
+            "stop_sequence": None,
+            "usage": {"input_tokens": prompt_tokens(body), "output_tokens": 0},
+        }
+        if body.get("stream"):
+            return StreamingResponse(message_stream(message), media_type="text/event-stream")
+        await delay(config.latency)
+        message["content"] = [{"type": "text", "text": "".join(words(config.chunks))}]
+        message["stop_reason"] = "end_turn"
+        message["usage"]["output_tokens"] = config.completion_tokens  # type: ignore
+        return message
+
+    async def message_stream(message: dict) -> AsyncIterator[str]:
+        def event(type: str, **data) -> str:
+            return f"event: {type}\ndata: {json.dumps({'type': type, **data})}\n\n"
+
+        await delay(config.latency)
+        yield event("message_start", message=message)
+        yield event("content_block_start", index=0, content_block={"type": "text", "text": ""})
+        for word in words(config.chunks):
+            yield event("content_block_delta", index=0, delta={"type": "text_delta", "text": word})
+            await delay(config.chunk_interval)
+        yield event("content_block_stop", index=0)
+        yield event(
+            "message_delta",
+            delta={"stop_reason": "end_turn", "stop_sequence": None},
+            usage={"output_tokens": config.completion_tokens},
+        )
+        yield event("message_stop")
+
+    @app.get("/v1/models")
+    async def models():
+        return {
+            "object": "list",
+            "data": [{"id": "fake-model", "object": "model", "created": 0, "owned_by": "fake"}],
+        }
+
+    @app.get("/stats")
+    async def get_stats():
+        return dict(stats)
+
+    return app
+
+
+app = create_app(FakeConfig.from_env())
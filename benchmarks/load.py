@@ -0,0 +1,177 @@
+"""
+压测客户端：每个场景以固定并发闭环调用网关（每个并发完成一个请求后立即发送下一个），
+统计吞吐、延迟分位数以及相对上游耗时增加的延迟。
+
+每次运行的请求内容带有随机前缀，不会命中响应缓存、向量缓存或合并相同请求。
+"""
+
+import asyncio
+import itertools
+import json
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Callable
+
+import httpx
+
+from benchmarks.fake_upstream import FakeConfig
+
+TOKEN_TEXT = "The quick brown fox jumps over the lazy dog. 敏捷的棕色狐狸跳过了懒狗。" * 200
+
+
+@dataclass
+class Scenario:
+    name: str
+    path: str
+    body: Callable[[str], dict]
+    # 上游本身的耗时（秒），网关增加的延迟 = 实测延迟 - upstream
+    upstream: Callable[[FakeConfig], float]
+    stream: bool = False
+
+
+def scenarios(model: str, embedding_model: str, batch_size: int) -> dict[str, Scenario]:
+    return {
+        scenario.name: scenario
+        for scenario in (
+            Scenario(
+                "gpt_openai",
+                "/gpt_openai",
+                lambda key: {"text": f"benchmark {key}", "model": model},
+                lambda config: config.latency,
+            ),
+            Scenario(
+                "gpt_openai_stream",
+                "/gpt_openai",
+                lambda key: {"text": f"benchmark {key}", "model": model, "stream": True},
+                lambda config: config.stream_duration,
+                stream=True,
+            ),
+            Scenario(
+                "gpt_openai_fast",
+                "/gpt_openai_fast",
+                lambda key: {
+                    "prompts": [f"benchmark {key}-{i}" for i in range(batch_size)],
+                    "model": model,
+                },
+                lambda config: config.latency,
+            ),
+            Scenario(
+                "vec_openai",
+                "/vec_openai",
+                lambda key: {"text": f"benchmark {key}", "model": embedding_model},
+                lambda config: config.latency,
+            ),
+            Scenario(
+                "get_token_num",
+                "/get_token_num",
+                lambda key: {"text": f"{key} {TOKEN_TEXT}", "count_only": True},
+                lambda config: 0.0,
+            ),
+        )
+    }
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, round(q * (len(values) - 1)))]
+
+
+@dataclass
+class Result:
+    scenario: str
+    concurrency: int
+    duration: float
+    upstream: float
+    latencies: list[float] = field(default_factory=list)
+    errors: int = 0
+    client_lag: float = 0.0
+    extra: dict = field(default_factory=dict)
+
+    def summary(self) -> dict:
+        requests = len(self.latencies) + self.errors
+        p50, p90, p99 = (percentile(self.latencies, q) for q in (0.5, 0.9, 0.99))
+        return {
+            "scenario": self.scenario,
+            "concurrency": self.concurrency,
+            "requests": requests,
+            "errors": self.errors,
+            "rps": len(self.latencies) / self.duration,
+            "p50": p50,
+            "p90": p90,
+            "p99": p99,
+            "added_p50": p50 - self.upstream,
+            "added_p99": p99 - self.upstream,
+            # 压测客户端自身的事件循环延迟，较大时客户端成为瓶颈，结果偏低
+            "client_lag_max": self.client_lag,
+            **self.extra,
+        }
+
+
+def ok(response: httpx.Response) -> bool:
+    if response.status_code != 200:
+        return False
+    status = response.json().get("status")
+    return status == "ok" or isinstance(status, list) and all(s == "ok" for s in status)
+
+
+async def send(client: httpx.AsyncClient, scenario: Scenario, key: str) -> bool:
+    if not scenario.stream:
+        return ok(await client.post(scenario.path, json=scenario.body(key)))
+    async with client.stream("POST", scenario.path, json=scenario.body(key)) as response:
+        done = False
+        async for line in response.aiter_lines():
+            if line.startswith("event: error"):
+                return False
+            done = done or line == "data: [DONE]"
+        return response.status_code == 200 and done
+
+
+async def monitor_lag(interval: float = 0.05) -> float:
+    """持续运行直到被取消，返回观测到的最大事件循环延迟"""
+    worst = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            worst = max(worst, time.perf_counter() - start - interval)
+    except asyncio.CancelledError:
+        return worst
+
+
+async def run_scenario(
+    client: httpx.AsyncClient,
+    scenario: Scenario,
+    concurrency: int,
+    duration: float,
+    warmup: float,
+    config: FakeConfig,
+) -> Result:
+    """先预热warmup秒（不计入结果），再统计duration秒内完成的请求"""
+    prefix = uuid.uuid4().hex[:8]
+    counter = itertools.count()
+    result = Result(scenario.name, concurrency, duration, scenario.upstream(config))
+    measure_start = time.perf_counter() + warmup
+    deadline = measure_start + duration
+
+    async def worker():
+        while (start := time.perf_counter()) < deadline:
+            try:
+                success = await send(client, scenario, f"{prefix}-{next(counter)}")
+            except (httpx.HTTPError, json.JSONDecodeError):
+                success = False
+            end = time.perf_counter()
+            if start < measure_start or end > deadline:
+                continue
+            if success:
+                result.latencies.append(end - start)
+            else:
+                result.errors += 1
+
+    lag = asyncio.create_task(monitor_lag())
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    lag.cancel()
+    result.client_lag = await lag
+    return result
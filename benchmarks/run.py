@@ -0,0 +1,247 @@
+"""
+网关压测。默认启动模拟上游与gunicorn部署的网关（使用项目的gunicorn.conf.py），
+按场景与并发逐组压测，输出吞吐、p50/p99延迟与网关增加的延迟。
+
+    python -m benchmarks.run --workers 4 --concurrency 1,16,64 --duration 10
+    python -m benchmarks.run --json result.json --baseline baseline.json  # 回归检查，超出容差时退出码为1
+    python -m benchmarks.run --target http://127.0.0.1:8000 --upstream http://127.0.0.1:9100
+
+--target指定已部署的网关时不再启动网关，此时网关需要自行指向模拟上游
+（OPENAI_BASE_URL=<上游>/v1, ANTHROPIC_BASE_URL=<上游>）。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from typing import Optional
+
+import httpx
+
+from benchmarks.fake_upstream import FakeConfig
+from benchmarks.load import run_scenario, scenarios
+
+ROOT = Path(__file__).parent.parent
+# 压测场景用到的服务商的API key，使用占位值；其他服务商未配置时网关中不可用
+REQUIRED_ENV = ("OPENAI_API_KEY", "CLAUDE_API_KEY")
+STARTUP_TIMEOUT = 60
+COLUMNS = ("scenario", "concurrency", "requests", "errors", "rps", "p50", "p99", "added_p50")
+COLUMNS += ("added_p99", "upstream_calls", "loop_lag_p99", "client_lag_max")
+# 网关各worker写入监控指标快照的间隔，读取/metrics前等待该时长使所有worker的数据都已写入
+METRICS_FLUSH_INTERVAL = 1.0
+LAG_METRIC = "chatbot_event_loop_lag_seconds_bucket"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def serve(command: list[str], env: dict, ready_url: str, output: Path, method: str = "GET"):
+    """启动子进程并等待ready_url可用，退出时结束进程。子进程的输出写入output"""
+    with output.open("wb") as file:
+        process = subprocess.Popen(
+            command, env=os.environ | env, cwd=ROOT, stdout=file, stderr=file
+        )
+    try:
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(
+                    f"{command[2]} exited with code {process.returncode}, see {output}"
+                )
+            try:
+                if httpx.request(method, ready_url, timeout=1).status_code == 200:
+                    break
+            except httpx.HTTPError:
+                pass
+            if time.monotonic() > deadline:
+                raise TimeoutError(
+                    f"{ready_url} is not ready after {STARTUP_TIMEOUT}s, see {output}"
+                )
+            time.sleep(0.2)
+        yield process
+    finally:
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def gateway_env(upstream: str, workers: int, port: int, log_dir: str) -> dict:
+    env = {name: os.getenv(name, "benchmark") for name in REQUIRED_ENV}
+    return env | {
+        "PORT": str(port),
+        "WORKERS": str(workers),
+        "LOG_DIR": log_dir,
+        "OPENAI_BASE_URL": f"{upstream}/v1",
+        "ANTHROPIC_BASE_URL": upstream,
+        "CHATBOT_NO_PROXY": "1",
+        "CHATBOT_METRICS_DIR": log_dir,
+        "CHATBOT_METRICS_FLUSH_INTERVAL": str(METRICS_FLUSH_INTERVAL),
+    }
+
+
+def format_row(row: dict) -> str:
+    cells = []
+    for column in COLUMNS:
+        value = row.get(column, "")
+        if isinstance(value, float):
+            value = f"{value:.1f}" if column == "rps" else f"{value * 1000:.1f}ms"
+        cells.append(f"{value:>14}" if column != "scenario" else f"{value:<18}")
+    return " ".join(cells)
+
+
+def compare(results: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    """吞吐下降或增加的延迟上升超过tolerance（比例）时视为回归。延迟另有5ms的绝对容差，避免噪声"""
+    base = {(row["scenario"], row["concurrency"]): row for row in baseline}
+    regressions = []
+    for row in results:
+        old = base.get((row["scenario"], row["concurrency"]))
+        if old is None:
+            continue
+        name = f"{row['scenario']}@{row['concurrency']}"
+        if row["rps"] < old["rps"] * (1 - tolerance):
+            regressions.append(f"{name}: rps {old['rps']:.1f} -> {row['rps']:.1f}")
+        for column in ("added_p50", "added_p99"):
+            if row[column] > old[column] * (1 + tolerance) + 0.005:
+                regressions.append(
+                    f"{name}: {column} {old[column] * 1000:.1f}ms -> {row[column] * 1000:.1f}ms"
+                )
+    return regressions
+
+
+async def upstream_calls(upstream: Optional[str]) -> Optional[int]:
+    if upstream is None:
+        return None
+    async with httpx.AsyncClient() as client:
+        stats = (await client.get(f"{upstream}/stats")).json()
+    return sum(value for key, value in stats.items() if not key.startswith("status_"))
+
+
+async def lag_buckets(client: httpx.AsyncClient) -> Optional[dict[float, float]]:
+    """网关所有worker合并后的事件循环延迟直方图{桶上界: 累计次数}，网关未提供时返回None"""
+    await asyncio.sleep(METRICS_FLUSH_INTERVAL * 1.5)
+    try:
+        response = await client.get("/metrics")
+    except httpx.HTTPError:
+        return None
+    if response.status_code != 200:
+        return None
+    buckets: dict[float, float] = {}
+    for line in response.text.splitlines():
+        if line.startswith(LAG_METRIC):
+            bound = float(line.split('le="')[1].split('"')[0])
+            buckets[bound] = float(line.rsplit(" ", 1)[1])
+    return buckets or None
+
+
+def lag_quantile(before: dict[float, float], after: dict[float, float], q: float) -> float:
+    """两次采样之间的延迟分位数，结果为所在桶的上界"""
+    deltas = sorted((bound, after[bound] - before.get(bound, 0)) for bound in after)
+    total = deltas[-1][1]
+    for bound, count in deltas:
+        if count >= total * q:
+            return bound
+    return deltas[-1][0]
+
+
+async def benchmark(args, target: str, upstream: Optional[str], config: FakeConfig) -> list[dict]:
+    selected = scenarios(args.model, args.embedding_model, args.batch_size)
+    rows = []
+    print(format_row({column: column for column in COLUMNS}))
+    for name in args.scenarios.split(","):
+        for concurrency in map(int, args.concurrency.split(",")):
+            limits = httpx.Limits(
+                max_connections=concurrency, max_keepalive_connections=concurrency
+            )
+            async with httpx.AsyncClient(base_url=target, timeout=120, limits=limits) as client:
+                before, lag_before = await upstream_calls(upstream), await lag_buckets(client)
+                result = await run_scenario(
+                    client, selected[name], concurrency, args.duration, args.warmup, config
+                )
+                after, lag_after = await upstream_calls(upstream), await lag_buckets(client)
+            row = result.summary()
+            # 以下两项都包含预热期间的数据；重试与对冲会使上游调用数增加
+            if before is not None and after is not None:
+                row["upstream_calls"] = after - before
+            if lag_before is not None and lag_after is not None:
+                row["loop_lag_p99"] = lag_quantile(lag_before, lag_after, 0.99)
+            rows.append(row)
+            print(format_row(row), flush=True)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="网关压测")
+    parser.add_argument("--target", help="已部署的网关地址，不指定时启动gunicorn")
+    parser.add_argument("--upstream", help="已启动的模拟上游地址，不指定时启动")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WORKERS", 4)))
+    parser.add_argument(
+        "--scenarios", default="gpt_openai,gpt_openai_fast,vec_openai,get_token_num"
+    )
+    parser.add_argument("--concurrency", default="1,16,64", help="逗号分隔的并发数")
+    parser.add_argument("--duration", type=float, default=10, help="每组统计的时长，秒")
+    parser.add_argument("--warmup", type=float, default=2, help="每组预热的时长，秒")
+    parser.add_argument("--batch-size", type=int, default=20, help="gpt_openai_fast每次的prompt数")
+    parser.add_argument("--model", default="gpt-4o-mini")
+    parser.add_argument("--embedding-model", default="text-embedding-3-small")
+    parser.add_argument("--latency", type=float, default=0.2, help="模拟上游的响应延迟，秒")
+    parser.add_argument("--chunks", type=int, default=20, help="模拟上游流式响应的chunk数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟上游返回500的比例")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="模拟上游返回429的比例")
+    parser.add_argument("--json", help="结果写入的JSON文件")
+    parser.add_argument("--log-dir", help="保留子进程输出与网关日志的目录，默认使用临时目录")
+    parser.add_argument("--baseline", help="对比的基准结果（--json的输出）")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="回归检查的容差比例")
+    args = parser.parse_args()
+
+    config = FakeConfig(
+        latency=args.latency,
+        chunks=args.chunks,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+    )
+    with ExitStack() as stack:
+        # 模拟上游与网关的输出、网关的日志（LOG_DIR）都写入该目录
+        log_dir = Path(args.log_dir or stack.enter_context(tempfile.TemporaryDirectory()))
+        log_dir.mkdir(parents=True, exist_ok=True)
+        upstream = args.upstream
+        if upstream is None and args.target is None:
+            port = free_port()
+            upstream = f"http://127.0.0.1:{port}"
+            command = [sys.executable, "-m", "uvicorn", "benchmarks.fake_upstream:app"]
+            command += ["--port", str(port), "--log-level", "warning"]
+            ready = f"{upstream}/v1/models"
+            stack.enter_context(serve(command, config.env(), ready, log_dir / "upstream.out"))
+        target = args.target
+        if target is None:
+            port = free_port()
+            target = f"http://127.0.0.1:{port}"
+            env = gateway_env(upstream, args.workers, port, str(log_dir))
+            command = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "src.main:app"]
+            output = log_dir / "gunicorn.out"
+            stack.enter_context(serve(command, env, f"{target}/ping", output, method="POST"))
+        rows = asyncio.run(benchmark(args, target, upstream, config))
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(rows, indent=2))
+    if args.baseline:
+        regressions = compare(rows, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
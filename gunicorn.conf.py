@@ -1,4 +1,5 @@
 # https://docs.gunicorn.org/en/stable/settings.html
+import gc
 import os
 from pathlib import Path
 
@@ -9,8 +10,27 @@ workers = int(os.getenv("WORKERS", 4))
 max_requests = 50_0000
 max_requests_jitter = 1_0000
 worker_class = UvicornWorker
+# 在master中导入应用，worker通过fork共享已导入的模块与tiktoken编码表（写时复制），
+# 启动与max_requests回收worker时不再重复加载。服务商客户端与连接在worker中首次使用时才创建
+preload_app = os.getenv("PRELOAD_APP", "1") == "1"
+
+log_dir = Path(os.getenv("LOG_DIR", "/data/var/log"))
+# 日志队列长度，大于0时由后台线程格式化和写入日志，队列满时丢弃；为0时在事件循环中同步写入
+log_queue_size = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+
+
+def file_handler(formatter: str, filename: Path) -> dict:
+    handler = {
+        "formatter": formatter,
+        "filename": filename,
+        "maxBytes": 1024 * 1024 * 100,
+        "backupCount": 10,
+    }
+    if log_queue_size > 0:
+        return handler | {"()": "src.log_handler.rotating_file_handler", "maxsize": log_queue_size}
+    return handler | {"class": "logging.handlers.RotatingFileHandler"}
+
 
-log_dir = Path("/data/var/log")
 logconfig_dict = {
     "version": 1,
     "disable_existing_loggers": False,
@@ -34,27 +54,9 @@ logconfig_dict = {
         },
     },
     "handlers": {
-        "default": {
-            "formatter": "default",
-            "class": "logging.handlers.RotatingFileHandler",
-            "filename": log_dir / "chatbot_api.log.stderr",
-            "maxBytes": 1024 * 1024 * 100,
-            "backupCount": 10,
-        },
-        "access": {
-            "formatter": "access",
-            "class": "logging.handlers.RotatingFileHandler",
-            "filename": log_dir / "chatbot_api.log.stderr",
-            "maxBytes": 1024 * 1024 * 100,
-            "backupCount": 10,
-        },
-        "chatbot": {
-            "formatter": "chatbot",
-            "class": "logging.handlers.RotatingFileHandler",
-            "filename": log_dir / "chatbot_api.log.stdout",
-            "maxBytes": 1024 * 1024 * 100,
-            "backupCount": 10,
-        },
+        "default": file_handler("default", log_dir / "chatbot_api.log.stderr"),
+        "access": file_handler("access", log_dir / "chatbot_api.log.stderr"),
+        "chatbot": file_handler("chatbot", log_dir / "chatbot_api.log.stdout"),
     },
     "loggers": {
         "gunicorn.error": {"level": "INFO", "handlers": ["default"], "propagate": False},
@@ -62,3 +64,29 @@ logconfig_dict = {
         "chatbot.access": {"handlers": ["access"], "level": "DEBUG", "propagate": False},
     },
 }
+
+
+def on_starting(server):
+    """master启动时调用：清空上次运行留下的指标快照"""
+    from src import metrics
+
+    if metrics.METRICS_DIR:
+        metrics.reset(metrics.METRICS_DIR)
+
+
+def when_ready(server):
+    """master启动完成、创建worker之前调用"""
+    if server.cfg.preload_app:
+        from src import tokenizer
+
+        tokenizer.preload()
+    # 之后的垃圾回收不再遍历master中已有的对象，减少worker中共享内存页被复制
+    gc.freeze()
+
+
+def child_exit(server, worker):
+    """worker退出后在master中调用：把其累计指标并入归档文件"""
+    from src import metrics
+
+    if metrics.METRICS_DIR:
+        metrics.archive(metrics.METRICS_DIR, worker.pid)
@@ -0,0 +1,263 @@
+"""
+按调用方统计用量与费用，并执行配额。
+
+调用方由info["caller"]或请求头X-Caller指定（前者优先），都未指定时为anonymous。
+这两者都由调用方自行声明，需要按调用方执行配额时应配置CHATBOT_CALLER_KEYS（JSON格式，API key到调用方）：
+    {"sk-team-a-xxxx": "team-a"}
+此时调用方只由请求头Authorization: Bearer <key>或X-Api-Key中的key确定，未知的key记为anonymous，
+info["caller"]与X-Caller不再生效。
+- 每次调用服务商后按(日期, 调用方, 服务商, 模型)累加请求数、token数与费用，先在内存中汇总，
+  每隔ACCOUNTING_FLUSH_INTERVAL秒批量写入SQLite（CHATBOT_ACCOUNTING_DB），请求不等待写入
+- 对话补全与向量化都计入；流式响应中途断开或服务商未返回usage时，按已输出的内容估算
+- 发出请求前检查配额：当日token数或费用超出时拒绝（429）；rpm/tpm按调用方排队，
+  先于服务商额度调度，避免单个调用方（如大批量任务）占满服务商的额度
+- 多个worker共用数据库时，每次写入后重新读取当日总量，配额在刷新间隔内是近似的
+
+配额配置（环境变量CHATBOT_QUOTAS，JSON格式），键为调用方，"*"为未单独配置的调用方的默认值：
+    {"team-a": {"daily_tokens": 5000000, "daily_cost": 50, "rpm": 600, "tpm": 200000},
+     "*": {"rpm": 60}}
+价格配置（环境变量CHATBOT_PRICES，JSON格式），键为模型名前缀，按最长前缀匹配，单位为每百万token：
+    {"gpt-4o-mini": {"input": 0.15, "output": 0.6, "cached_input": 0.075}}
+未配置价格的模型费用记为0。
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, Mapping, Optional
+
+from src.client_wrapper import cached_tokens
+from src.metrics import QUOTA_REJECTED
+from src.scheduler import RateScheduler
+
+logger = logging.getLogger("chatbot")
+
+ACCOUNTING_DB = os.getenv("CHATBOT_ACCOUNTING_DB", "")
+ACCOUNTING_FLUSH_INTERVAL = float(os.getenv("CHATBOT_ACCOUNTING_FLUSH_INTERVAL", 5))
+QUOTAS: dict[str, dict] = json.loads(os.getenv("CHATBOT_QUOTAS", "{}"))
+PRICES: dict[str, dict] = json.loads(os.getenv("CHATBOT_PRICES", "{}"))
+CALLER_KEYS: dict[str, str] = json.loads(os.getenv("CHATBOT_CALLER_KEYS", "{}"))
+DEFAULT_CALLER = "anonymous"
+
+current_caller: ContextVar[str] = ContextVar("caller", default=DEFAULT_CALLER)
+
+# (日期, 调用方, 服务商, 模型)
+UsageKey = tuple[str, str, str, str]
+FIELDS = ("requests", "prompt_tokens", "completion_tokens", "cached_tokens", "cost")
+
+
+class QuotaExceeded(Exception):
+    status_code = 429
+
+
+def request_caller(headers: Mapping[str, str]) -> str:
+    if CALLER_KEYS:
+        authorization = headers.get("authorization", "")
+        scheme, _, key = authorization.partition(" ")
+        if scheme.lower() != "bearer":
+            key = headers.get("x-api-key", "")
+        return CALLER_KEYS.get(key.strip(), DEFAULT_CALLER)
+    return headers.get("x-caller") or DEFAULT_CALLER
+
+
+def set_caller(info: Optional[dict]):
+    # 调用方由API key确定时，不接受请求自行声明的调用方
+    if info and info.get("caller") and not CALLER_KEYS:
+        current_caller.set(str(info["caller"]))
+
+
+def approximate_usage(messages: list, completion: str) -> dict:
+    """服务商没有返回usage时按UTF-8字节数估算（偏大），图片不计入"""
+    texts = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            texts.append(content)
+        elif isinstance(content, list):
+            texts += [part.get("text", "") for part in content if isinstance(part, dict)]
+    prompt = sum(len(text.encode("utf-8")) for text in texts) // 3 + 1
+    output = len(completion.encode("utf-8")) // 3 + 1
+    return {"prompt_tokens": prompt, "completion_tokens": output, "total_tokens": prompt + output}
+
+
+def today() -> str:
+    return time.strftime("%Y-%m-%d")
+
+
+def merge(rows: dict, key: tuple, values):
+    row = rows.setdefault(key, [0] * len(FIELDS))
+    for i, value in enumerate(values):
+        row[i] += value
+
+
+def usage_value(usage: Any, name: str) -> int:
+    value = usage.get(name) if isinstance(usage, dict) else getattr(usage, name, None)
+    return value or 0
+
+
+class UsageStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        os.register_at_fork(after_in_child=self._reopen)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS usage ("
+                "day TEXT NOT NULL, caller TEXT NOT NULL, service TEXT NOT NULL, "
+                "model TEXT NOT NULL, requests INTEGER NOT NULL, prompt_tokens INTEGER NOT NULL, "
+                "completion_tokens INTEGER NOT NULL, cached_tokens INTEGER NOT NULL, "
+                "cost REAL NOT NULL, PRIMARY KEY (day, caller, service, model))"
+            )
+
+    def _reopen(self):
+        # gunicorn预加载应用时在master进程中创建，fork后每个worker使用自己的连接
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+
+    def add(self, rows: dict[UsageKey, list]):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (day, caller, service, model) DO UPDATE SET "
+                + ", ".join(f"{field} = {field} + excluded.{field}" for field in FIELDS),
+                [(*key, *values) for key, values in rows.items()],
+            )
+
+    def totals(self, day: str) -> dict[str, list]:
+        """当日每个调用方的[token数, 费用]"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT caller, SUM(prompt_tokens + completion_tokens), SUM(cost) FROM usage "
+                "WHERE day = ? GROUP BY caller",
+                (day,),
+            ).fetchall()
+        return {caller: [tokens, cost] for caller, tokens, cost in rows}
+
+    def query(self, start: str, end: str) -> dict[UsageKey, list]:
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT day, caller, service, model, {', '.join(FIELDS)} FROM usage "
+                "WHERE day BETWEEN ? AND ?",
+                (start, end),
+            ).fetchall()
+        return {tuple(row[:4]): list(row[4:]) for row in rows}  # type: ignore
+
+
+class Accountant:
+    def __init__(self, store: Optional[UsageStore], quotas: dict[str, dict], prices: dict):
+        self.store = store
+        self.quotas = quotas
+        self.prices = prices
+        # 尚未写入数据库的用量；未配置数据库时保留在内存中
+        self.pending: dict[UsageKey, list] = {}
+        # 当日每个调用方的[token数, 费用]，用于检查配额
+        self.totals: dict[str, list] = {}
+        self.day = today()
+        self.limiter = RateScheduler({})
+
+    def quota(self, caller: str) -> dict:
+        return self.quotas.get(caller, self.quotas.get("*", {}))
+
+    def cost(self, model: str, usage: Any) -> float:
+        prefixes = [prefix for prefix in self.prices if model.startswith(prefix)]
+        if not prefixes:
+            return 0.0
+        price = self.prices[max(prefixes, key=len)]
+        cached = cached_tokens(usage)
+        prompt = usage_value(usage, "prompt_tokens") - cached
+        return (
+            prompt * price.get("input", 0)
+            + cached * price.get("cached_input", price.get("input", 0))
+            + usage_value(usage, "completion_tokens") * price.get("output", 0)
+        ) / 1e6
+
+    def rollover(self):
+        if self.day != today():
+            self.day = today()
+            self.totals = {}
+
+    def check(self, caller: str):
+        self.rollover()
+        quota = self.quota(caller)
+        tokens, cost = self.totals.get(caller, (0, 0.0))
+        for reason, used in (("daily_tokens", tokens), ("daily_cost", cost)):
+            if quota.get(reason) and used >= quota[reason]:
+                QUOTA_REJECTED.inc(caller, reason)
+                raise QuotaExceeded(f"调用方{caller}已超出当日配额{reason}={quota[reason]}")
+
+    def record(self, caller: str, service: str, model: str, usage: Any):
+        if not usage:
+            return
+        self.rollover()
+        prompt = usage_value(usage, "prompt_tokens")
+        completion = usage_value(usage, "completion_tokens")
+        cost = self.cost(model, usage)
+        values = (1, prompt, completion, cached_tokens(usage), cost)
+        merge(self.pending, (self.day, caller, service, model), values)
+        total = self.totals.setdefault(caller, [0, 0.0])
+        total[0] += prompt + completion
+        total[1] += cost
+
+    @asynccontextmanager
+    async def charge(self, service: str, model: str, messages: list, max_tokens: Optional[int]):
+        """检查配额并按调用方的rpm/tpm排队，调用方通过reservation.record(usage)记录实际消耗"""
+        caller = current_caller.get()
+        self.check(caller)
+        quota = self.quota(caller)
+        key = None
+        if quota.get("rpm") or quota.get("tpm"):
+            key = caller
+            self.limiter.limits.setdefault(caller, quota)
+        async with self.limiter.reserve_key(key, model, messages, max_tokens) as reservation:
+            try:
+                yield reservation
+            finally:
+                # 出错或客户端断开时同样记录已消耗的用量
+                self.record(caller, service, model, reservation.usage)
+
+    async def flush(self):
+        if self.store is None or not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        try:
+            await asyncio.to_thread(self.store.add, pending)
+        except Exception:
+            # 写入失败时合并回内存，下次重试
+            for key, values in pending.items():
+                merge(self.pending, key, values)
+            raise
+        totals = await asyncio.to_thread(self.store.totals, self.day)
+        # 读取期间新增的用量还在pending中
+        for (day, caller, _, _), values in self.pending.items():
+            if day == self.day:
+                total = totals.setdefault(caller, [0, 0.0])
+                total[0] += values[1] + values[2]
+                total[1] += values[4]
+        self.totals = totals
+
+    async def flush_periodically(self, interval: float = ACCOUNTING_FLUSH_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Flush usage failed: {e}")
+
+    async def summary(self, start: str, end: str) -> dict[UsageKey, list]:
+        rows = await asyncio.to_thread(self.store.query, start, end) if self.store else {}
+        for key, values in self.pending.items():
+            if start <= key[0] <= end:
+                merge(rows, key, values)
+        return rows
+
+
+accountant = Accountant(UsageStore(ACCOUNTING_DB) if ACCOUNTING_DB else None, QUOTAS, PRICES)
@@ -7,21 +7,23 @@ import hmac
 import json
 import os
 from datetime import datetime, timezone
+from functools import cache
 from typing import Literal, Optional, Union
 from urllib.parse import quote
 
 import httpx
 
+from src.clients import ServiceUnavailable
+from src.transport import transports
+
 # 以下参数视服务不同而不同，一个服务内通常是一致的
 SERVICE = "ark"
 REGION = "cn-beijing"
 HOST = "open.volcengineapi.com"
 
-# 火山云请求的凭证 https://console.volcengine.com/iam/keymanage
+# 火山云请求的凭证 https://console.volcengine.com/iam/keymanage，未设置时无法获取豆包的模型列表
 AK = os.getenv("VOLC_ACCESSKEY", "")
 SK = os.getenv("VOLC_SECRETKEY", "")
-assert AK, "Please set VOLC_ACCESSKEY"
-assert SK, "Please set VOLC_SECRETKEY"
 
 
 def norm_query(params: dict[str, Union[str, list[str]]]) -> str:
@@ -98,13 +100,23 @@ def sign_header(
     }
 
 
+@cache
+def ark_client() -> httpx.AsyncClient:
+    # 复用连接，避免每次请求都重新建立跨区域的TLS连接
+    return transports.build("volcengine", f"https://{HOST}")
+
+
 async def ark_model_list() -> dict:
+    if not (AK and SK):
+        raise ServiceUnavailable("未配置VOLC_ACCESSKEY与VOLC_SECRETKEY，无法获取豆包的模型列表")
     query = {"Action": "ListEndpoints", "PageSize": "100", "Version": "2024-01-01"}
     data = {"Filter": {"Statuses": ["Running"]}}
+    # 签名包含时间戳，每次请求都需要重新签名
     signed = sign_header("POST", "/", query, data)
-    async with httpx.AsyncClient() as client:
-        res = await client.post(f"https://{HOST}", headers=signed, params=query, json=data)
-        return res.json()["Result"]["Items"]
+    res = await ark_client().post(
+        f"https://{HOST}", headers=signed, params=query, json=data, timeout=30
+    )
+    return res.json()["Result"]["Items"]
 
 
 if __name__ == "__main__":
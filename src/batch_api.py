@@ -0,0 +1,209 @@
+"""
+服务商原生的Batch API。
+
+批量任务设置native_batch时，不逐条实时调用，而是把请求整理成服务商的批量格式一次性提交，
+定期轮询批次状态，完成后按custom_id（即条目index）写回结果。
+批量接口价格更低、额度与实时接口分开，适合不着急的大批量任务，但通常在24小时内才能完成。
+
+- openai / azure: Files + Batches接口
+- claude: Message Batches接口
+- 其他服务商暂不支持
+环境变量CHATBOT_BATCH_BACKEND=fake时所有服务商使用本地的FakeBatchBackend，便于测试。
+"""
+
+import json
+import os
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Any, Optional
+
+from anthropic import AsyncAnthropic
+from openai import AsyncOpenAI
+
+from src.client_wrapper import claude_system, claude_usage
+from src.clients import CLIENTS
+from src.schema import ServiceProvider
+
+# (index, status, reply, usage, cached)，与JobStore.save的参数一致
+Result = tuple[int, str, Any, Any, bool]
+
+BATCH_BACKEND = os.getenv("CHATBOT_BATCH_BACKEND", "")
+# 单个批次的最大请求数，openai限制为50000
+MAX_BATCH_SIZE = int(os.getenv("CHATBOT_BATCH_MAX_SIZE", 50000))
+# 调用参数中不转发给服务商的字段
+LOCAL_PARAMS = ("service", "info", "cache", "hedge", "native_batch")
+
+
+def request_body(params: dict) -> dict:
+    return {
+        key: value for key, value in params.items() if key not in LOCAL_PARAMS and value is not None
+    }
+
+
+class BatchBackend(ABC):
+    @abstractmethod
+    async def submit(self, requests: list[tuple[int, dict]]) -> str:
+        """提交一个批次，requests为(index, 调用参数)，返回批次id"""
+
+    @abstractmethod
+    async def done(self, batch_id: str) -> bool:
+        """批次是否已结束（包括失败、过期、取消）"""
+
+    @abstractmethod
+    async def results(self, batch_id: str) -> list[Result]:
+        """已结束批次的结果"""
+
+
+class OpenAIBatchBackend(BatchBackend):
+    def __init__(self, service: ServiceProvider, url: str, extra_query: Optional[dict] = None):
+        self.service = service
+        self.url = url
+        # azure的Batch API需要较新的api-version
+        self.extra_query = extra_query
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        return CLIENTS[self.service]
+
+    async def submit(self, requests: list[tuple[int, dict]]) -> str:
+        lines = [
+            json.dumps(
+                {
+                    "custom_id": str(index),
+                    "method": "POST",
+                    "url": self.url,
+                    "body": request_body(params),
+                },
+                ensure_ascii=False,
+            )
+            for index, params in requests
+        ]
+        file = await self.client.files.create(
+            file=("batch.jsonl", "\n".join(lines).encode()),
+            purpose="batch",
+            extra_query=self.extra_query,
+        )
+        batch = await self.client.batches.create(
+            input_file_id=file.id,
+            # openai为/v1/chat/completions，azure为/chat/completions，与请求行中的url一致
+            endpoint=self.url,  # type: ignore
+            completion_window="24h",
+            extra_query=self.extra_query,
+        )
+        return batch.id
+
+    async def done(self, batch_id: str) -> bool:
+        batch = await self.client.batches.retrieve(batch_id, extra_query=self.extra_query)
+        return batch.status in ("completed", "failed", "expired", "cancelled")
+
+    async def results(self, batch_id: str) -> list[Result]:
+        batch = await self.client.batches.retrieve(batch_id, extra_query=self.extra_query)
+        results = []
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            content = await self.client.files.content(file_id, extra_query=self.extra_query)
+            for line in content.text.splitlines():
+                if line.strip():
+                    results.append(self.parse(json.loads(line)))
+        return results
+
+    @staticmethod
+    def parse(line: dict) -> Result:
+        index = int(line["custom_id"])
+        response = line.get("response") or {}
+        if line.get("error") or response.get("status_code") != 200:
+            error = line.get("error") or response.get("body", {}).get("error") or {}
+            return index, "error", error.get("message", str(error)), None, False
+        body = response["body"]
+        return index, "ok", body["choices"][0]["message"]["content"], body.get("usage"), False
+
+
+class AnthropicBatchBackend(BatchBackend):
+    @property
+    def client(self) -> AsyncAnthropic:
+        return CLIENTS["claude"].client  # type: ignore
+
+    @staticmethod
+    def claude_params(params: dict) -> dict:
+        params = request_body(params)
+        params.pop("seed", None)
+        params.pop("response_format", None)
+        params.setdefault("max_tokens", 4096)
+        system, params["messages"] = claude_system(params["messages"])
+        if system:
+            params["system"] = system
+        return params
+
+    async def submit(self, requests: list[tuple[int, dict]]) -> str:
+        batch = await self.client.messages.batches.create(
+            requests=[
+                {"custom_id": str(index), "params": self.claude_params(params)}  # type: ignore
+                for index, params in requests
+            ]
+        )
+        return batch.id
+
+    async def done(self, batch_id: str) -> bool:
+        batch = await self.client.messages.batches.retrieve(batch_id)
+        return batch.processing_status == "ended"
+
+    async def results(self, batch_id: str) -> list[Result]:
+        results = []
+        async for entry in await self.client.messages.batches.results(batch_id):
+            index = int(entry.custom_id)
+            if entry.result.type == "succeeded":
+                message = entry.result.message
+                reply = "".join(block.text for block in message.content if block.type == "text")
+                usage = claude_usage(
+                    message.usage.input_tokens,
+                    message.usage.output_tokens,
+                    message.usage.cache_read_input_tokens,
+                    message.usage.cache_creation_input_tokens,
+                )
+                results.append((index, "ok", reply, usage.model_dump(), False))
+            elif entry.result.type == "errored":
+                results.append((index, "error", entry.result.error.error.message, None, False))
+            else:
+                results.append((index, "error", f"batch request {entry.result.type}", None, False))
+        return results
+
+
+class FakeBatchBackend(BatchBackend):
+    """本地模拟的批量接口，提交delay秒后完成，回复为固定文本"""
+
+    REPLY = "Fake batch response"
+
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.batches: dict[str, tuple[float, list[tuple[int, dict]]]] = {}
+
+    async def submit(self, requests: list[tuple[int, dict]]) -> str:
+        batch_id = f"fake-batch-{uuid.uuid4().hex}"
+        self.batches[batch_id] = (time.monotonic(), requests)
+        return batch_id
+
+    async def done(self, batch_id: str) -> bool:
+        return time.monotonic() - self.batches[batch_id][0] >= self.delay
+
+    async def results(self, batch_id: str) -> list[Result]:
+        _, requests = self.batches.pop(batch_id)
+        usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        return [(index, "ok", self.REPLY, usage, False) for index, _ in requests]
+
+
+def build_backends() -> dict[ServiceProvider, BatchBackend]:
+    if BATCH_BACKEND == "fake":
+        fake = FakeBatchBackend()
+        return {"openai": fake, "azure": fake, "claude": fake}
+    return {
+        "openai": OpenAIBatchBackend("openai", "/v1/chat/completions"),
+        "azure": OpenAIBatchBackend(
+            "azure", "/chat/completions", extra_query={"api-version": "2024-10-21"}
+        ),
+        "claude": AnthropicBatchBackend(),
+    }
+
+
+BATCH_BACKENDS = build_backends()
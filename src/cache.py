@@ -0,0 +1,238 @@
+"""
+确定性请求（temperature=0）的响应缓存。
+
+两级缓存：进程内LRU + 可选的SQLite磁盘缓存（多个gunicorn worker共享同一文件）。
+- CHATBOT_CACHE_SIZE: 进程内LRU的最大条目数，0表示关闭缓存
+- CHATBOT_CACHE_DB: SQLite文件路径，为空时不启用磁盘缓存
+- CHATBOT_CACHE_TTL: 缓存有效期（秒）
+- CHATBOT_CACHE_DB_MAX_ROWS: 磁盘缓存最大条目数，超出后淘汰最久未访问的记录
+- CHATBOT_SINGLE_FLIGHT: 是否合并正在进行中的相同确定性请求，默认开启，设为0关闭
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Generic, Hashable, Optional, TypeVar
+
+from src.metrics import CACHE_REQUESTS
+
+logger = logging.getLogger("chatbot")
+
+CACHE_SIZE = int(os.getenv("CHATBOT_CACHE_SIZE", 10000))
+CACHE_DB = os.getenv("CHATBOT_CACHE_DB", "")
+CACHE_TTL = float(os.getenv("CHATBOT_CACHE_TTL", 7 * 24 * 3600))
+CACHE_DB_MAX_ROWS = int(os.getenv("CHATBOT_CACHE_DB_MAX_ROWS", 1_000_000))
+SINGLE_FLIGHT = os.getenv("CHATBOT_SINGLE_FLIGHT", "1") != "0"
+
+CachedResponse = tuple[str, Optional[dict]]
+T = TypeVar("T")
+
+
+def cache_key(*parts: Any) -> str:
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: OrderedDict[Any, tuple[float, Any]] = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if expires < time.time():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, expires: Optional[float] = None):
+        self._data[key] = (expires or time.time() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+
+class SqliteCache:
+    # 每写入多少次检查一次过期与容量
+    EVICT_INTERVAL = 1000
+
+    def __init__(self, path: str, ttl: float, max_rows: int):
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self._writes = 0
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        os.register_at_fork(after_in_child=self._reopen)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "expires REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS response_cache_accessed ON response_cache(accessed)"
+            )
+
+    def _reopen(self):
+        # gunicorn预加载应用时在master进程中创建，fork后每个worker使用自己的连接
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+
+    def get(self, key: str) -> Optional[tuple[float, CachedResponse]]:
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT value, expires FROM response_cache WHERE key = ? AND expires > ?",
+                (key, now),
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE response_cache SET accessed = ? WHERE key = ?", (now, key))
+        reply, usage = json.loads(row[0])
+        return row[1], (reply, usage)
+
+    def set(self, key: str, value: CachedResponse):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now + self.ttl, now),
+            )
+            self._writes += 1
+            if self._writes % self.EVICT_INTERVAL == 0:
+                self._evict(now)
+
+    def _evict(self, now: float):
+        self._conn.execute("DELETE FROM response_cache WHERE expires <= ?", (now,))
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM response_cache").fetchone()
+        if count > self.max_rows:
+            self._conn.execute(
+                "DELETE FROM response_cache WHERE key IN "
+                "(SELECT key FROM response_cache ORDER BY accessed LIMIT ?)",
+                (count - self.max_rows,),
+            )
+
+
+class ResponseCache:
+    def __init__(self, max_size: int, db_path: str, ttl: float, db_max_rows: int):
+        self.enabled = max_size > 0
+        self.memory = LRUCache(max_size, ttl)
+        self.disk = SqliteCache(db_path, ttl, db_max_rows) if self.enabled and db_path else None
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            item = await asyncio.to_thread(self.disk.get, key)
+            if item is not None:
+                expires, value = item
+                self.memory.set(key, value, expires)
+        CACHE_REQUESTS.inc("response", "miss" if value is None else "hit")
+        return value
+
+    async def set(self, key: str, reply: str, usage: Any):
+        if hasattr(usage, "model_dump"):
+            usage = usage.model_dump()
+        value = (reply, dict(usage) if usage else None)
+        self.memory.set(key, value)
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.set, key, value)
+
+
+class RefreshingCache(Generic[T]):
+    """异步加载的TTL缓存
+
+    - 未过期（ttl内）直接返回
+    - 已过期但未超过max_stale时先返回旧值，并在后台刷新（stale-while-revalidate）
+    - 同一个key同时只有一个加载任务，并发的调用方共用结果
+    """
+
+    def __init__(self, ttl: float, max_stale: float):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._data: dict[Hashable, tuple[float, T]] = {}
+        self._loading: dict[Hashable, asyncio.Task] = {}
+
+    async def get(self, key: Hashable, load: Callable[[], Awaitable[T]]) -> T:
+        item = self._data.get(key)
+        if item is not None:
+            age = time.monotonic() - item[0]
+            if age < self.ttl:
+                return item[1]
+            if age < self.max_stale:
+                self._refresh(key, load).add_done_callback(self._log_error)
+                return item[1]
+        # shield: 某个调用方被取消时不影响其他共用该任务的调用方
+        return await asyncio.shield(self._refresh(key, load))
+
+    def _refresh(self, key: Hashable, load: Callable[[], Awaitable[T]]) -> asyncio.Task:
+        if key not in self._loading:
+            self._loading[key] = asyncio.ensure_future(self._load(key, load))
+        return self._loading[key]
+
+    async def _load(self, key: Hashable, load: Callable[[], Awaitable[T]]) -> T:
+        try:
+            value = await load()
+            self._data[key] = (time.monotonic(), value)
+            return value
+        finally:
+            self._loading.pop(key, None)
+
+    @staticmethod
+    def _log_error(task: asyncio.Task):
+        if not task.cancelled() and task.exception():
+            logger.warning(f"Background refresh failed: {task.exception()}")
+
+    def invalidate(self, key: Hashable):
+        self._data.pop(key, None)
+
+
+class SingleFlight:
+    """相同key的并发调用只执行一次，结果分发给所有调用方。
+    调用方被取消时，只有在没有其他调用方等待时才取消底层任务"""
+
+    def __init__(self):
+        self._calls: dict[Hashable, list] = {}  # key: [task, 等待的调用方数]
+
+    async def do(self, key: Hashable, call: Callable[[], Awaitable[T]]) -> tuple[T, bool]:
+        """返回(结果, 是否与其他调用方共用)"""
+        entry = self._calls.get(key)
+        shared = entry is not None
+        if entry is None:
+            entry = self._calls[key] = [asyncio.ensure_future(call()), 0]
+            entry[0].add_done_callback(lambda _: self._forget(key, entry))
+        CACHE_REQUESTS.inc("single_flight", "hit" if shared else "miss")
+        entry[1] += 1
+        try:
+            return await asyncio.shield(entry[0]), shared
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not entry[0].done():
+                entry[0].cancel()
+
+    def _forget(self, key: Hashable, entry: list):
+        if self._calls.get(key) is entry:
+            del self._calls[key]
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+
+response_cache = ResponseCache(CACHE_SIZE, CACHE_DB, CACHE_TTL, CACHE_DB_MAX_ROWS)
+single_flight = SingleFlight()
@@ -2,14 +2,23 @@
 文件包含了对其他客户端的封装，使得调用方式与OpenAI的客户端一致
 """
 
+import os
 import time
+from typing import Any, AsyncIterator, Optional
 
 from anthropic import AsyncAnthropic
-from anthropic.types import ContentBlock, Message, TextBlock
+from anthropic.types import ContentBlock, Message, RawMessageStreamEvent, TextBlock
 from openai import NOT_GIVEN, AsyncOpenAI
 from openai.types.chat.chat_completion import ChatCompletion, Choice
+from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
+from openai.types.chat.chat_completion_chunk import Choice as ChunkChoice
+from openai.types.chat.chat_completion_chunk import ChoiceDelta
 from openai.types.chat.chat_completion_message import ChatCompletionMessage
-from openai.types.completion_usage import CompletionUsage
+from openai.types.completion_usage import CompletionUsage, PromptTokensDetails
+
+# 系统提示词超过该长度（字符数）时启用前缀缓存。claude写入缓存比普通输入贵25%，
+# 且低于1024 token的前缀不会被缓存，短提示词标记缓存没有收益
+PROMPT_CACHE_MIN_CHARS = int(os.getenv("CHATBOT_PROMPT_CACHE_MIN_CHARS", 2048))
 
 
 def claude_block_to_openai_message(block: ContentBlock) -> ChatCompletionMessage:
@@ -19,6 +28,113 @@ def claude_block_to_openai_message(block: ContentBlock) -> ChatCompletionMessage
     raise ValueError(f"Unsupported block type: {block}")
 
 
+def claude_image(part: dict) -> dict:
+    """将OpenAI格式的image_url转换为claude的image块"""
+    url = part["image_url"]["url"]
+    if url.startswith("data:"):
+        header, _, data = url.partition(",")
+        media_type = header.removeprefix("data:").split(";")[0]
+        return {
+            "type": "image",
+            "source": {"type": "base64", "media_type": media_type, "data": data},
+        }
+    return {"type": "image", "source": {"type": "url", "url": url}}
+
+
+def claude_messages(messages: list[dict]) -> list[dict]:
+    return [
+        (
+            message
+            if isinstance(message["content"], str)
+            else message
+            | {
+                "content": [
+                    claude_image(part) if part.get("type") == "image_url" else part
+                    for part in message["content"]
+                ]
+            }
+        )
+        for message in messages
+    ]
+
+
+def claude_system(messages: list[dict]) -> tuple[list[dict], list[dict]]:
+    """claude的系统提示词需要通过system参数传入。
+    返回(system文本块, 其余消息)，系统提示词足够长时在最后一块上标记cache_control，
+    使相同系统提示词的请求复用缓存的前缀"""
+    system = []
+    for message in messages:
+        if message["role"] == "system":
+            content = message["content"]
+            if isinstance(content, str):
+                system.append({"type": "text", "text": content})
+            else:
+                system.extend(dict(part) for part in content)
+    if system and sum(len(block.get("text", "")) for block in system) >= PROMPT_CACHE_MIN_CHARS:
+        system[-1]["cache_control"] = {"type": "ephemeral"}
+    return system, claude_messages([message for message in messages if message["role"] != "system"])
+
+
+def claude_usage(
+    input_tokens: int, output_tokens: int, cache_read: Optional[int], cache_write: Optional[int]
+) -> CompletionUsage:
+    """claude的input_tokens不含缓存部分，转换为openai的口径：prompt_tokens包含缓存的token"""
+    prompt_tokens = input_tokens + (cache_read or 0) + (cache_write or 0)
+    return CompletionUsage(
+        completion_tokens=output_tokens,
+        prompt_tokens=prompt_tokens,
+        total_tokens=prompt_tokens + output_tokens,
+        prompt_tokens_details=PromptTokensDetails(
+            cached_tokens=cache_read or 0, cache_write_tokens=cache_write or 0
+        ),
+    )
+
+
+def cached_tokens(usage: Any) -> int:
+    """usage中命中前缀缓存的输入token数，兼容openai/豆包的prompt_tokens_details与deepseek的格式"""
+    if not usage:
+        return 0
+    if not isinstance(usage, dict):
+        usage = usage.model_dump()
+    details = usage.get("prompt_tokens_details") or {}
+    return details.get("cached_tokens") or usage.get("prompt_cache_hit_tokens") or 0
+
+
+def normalize_usage(usage: Optional[CompletionUsage]) -> Optional[CompletionUsage]:
+    """将deepseek的prompt_cache_hit_tokens统一到prompt_tokens_details.cached_tokens"""
+    hit = getattr(usage, "prompt_cache_hit_tokens", None)
+    if usage is not None and hit is not None and usage.prompt_tokens_details is None:
+        usage.prompt_tokens_details = PromptTokensDetails(cached_tokens=hit)
+    return usage
+
+
+# claude的stop_reason与openai的finish_reason对应关系
+FINISH_REASONS = {"end_turn": "stop", "stop_sequence": "stop", "max_tokens": "length"}
+
+
+def claude_chunk(
+    id: str,
+    model: str,
+    content: Optional[str] = None,
+    finish_reason: Optional[str] = None,
+    usage: Optional[CompletionUsage] = None,
+) -> ChatCompletionChunk:
+    return ChatCompletionChunk(
+        id=id,
+        choices=[
+            ChunkChoice(
+                index=0,
+                delta=ChoiceDelta(content=content, role="assistant"),
+                finish_reason=finish_reason,  # type: ignore
+            )
+        ],
+        created=int(time.time() * 1000),
+        model=model,
+        object="chat.completion.chunk",
+        usage=usage,
+    )
+
+
 class AsyncClaude(AsyncOpenAI):
     def __init__(self, api_key: str, **kwargs):
         self.client = AsyncAnthropic(api_key=api_key, **kwargs)
@@ -33,7 +149,14 @@ class AsyncClaude(AsyncOpenAI):
 
     async def create(self, **kwargs):
         kwargs.setdefault("max_tokens", 4096)
+        # claude不支持stream_options, 流式响应中总会返回usage
+        kwargs.pop("stream_options", None)
         kwargs = {k: v for k, v in kwargs.items() if v not in (None, NOT_GIVEN)}
+        system, kwargs["messages"] = claude_system(kwargs["messages"])
+        if system:
+            kwargs["system"] = system
+        if kwargs.pop("stream", False):
+            return self._stream(**kwargs)
         res: Message = await self.client.messages.create(**kwargs)
         return ChatCompletion(
             id=res.id,
@@ -48,13 +171,38 @@ class AsyncClaude(AsyncOpenAI):
             created=int(time.time() * 1000),
             model=res.model,
             object="chat.completion",
-            usage=CompletionUsage(
-                completion_tokens=res.usage.output_tokens,
-                prompt_tokens=res.usage.input_tokens,
-                total_tokens=res.usage.output_tokens + res.usage.input_tokens,
+            usage=claude_usage(
+                res.usage.input_tokens,
+                res.usage.output_tokens,
+                res.usage.cache_read_input_tokens,
+                res.usage.cache_creation_input_tokens,
             ),
         )
 
+    async def _stream(self, **kwargs) -> AsyncIterator[ChatCompletionChunk]:
+        """将claude的流式事件转换为openai的ChatCompletionChunk"""
+        events = await self.client.messages.create(stream=True, **kwargs)
+        id, model, start_usage = "", kwargs.get("model", ""), None
+        event: RawMessageStreamEvent
+        async for event in events:
+            if event.type == "message_start":
+                id, model = event.message.id, event.message.model
+                start_usage = event.message.usage
+            elif event.type == "content_block_delta" and event.delta.type == "text_delta":
+                yield claude_chunk(id, model, content=event.delta.text)
+            elif event.type == "message_delta":
+                yield claude_chunk(
+                    id,
+                    model,
+                    finish_reason=FINISH_REASONS.get(event.delta.stop_reason or "", "stop"),
+                    usage=claude_usage(
+                        start_usage.input_tokens if start_usage else 0,
+                        event.usage.output_tokens,
+                        start_usage.cache_read_input_tokens if start_usage else 0,
+                        start_usage.cache_creation_input_tokens if start_usage else 0,
+                    ),
+                )
+
     @property
     def embedded(self):
         raise NotImplementedError("Claude does not support embedded completions")
@@ -0,0 +1,199 @@
+"""
+向量化的缓存与自动批处理。
+
+- 缓存以(service, model, dimensions, 文本hash)为键，向量以float32数组存储，约为list[float]内存的1/8
+- 并发的请求中未命中缓存的文本会合并为一次上游调用，单批不超过EMBEDDING_BATCH_SIZE条、
+  EMBEDDING_BATCH_TOKENS个估算token，最多等待EMBEDDING_BATCH_WAIT秒
+- 上游调用与对话补全一样经过并发限制、重试与监控；合并的批次因输入有误失败时，
+  按请求分别重试，一个请求的错误输入不影响同批的其他请求
+- 未命中缓存时检查调用方的配额，合并批次的用量按各请求估算的token数分摊给各调用方
+"""
+
+import asyncio
+import hashlib
+import os
+from array import array
+from typing import Optional
+
+from src.accounting import accountant, current_caller, usage_value
+from src.cache import LRUCache
+from src.clients import CLIENTS
+from src.limiter import limiter
+from src.metrics import CACHE_REQUESTS, record_usage, track_upstream
+from src.retry import is_retryable, with_retry
+from src.schema import ServiceProvider
+
+EMBEDDING_CACHE_SIZE = int(os.getenv("CHATBOT_EMBEDDING_CACHE_SIZE", 20000))
+EMBEDDING_BATCH_SIZE = int(os.getenv("CHATBOT_EMBEDDING_BATCH_SIZE", 256))
+EMBEDDING_BATCH_WAIT = float(os.getenv("CHATBOT_EMBEDDING_BATCH_WAIT", 0.01))
+# 单批估算token数的上限，openai单次请求的上限为300000
+EMBEDDING_BATCH_TOKENS = int(os.getenv("CHATBOT_EMBEDDING_BATCH_TOKENS", 100000))
+
+EmbeddingKey = tuple[str, str, Optional[int]]
+
+
+def text_hash(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+async def create_embeddings(service: ServiceProvider, model: str, **kwargs):
+    """经过并发限制、重试与监控调用服务商的embeddings接口，并记录用量"""
+
+    async def create():
+        async with limiter.slot(service, model):
+            with track_upstream(service, model):
+                return await CLIENTS[service].embeddings.create(model=model, **kwargs)
+
+    res = await with_retry(service, model, create)
+    record_usage(service, model, res.usage)
+    return res
+
+
+def estimate_tokens(text: str) -> int:
+    # 按UTF-8字节数粗略估算，偏大，避免在事件循环中分词
+    return len(text.encode("utf-8")) // 3 + 1
+
+
+class PendingBatch:
+    def __init__(self):
+        # 等待中的文本 -> future
+        self.futures: dict[str, asyncio.Future] = {}
+        # 每个请求的(调用方, 加入本批次的文本)，失败时按请求拆分，成功时按请求分摊用量
+        self.requests: list[tuple[str, list[str]]] = []
+        self.tokens = 0
+
+    def split(self) -> list["PendingBatch"]:
+        batches = []
+        for caller, texts in self.requests:
+            batch = PendingBatch()
+            batch.futures = {text: self.futures[text] for text in texts}
+            batch.requests = [(caller, texts)]
+            batches.append(batch)
+        return batches
+
+    def record(self, service: str, model: str, usage):
+        """按各请求估算的token数分摊实际用量，服务商没有返回usage时直接使用估算值"""
+        weights = [sum(estimate_tokens(text) for text in texts) for _, texts in self.requests]
+        total = usage_value(usage, "prompt_tokens") if usage else sum(weights)
+        remaining = total
+        for i, ((caller, _), weight) in enumerate(zip(self.requests, weights)):
+            share = remaining if i == len(weights) - 1 else total * weight // sum(weights)
+            remaining -= share
+            accountant.record(caller, service, model, {"prompt_tokens": share})
+
+
+class EmbeddingBatcher:
+    def __init__(
+        self,
+        cache_size: int,
+        batch_size: int,
+        max_wait: float,
+        max_tokens: int = EMBEDDING_BATCH_TOKENS,
+    ):
+        self.cache = LRUCache(cache_size, float("inf"))
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.max_tokens = max_tokens
+        # 每个(service, model, dimensions)各自排队
+        self._pending: dict[EmbeddingKey, PendingBatch] = {}
+        self._timers: dict[EmbeddingKey, asyncio.TimerHandle] = {}
+        # 持有进行中的上游调用，避免任务在完成前被回收
+        self._tasks: set[asyncio.Task] = set()
+
+    async def embed(
+        self, service: ServiceProvider, model: str, dimensions: Optional[int], texts: list[str]
+    ) -> list[array]:
+        group = (service, model, dimensions)
+        results: list[Optional[array]] = []
+        missing: list[int] = []
+        for i, text in enumerate(texts):
+            embedding = self.cache.get((*group, text_hash(text))) if self.cache.max_size else None
+            CACHE_REQUESTS.inc("embedding", "miss" if embedding is None else "hit")
+            results.append(embedding)
+            if embedding is None:
+                missing.append(i)
+        if missing:
+            caller = current_caller.get()
+            accountant.check(caller)
+            futures = self._enqueue(group, caller, [texts[i] for i in missing])
+            for i, embedding in zip(missing, await asyncio.gather(*futures)):
+                results[i] = embedding
+        return results  # type: ignore
+
+    def _enqueue(self, group: EmbeddingKey, caller: str, texts: list[str]) -> list[asyncio.Future]:
+        futures = []
+        added: list[str] = []
+        for text in texts:
+            batch = self._pending.get(group)
+            if batch and text in batch.futures:  # 相同文本共用一次调用
+                futures.append(batch.futures[text])
+                if text not in added:
+                    added.append(text)
+                continue
+            tokens = estimate_tokens(text)
+            if batch and batch.tokens + tokens > self.max_tokens:
+                self._add_request(batch, caller, added)
+                self._flush(group)
+                added, batch = [], None
+            if batch is None:
+                batch = self._pending[group] = PendingBatch()
+            future = batch.futures[text] = asyncio.get_running_loop().create_future()
+            batch.tokens += tokens
+            futures.append(future)
+            added.append(text)
+            if len(batch.futures) >= self.batch_size:
+                self._add_request(batch, caller, added)
+                self._flush(group)
+                added = []
+        if added:
+            self._add_request(self._pending[group], caller, added)
+            if group not in self._timers:
+                self._timers[group] = asyncio.get_running_loop().call_later(
+                    self.max_wait, self._flush, group
+                )
+        return futures
+
+    @staticmethod
+    def _add_request(batch: PendingBatch, caller: str, texts: list[str]):
+        if texts:
+            batch.requests.append((caller, texts))
+
+    def _flush(self, group: EmbeddingKey):
+        timer = self._timers.pop(group, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(group, None)
+        if batch:
+            task = asyncio.create_task(self._request(group, batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _create(self, group: EmbeddingKey, texts: list[str]):
+        service, model, dimensions = group
+        kwargs = {"dimensions": dimensions} if dimensions else {}
+        return await create_embeddings(service, model, input=texts, **kwargs)  # type: ignore
+
+    async def _request(self, group: EmbeddingKey, batch: PendingBatch):
+        try:
+            res = await self._create(group, list(batch.futures))
+        except Exception as e:
+            # 服务商不可用时拆分只会放大请求量，只在输入有误时按请求分别重试
+            if len(batch.requests) > 1 and not is_retryable(e):
+                await asyncio.gather(*[self._request(group, part) for part in batch.split()])
+                return
+            for future in batch.futures.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        batch.record(group[0], group[1], res.usage)
+        for (text, future), item in zip(batch.futures.items(), res.data):
+            embedding = array("f", item.embedding)
+            if self.cache.max_size:
+                self.cache.set((*group, text_hash(text)), embedding)
+            if not future.done():
+                future.set_result(embedding)
+
+
+embedding_batcher = EmbeddingBatcher(
+    EMBEDDING_CACHE_SIZE, EMBEDDING_BATCH_SIZE, EMBEDDING_BATCH_WAIT
+)
@@ -0,0 +1,27 @@
+"""
+图片解码与压缩，在src.images的进程池中执行。
+该模块只依赖Pillow，子进程导入时不会加载服务的其他模块。
+"""
+
+import io
+
+from PIL import Image, ImageOps
+
+
+def shrink(data: bytes, max_side: int, format: str, quality: int) -> tuple[bytes, str]:
+    """将图片的长边缩小到max_side以内并重新编码，返回(图片数据, MIME类型)。
+    无需缩放且重新编码后没有变小时返回原图"""
+    with Image.open(io.BytesIO(data)) as original:
+        original_format = original.format
+        image = ImageOps.exif_transpose(original)
+        resized = max(image.size) > max_side
+        if resized:
+            image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        if format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, format, quality=quality)
+    output = buffer.getvalue()
+    if not resized and len(output) >= len(data) and original_format in Image.MIME:
+        return data, Image.MIME[original_format]
+    return output, Image.MIME[format]
@@ -0,0 +1,165 @@
+"""
+图片输入预处理。
+
+请求中的图片（image_url为链接或base64）在发送给服务商前：
+- 链接由服务端通过独立的连接池下载，内网链接服务商无法访问的问题也随之解决
+- 在进程池中解码、按模型配置把长边缩小到max_side以内，重新编码为JPEG/WebP，避免阻塞事件循环
+- 结果按图片内容哈希（以及链接）缓存，相同图片只处理一次
+
+配置（环境变量CHATBOT_IMAGE_CONFIG，JSON格式），键为模型名前缀，按最长前缀匹配：
+    {"gpt-4o": {"max_side": 2048}, "claude": {"max_side": 1568, "format": "WEBP", "quality": 80}}
+预处理默认关闭，CHATBOT_IMAGE_PREPROCESS=1时开启；未安装Pillow时图片原样转发。
+"""
+
+import asyncio
+import base64
+import hashlib
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from src.cache import LRUCache, SingleFlight
+from src.transport import transports
+
+logger = logging.getLogger("chatbot")
+
+DEFAULT_IMAGE_CONFIG = {"max_side": 1568, "format": "JPEG", "quality": 85}
+IMAGE_CONFIG: dict[str, dict] = json.loads(os.getenv("CHATBOT_IMAGE_CONFIG", "{}"))
+PILLOW_AVAILABLE = importlib.util.find_spec("PIL") is not None
+IMAGE_PREPROCESS = os.getenv("CHATBOT_IMAGE_PREPROCESS", "0") == "1" and PILLOW_AVAILABLE
+IMAGE_WORKERS = int(os.getenv("CHATBOT_IMAGE_WORKERS", 2))
+IMAGE_CACHE_SIZE = int(os.getenv("CHATBOT_IMAGE_CACHE_SIZE", 200))
+IMAGE_CACHE_TTL = 3600.0
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+
+if not PILLOW_AVAILABLE:
+    logger.warning("Pillow is not installed, images are forwarded without preprocessing")
+
+
+def image_config(model: str) -> dict:
+    prefixes = [prefix for prefix in IMAGE_CONFIG if model.startswith(prefix)]
+    if not prefixes:
+        return DEFAULT_IMAGE_CONFIG
+    return DEFAULT_IMAGE_CONFIG | IMAGE_CONFIG[max(prefixes, key=len)]
+
+
+def has_images(messages: list) -> bool:
+    return any(
+        isinstance(message.get("content"), list)
+        and any(part.get("type") == "image_url" for part in message["content"])
+        for message in messages
+    )
+
+
+class ImagePipeline:
+    def __init__(self, workers: int, cache_size: int):
+        self.workers = workers
+        self.cache = LRUCache(cache_size, IMAGE_CACHE_TTL)
+        self.flight = SingleFlight()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._client = None
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        # 延迟创建：gunicorn的每个worker各自创建进程池；使用spawn避免fork带有线程的进程
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._pool
+
+    async def fetch(self, url: str) -> bytes:
+        if self._client is None:
+            self._client = transports.build("images", "")
+        # 流式读取，超过大小限制时立即中断下载，不把整个响应读入内存
+        async with self._client.stream("GET", url, timeout=30, follow_redirects=True) as response:
+            response.raise_for_status()
+            if int(response.headers.get("content-length", 0)) > MAX_IMAGE_BYTES:
+                raise ValueError(f"图片大小超过{MAX_IMAGE_BYTES}字节")
+            chunks, size = [], 0
+            async for chunk in response.aiter_bytes():
+                size += len(chunk)
+                if size > MAX_IMAGE_BYTES:
+                    raise ValueError(f"图片大小超过{MAX_IMAGE_BYTES}字节")
+                chunks.append(chunk)
+        return b"".join(chunks)
+
+    async def process(self, url: str, model: str) -> str:
+        """返回处理后的data URL，处理失败时返回原链接"""
+        config = image_config(model)
+        config_key = json.dumps(config, sort_keys=True)
+        try:
+            if url.startswith("data:"):
+                data = base64.b64decode(url.partition(",")[2])
+            else:
+                key = ("url", url, config_key)
+                if (cached := self.cache.get(key)) is None:
+                    cached, _ = await self.flight.do(key, lambda: self._process_url(url, config))
+                    self.cache.set(key, cached)
+                return cached
+            return await self._process_data(data, config)
+        except Exception as e:
+            logger.warning(f"Preprocess image failed, forwarding as is: {e}")
+            return url
+
+    async def _process_url(self, url: str, config: dict) -> str:
+        return await self._process_data(await self.fetch(url), config)
+
+    async def _process_data(self, data: bytes, config: dict) -> str:
+        key = (hashlib.sha256(data).hexdigest(), json.dumps(config, sort_keys=True))
+        if (cached := self.cache.get(key)) is not None:
+            return cached
+        loop = asyncio.get_running_loop()
+        from src.image_ops import shrink
+
+        output, mime = await loop.run_in_executor(
+            self.pool, shrink, data, config["max_side"], config["format"], config["quality"]
+        )
+        result = f"data:{mime};base64,{base64.b64encode(output).decode()}"
+        self.cache.set(key, result)
+        return result
+
+    async def preprocess(self, messages: list, model: str) -> list:
+        """返回图片替换为处理结果后的消息列表，不修改传入的messages"""
+        if not IMAGE_PREPROCESS or not has_images(messages):
+            return messages
+        parts = [
+            part
+            for message in messages
+            if isinstance(message.get("content"), list)
+            for part in message["content"]
+            if part.get("type") == "image_url"
+        ]
+        urls = await asyncio.gather(
+            *[self.process(part["image_url"]["url"], model) for part in parts]
+        )
+        processed = {id(part): url for part, url in zip(parts, urls)}
+        return [
+            (
+                message
+                if not isinstance(message.get("content"), list)
+                else message
+                | {
+                    "content": [
+                        (
+                            part | {"image_url": part["image_url"] | {"url": processed[id(part)]}}
+                            if id(part) in processed
+                            else part
+                        )
+                        for part in message["content"]
+                    ]
+                }
+            )
+            for message in messages
+        ]
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+image_pipeline = ImagePipeline(IMAGE_WORKERS, IMAGE_CACHE_SIZE)
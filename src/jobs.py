@@ -0,0 +1,414 @@
+"""
+异步批量任务。
+
+任务与每条请求的结果保存在SQLite（CHATBOT_JOB_DB）中，每个gunicorn worker运行一个JobRunner：
+- 通过租约（lease）认领任务：认领后由独立的心跳每隔LEASE_SECONDS/3续约，与请求的耗时无关；
+  worker退出时释放租约，崩溃时租约过期后由其他worker接手
+- 任务出错时租约按失败次数指数延后，到期后再由任意worker重试；
+  连续JOB_MAX_ATTEMPTS次失败且期间没有完成任何条目时，任务标记为failed
+- 只处理status为pending的条目，每批完成的结果立即写入数据库，
+  因此worker被max_requests回收或服务重启后，任务会从中断处继续
+- 同一任务同时在途的请求数不超过JOB_WINDOW，实际并发由src.limiter控制
+- 参数native_batch为true时改用服务商的Batch API，见src.batch_api
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Optional
+
+from openai import NOT_GIVEN
+
+from src.accounting import DEFAULT_CALLER, QuotaExceeded, accountant, current_caller
+from src.batch_api import BATCH_BACKENDS, MAX_BATCH_SIZE
+from src.retrieve_text import chatbot_openai
+
+logger = logging.getLogger("chatbot")
+
+JOB_DB = os.getenv("CHATBOT_JOB_DB", "")
+JOB_WINDOW = int(os.getenv("CHATBOT_JOB_WINDOW", 200))
+LEASE_SECONDS = 60.0
+POLL_INTERVAL = 2.0
+JOB_MAX_ATTEMPTS = int(os.getenv("CHATBOT_JOB_MAX_ATTEMPTS", 5))
+MAX_RETRY_DELAY = 600.0
+# 原生批量任务查询批次状态的间隔
+BATCH_POLL_INTERVAL = float(os.getenv("CHATBOT_BATCH_POLL_INTERVAL", 30))
+
+
+def retry_delay(failures: int) -> float:
+    return min(POLL_INTERVAL * 2**failures, MAX_RETRY_DELAY)
+
+
+class JobStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        os.register_at_fork(after_in_child=self._reopen)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, status TEXT NOT NULL, params TEXT NOT NULL, "
+                "total INTEGER NOT NULL, created REAL NOT NULL, updated REAL NOT NULL, "
+                "owner TEXT, lease REAL NOT NULL DEFAULT 0, "
+                "attempts INTEGER NOT NULL DEFAULT 0, error TEXT)"
+            )
+            # 兼容增加attempts与error之前创建的数据库
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            for column, definition in (
+                ("attempts", "INTEGER NOT NULL DEFAULT 0"),
+                ("error", "TEXT"),
+            ):
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_items ("
+                "job_id TEXT NOT NULL, idx INTEGER NOT NULL, request TEXT NOT NULL, "
+                "status TEXT NOT NULL, reply TEXT, usage TEXT, cached INTEGER, "
+                "PRIMARY KEY (job_id, idx))"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS job_items_status ON job_items(job_id, status)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_batches ("
+                "batch_id TEXT PRIMARY KEY, job_id TEXT NOT NULL, service TEXT NOT NULL, "
+                "indices TEXT NOT NULL, done INTEGER NOT NULL DEFAULT 0)"
+            )
+
+    def _reopen(self):
+        # gunicorn预加载应用时在master进程中创建，fork后每个worker使用自己的连接
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+
+    def create(self, params: dict, requests: list[dict]) -> str:
+        """params为所有条目共用的调用参数，requests中每条至少包含messages，其余字段覆盖params"""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO jobs (id, status, params, total, created, updated) "
+                "VALUES (?, 'pending', ?, ?, ?, ?)",
+                (job_id, json.dumps(params, ensure_ascii=False), len(requests), now, now),
+            )
+            self._conn.executemany(
+                "INSERT INTO job_items (job_id, idx, request, status) VALUES (?, ?, ?, 'pending')",
+                (
+                    (job_id, index, json.dumps(request, ensure_ascii=False))
+                    for index, request in enumerate(requests)
+                ),
+            )
+        return job_id
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT status, params, total, created, updated, error FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            counts = dict(
+                self._conn.execute(
+                    "SELECT status, COUNT(*) FROM job_items WHERE job_id = ? GROUP BY status",
+                    (job_id,),
+                ).fetchall()
+            )
+        status, params, total, created, updated, error = row
+        return {
+            "job_id": job_id,
+            "job_status": status,
+            "params": json.loads(params),
+            "total": total,
+            "progress": {key: counts.get(key, 0) for key in ("pending", "ok", "error")},
+            "created": created,
+            "updated": updated,
+            "error": error,
+        }
+
+    def results(self, job_id: str, offset: int, limit: int) -> list[dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT idx, status, reply, usage, cached FROM job_items "
+                "WHERE job_id = ? AND idx >= ? ORDER BY idx LIMIT ?",
+                (job_id, offset, limit),
+            ).fetchall()
+        return [
+            {
+                "index": index,
+                "status": status,
+                "reply": reply,
+                "usage": json.loads(usage) if usage else None,
+                "cached": bool(cached),
+            }
+            for index, status, reply, usage, cached in rows
+        ]
+
+    def cancel(self, job_id: str) -> bool:
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = 'cancelled', updated = ? "
+                "WHERE id = ? AND status IN ('pending', 'running')",
+                (time.time(), job_id),
+            )
+        return cursor.rowcount > 0
+
+    def claim(self, owner: str) -> Optional[str]:
+        """认领最早创建且租约已过期的未完成任务"""
+        now = time.time()
+        lease = now + LEASE_SECONDS
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = 'running', owner = ?, lease = ?, updated = ? "
+                "WHERE id = (SELECT id FROM jobs WHERE status IN ('pending', 'running') "
+                "AND lease < ? ORDER BY created LIMIT 1) AND lease < ?",
+                (owner, lease, now, now, now),
+            )
+            if cursor.rowcount == 0:
+                return None
+            row = self._conn.execute(
+                "SELECT id FROM jobs WHERE owner = ? AND lease = ?", (owner, lease)
+            ).fetchone()
+        return row[0] if row else None
+
+    def renew(self, job_id: str, owner: str) -> bool:
+        """续约，任务被取消或已被其他worker接手时返回False"""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET lease = ? WHERE id = ? AND owner = ? AND status = 'running'",
+                (time.time() + LEASE_SECONDS, job_id, owner),
+            )
+        return cursor.rowcount > 0
+
+    def release(self, job_id: str, owner: str):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET lease = 0 WHERE id = ? AND owner = ?", (job_id, owner)
+            )
+
+    def fail(self, job_id: str, owner: str, error: str):
+        """记录一次失败：延后租约，到期后再重试；连续失败JOB_MAX_ATTEMPTS次后标记为failed。
+        保存结果时失败次数清零，因此只有没有进展的失败才会累计"""
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT attempts FROM jobs WHERE id = ? AND owner = ? AND status = 'running'",
+                (job_id, owner),
+            ).fetchone()
+            if row is None:
+                return
+            attempts = row[0] + 1
+            status = "failed" if attempts >= JOB_MAX_ATTEMPTS else "running"
+            lease = 0 if status == "failed" else now + retry_delay(attempts)
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, lease = ?, attempts = ?, error = ?, updated = ? "
+                "WHERE id = ?",
+                (status, lease, attempts, error, now, job_id),
+            )
+
+    def pending(self, job_id: str) -> list[tuple[int, dict]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT idx, request FROM job_items WHERE job_id = ? AND status = 'pending' "
+                "ORDER BY idx",
+                (job_id,),
+            ).fetchall()
+        return [(index, json.loads(request)) for index, request in rows]
+
+    def save(self, job_id: str, results: list[tuple[int, str, Any, Any, bool]]):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE job_items SET status = ?, reply = ?, usage = ?, cached = ? "
+                "WHERE job_id = ? AND idx = ?",
+                (
+                    (status, reply, json.dumps(usage) if usage else None, cached, job_id, index)
+                    for index, status, reply, usage, cached in results
+                ),
+            )
+            self._conn.execute(
+                "UPDATE jobs SET updated = ?, attempts = 0 WHERE id = ?", (time.time(), job_id)
+            )
+
+    def add_batch(self, job_id: str, batch_id: str, service: str, indices: list[int]):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO job_batches (batch_id, job_id, service, indices) VALUES (?, ?, ?, ?)",
+                (batch_id, job_id, service, json.dumps(indices)),
+            )
+
+    def open_batches(self, job_id: str) -> list[tuple[str, str, list[int]]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT batch_id, service, indices FROM job_batches WHERE job_id = ? AND done = 0",
+                (job_id,),
+            ).fetchall()
+        return [(batch_id, service, json.loads(indices)) for batch_id, service, indices in rows]
+
+    def close_batch(self, batch_id: str):
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE job_batches SET done = 1 WHERE batch_id = ?", (batch_id,))
+
+    def finish(self, job_id: str, owner: str):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'completed', lease = 0, updated = ? "
+                "WHERE id = ? AND owner = ? AND status = 'running'",
+                (time.time(), job_id, owner),
+            )
+
+
+async def run_item(params: dict, request: dict) -> tuple[str, Any, Any, bool]:
+    params = params | request
+    messages = params.pop("messages")
+    # 后台执行没有请求上下文，使用提交时记录的调用方
+    current_caller.set((params.get("info") or {}).get("caller") or DEFAULT_CALLER)
+    params["response_format"] = params.get("response_format") or NOT_GIVEN
+    try:
+        reply, usage, cached = await chatbot_openai(messages, **params)
+    except Exception as e:  # 单条失败不影响整个任务
+        logger.error(f"Job item error: {e}")
+        return "error", getattr(e, "message", str(e)), None, False
+    if hasattr(usage, "model_dump"):
+        usage = usage.model_dump()
+    return "ok", reply, usage, cached
+
+
+class JobRunner:
+    def __init__(self, store: JobStore, window: int = JOB_WINDOW):
+        self.store = store
+        self.window = window
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+    async def run(self):
+        failures = 0
+        while True:
+            job_id = await asyncio.to_thread(self.store.claim, self.owner)
+            if job_id is None:
+                await asyncio.sleep(POLL_INTERVAL)
+                continue
+            try:
+                await self.hold(job_id)
+            except asyncio.CancelledError:
+                await asyncio.to_thread(self.store.release, job_id, self.owner)
+                raise
+            except Exception as e:
+                logger.error(f"Job {job_id} failed: {e}")
+                await asyncio.to_thread(self.store.fail, job_id, self.owner, str(e))
+                # 连续出错时（如数据库或服务商不可用）暂缓认领
+                failures += 1
+                await asyncio.sleep(retry_delay(failures))
+                continue
+            failures = 0
+            await asyncio.to_thread(self.store.release, job_id, self.owner)
+
+    async def heartbeat(self, job_id: str):
+        """每隔LEASE_SECONDS/3续约，任务被取消或已被其他worker接手时返回"""
+        while True:
+            await asyncio.sleep(LEASE_SECONDS / 3)
+            if not await asyncio.to_thread(self.store.renew, job_id, self.owner):
+                return
+
+    async def hold(self, job_id: str):
+        """在心跳维持租约期间处理任务。
+        单条请求可能远超LEASE_SECONDS（推理模型、TPM排队、提交大批次），续约不能依赖处理进度，
+        否则租约过期后其他worker会重复调用服务商；失去租约时停止处理"""
+        work = asyncio.create_task(self.process(job_id))
+        heartbeat = asyncio.create_task(self.heartbeat(job_id))
+        try:
+            await asyncio.wait({work, heartbeat}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            heartbeat.cancel()
+            if not work.done():
+                work.cancel()
+                await asyncio.wait({work})
+        for task in (work, heartbeat):
+            if task.done() and not task.cancelled() and task.exception():
+                raise task.exception()  # type: ignore
+
+    async def process(self, job_id: str):
+        job = await asyncio.to_thread(self.store.get, job_id)
+        if job["params"].get("native_batch"):  # type: ignore
+            return await self.process_native(job_id, job)  # type: ignore
+        items = iter(await asyncio.to_thread(self.store.pending, job_id))
+        pending: set[asyncio.Task] = set()
+
+        async def indexed(index: int, request: dict):
+            return index, *await run_item(job["params"], request)  # type: ignore
+
+        try:
+            while True:
+                for index, request in items:
+                    pending.add(asyncio.create_task(indexed(index, request)))
+                    if len(pending) >= self.window:
+                        break
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                await asyncio.to_thread(self.store.save, job_id, [task.result() for task in done])
+            await asyncio.to_thread(self.store.finish, job_id, self.owner)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def process_native(self, job_id: str, job: dict):
+        """通过服务商的Batch API执行任务。已提交的批次记录在数据库中，重启后继续轮询而不会重复提交"""
+        batches = await asyncio.to_thread(self.store.open_batches, job_id)
+        submitted = {index for _, _, indices in batches for index in indices}
+        groups: dict[tuple[str, str], list[tuple[int, dict]]] = {}
+        # 每条请求的(调用方, 模型)，用于记录用量
+        owners: dict[int, tuple[str, str]] = {}
+        rejected = []
+        for index, request in await asyncio.to_thread(self.store.pending, job_id):
+            params = job["params"] | request
+            caller = (params.get("info") or {}).get("caller") or DEFAULT_CALLER
+            owners[index] = (caller, params["model"])
+            if index in submitted:
+                continue
+            try:
+                accountant.check(caller)
+            except QuotaExceeded as e:
+                rejected.append((index, "error", str(e), None, False))
+                continue
+            groups.setdefault((params["service"], params["model"]), []).append((index, params))
+        if rejected:
+            await asyncio.to_thread(self.store.save, job_id, rejected)
+        for (service, _), requests in groups.items():
+            for i in range(0, len(requests), MAX_BATCH_SIZE):
+                chunk = requests[i : i + MAX_BATCH_SIZE]
+                batch_id = await BATCH_BACKENDS[service].submit(chunk)  # type: ignore
+                indices = [index for index, _ in chunk]
+                await asyncio.to_thread(self.store.add_batch, job_id, batch_id, service, indices)
+                batches.append((batch_id, service, indices))
+
+        while batches:
+            for batch in list(batches):
+                batch_id, service, indices = batch
+                backend = BATCH_BACKENDS[service]  # type: ignore
+                if not await backend.done(batch_id):
+                    continue
+                results = await backend.results(batch_id)
+                for index, _, _, usage, _ in results:
+                    caller, model = owners[index]
+                    accountant.record(caller, service, model, usage)
+                returned = {result[0] for result in results}
+                results += [
+                    (index, "error", "批次结束时没有返回该条结果", None, False)
+                    for index in indices
+                    if index not in returned
+                ]
+                await asyncio.to_thread(self.store.save, job_id, results)
+                await asyncio.to_thread(self.store.close_batch, batch_id)
+                batches.remove(batch)
+            if batches:
+                await asyncio.sleep(BATCH_POLL_INTERVAL)
+        await asyncio.to_thread(self.store.finish, job_id, self.owner)
+
+
+job_store = JobStore(JOB_DB) if JOB_DB else None
@@ -0,0 +1,195 @@
+"""
+按服务商、模型划分的自适应并发限制。
+
+每个服务商和每个(服务商, 模型)各有一个AIMD限流器：请求成功时并发上限缓慢增加，
+遇到429/超时等过载响应时上限减半。可选的全局预算通过文件锁在所有gunicorn worker之间共享。
+
+配置（环境变量CHATBOT_LIMITS，JSON格式），键为服务商或"服务商/模型"：
+    {"openai": {"initial": 100, "max": 300}, "minimax/abab6.5s-chat": {"initial": 5, "global": 20}}
+- initial: 初始并发上限
+- min/max: 并发上限的调整范围
+- global: 所有worker合计的并发上限，需要同时设置CHATBOT_LIMIT_DIR
+"""
+
+import asyncio
+import fcntl
+import json
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from anthropic import APITimeoutError as AnthropicTimeoutError
+from openai import APITimeoutError
+
+from src.schema import ServiceProvider
+
+DEFAULT_LIMIT = {"initial": 50, "min": 1, "max": 200}
+DEFAULT_LIMITS: dict[str, dict] = {
+    "openai": {"initial": 100, "min": 1, "max": 500},
+    "azure": {"initial": 100, "min": 1, "max": 300},
+    "minimax": {"initial": 10, "min": 1, "max": 50},
+    "moonshot": {"initial": 20, "min": 1, "max": 100},
+}
+LIMITS: dict[str, dict] = DEFAULT_LIMITS | json.loads(os.getenv("CHATBOT_LIMITS", "{}"))
+LIMIT_DIR = os.getenv("CHATBOT_LIMIT_DIR", "")
+
+# 过载的状态码：429限流、503服务不可用、529 claude过载
+OVERLOAD_STATUS = (429, 503, 529)
+TIMEOUT_ERRORS = (APITimeoutError, AnthropicTimeoutError, asyncio.TimeoutError)
+
+
+def is_overload(exc: Optional[BaseException]) -> bool:
+    if exc is None:
+        return False
+    return isinstance(exc, TIMEOUT_ERRORS) or getattr(exc, "status_code", None) in OVERLOAD_STATUS
+
+
+class AdaptiveLimiter:
+    """AIMD并发限制：成功时上限每轮+1，过载时乘以decrease，同一冷却期内只下调一次；其他错误不调整"""
+
+    def __init__(
+        self,
+        initial: int,
+        min: int = 1,
+        max: int = 1000,
+        decrease: float = 0.5,
+        cooldown: float = 1.0,
+        **_,
+    ):
+        self.limit = float(initial)
+        self.min_limit = min
+        self.max_limit = max
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._waiters: deque[asyncio.Future] = deque()
+
+    async def acquire(self):
+        while self.in_flight >= int(self.limit):
+            # future在调用时创建，不会像全局Semaphore一样在python3.9中挂载到错误的loop
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done():  # 已被唤醒但被取消，把名额让给下一个
+                    self._wake()
+                else:
+                    self._waiters.remove(waiter)
+                raise
+        self.in_flight += 1
+
+    def release(self, exc: Optional[BaseException] = None):
+        if is_overload(exc):
+            now = time.monotonic()
+            if now - self._last_decrease > self.cooldown:
+                self._last_decrease = now
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+        elif exc is None:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def stats(self) -> dict:
+        return {"limit": int(self.limit), "in_flight": self.in_flight}
+
+
+class GlobalBudget:
+    """跨进程的并发预算。每个名额对应锁文件中的一个字节，进程退出时文件锁会自动释放"""
+
+    def __init__(self, path: str, size: int, poll: float = 0.05):
+        self.size = size
+        self.poll = poll
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._held: set[int] = set()
+
+    def _try_acquire(self) -> Optional[int]:
+        for offset in range(self.size):
+            # fcntl锁归属于进程，同一进程内需要自己记录已持有的名额
+            if offset in self._held:
+                continue
+            try:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+            except OSError:
+                continue
+            self._held.add(offset)
+            return offset
+        return None
+
+    async def acquire(self) -> int:
+        while (offset := self._try_acquire()) is None:
+            await asyncio.sleep(self.poll)
+        return offset
+
+    def release(self, offset: int):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, offset)
+        self._held.discard(offset)
+
+
+class LimiterRegistry:
+    def __init__(self, limits: dict[str, dict], limit_dir: str):
+        self.limits = limits
+        self.limit_dir = limit_dir
+        self.limiters: dict[str, AdaptiveLimiter] = {}
+        self.budgets: dict[str, Optional[GlobalBudget]] = {}
+
+    def _config(self, key: str, service: ServiceProvider) -> dict:
+        return self.limits.get(key) or self.limits.get(service) or DEFAULT_LIMIT
+
+    def _get(self, key: str, service: ServiceProvider) -> AdaptiveLimiter:
+        if key not in self.limiters:
+            self.limiters[key] = AdaptiveLimiter(**self._config(key, service))
+        return self.limiters[key]
+
+    def _budget(self, key: str) -> Optional[GlobalBudget]:
+        if key not in self.budgets:
+            size = self.limits.get(key, {}).get("global")
+            budget = None
+            if size and self.limit_dir:
+                path = os.path.join(self.limit_dir, f"{key.replace('/', '__')}.lock")
+                budget = GlobalBudget(path, size)
+            self.budgets[key] = budget
+        return self.budgets[key]
+
+    @asynccontextmanager
+    async def slot(self, service: ServiceProvider, model: str):
+        """依次获取模型、服务商的并发名额（及全局预算），退出时根据异常类型调整上限。
+        先在模型上排队，等待中的请求不占用服务商的名额，一个模型饱和时不影响同服务商的其他模型"""
+        keys = (f"{service}/{model}", service)
+        limiters = [self._get(key, service) for key in keys]
+        budgets = [budget for key in keys if (budget := self._budget(key))]
+        acquired: list[AdaptiveLimiter] = []
+        held: list[tuple[GlobalBudget, int]] = []
+        exc: Optional[BaseException] = None
+        try:
+            for limiter in limiters:
+                await limiter.acquire()
+                acquired.append(limiter)
+            for budget in budgets:
+                held.append((budget, await budget.acquire()))
+            yield
+        except BaseException as e:
+            exc = e
+            raise
+        finally:
+            for budget, offset in held:
+                budget.release(offset)
+            for limiter in acquired:
+                limiter.release(exc)
+
+    def stats(self) -> dict[str, dict]:
+        return {key: limiter.stats() for key, limiter in self.limiters.items()}
+
+
+limiter = LimiterRegistry(LIMITS, LIMIT_DIR)
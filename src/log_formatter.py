@@ -3,6 +3,23 @@ import logging
 from copy import copy
 
 
+def format_prompt(messages: list[dict]) -> str:
+    if len(messages) == 1:
+        return messages[0]["content"]
+    messages_str = []
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, list):
+            content = "\n".join(
+                f"[({content['type']})]{content[content['type']]}" for content in content
+            )
+        elif not isinstance(content, str):
+            content = str(content)
+
+        messages_str.append(f"<{message['role']}>: {content}")
+    return "\n".join(messages_str)
+
+
 class JsonFormatter(logging.Formatter):
     def format(self, record: logging.LogRecord) -> str:
         if record.exc_info and not record.exc_text:
@@ -11,6 +28,8 @@ class JsonFormatter(logging.Formatter):
 
         record_dict = copy(record.__dict__)
         record_dict.pop("args", None)
+        if "messages" in record_dict:
+            record_dict["prompt"] = format_prompt(record_dict.pop("messages"))
         record_dict["msg"] = record.msg.format(**record_dict)
         if record.args:
             try:
@@ -22,4 +41,4 @@ class JsonFormatter(logging.Formatter):
         if record_dict["exc_text"]:
             record_dict["msg"] = f"{record_dict['msg']}\n{record_dict['exc_text']}"
             record_dict["exc_text"] = ""
-        return json.dumps(record_dict, ensure_ascii=False, separators=(",", ":"))
+        return json.dumps(record_dict, ensure_ascii=False, separators=(",", ":"), default=str)
@@ -0,0 +1,75 @@
+"""
+后台线程写日志。
+
+BackgroundHandler只负责把日志记录放入有界队列，格式化（JsonFormatter）、写文件和日志轮转
+都在后台线程中完成，避免阻塞事件循环。队列满时丢弃新记录并计数。
+"""
+
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import ClassVar
+
+
+class BackgroundHandler(QueueHandler):
+    instances: ClassVar[list["BackgroundHandler"]] = []
+
+    def __init__(self, target: logging.Handler, maxsize: int = 10000):
+        super().__init__(queue.Queue(maxsize))
+        self.target = target
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.listener = QueueListener(self.queue, target, respect_handler_level=True)
+        self.listener.start()
+        self.instances.append(self)
+
+    def setFormatter(self, fmt):
+        # 格式化在后台线程中由目标handler完成
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 不在调用方线程格式化，直接转交原始记录
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def restart(self):
+        """fork后子进程中没有后台线程，需要重新创建队列和监听线程"""
+        self.queue = queue.Queue(self.maxsize)
+        self.listener = QueueListener(self.queue, self.target, respect_handler_level=True)
+        self.listener.start()
+
+    def close(self):
+        if self.listener._thread is not None:
+            self.listener.stop()
+        self.target.close()
+        super().close()
+
+    def stats(self) -> dict:
+        return {
+            "target": getattr(self.target, "baseFilename", type(self.target).__name__),
+            "queued": self.queue.qsize(),
+            "maxsize": self.maxsize,
+            "dropped": self.dropped,
+        }
+
+
+def _restart_all():
+    for handler in BackgroundHandler.instances:
+        handler.restart()
+
+
+os.register_at_fork(after_in_child=_restart_all)
+
+
+def rotating_file_handler(
+    filename: str, maxBytes: int = 0, backupCount: int = 0, maxsize: int = 10000
+) -> BackgroundHandler:
+    """供logging.config.dictConfig使用的工厂函数：后台线程写入的RotatingFileHandler"""
+    target = RotatingFileHandler(filename, maxBytes=maxBytes, backupCount=backupCount)
+    return BackgroundHandler(target, maxsize)
@@ -0,0 +1,139 @@
+"""
+事件循环监控，每个worker在lifespan中启动一份：
+- 每隔LOOP_MONITOR_INTERVAL秒测量事件循环延迟（sleep实际耗时超出预期的部分），记录到监控指标
+- 看门狗线程发现事件循环超过SLOW_CALLBACK_THRESHOLD秒没有响应时，抓取事件循环线程当时的调用栈，
+  写入日志并保留最近的SLOW_CALLBACK_HISTORY条，阻塞结束后补充实际阻塞时长。
+  kind为callback表示某个回调占用了事件循环；为gil表示事件循环在等待IO时无法恢复运行
+  （GIL被其他线程占用或CPU不足），此时附带其他线程的调用栈
+- 线程池的使用情况：asyncio默认线程池（asyncio.to_thread）、tokenizer线程池，
+  以及FastAPI同步接口使用的anyio工作线程
+
+结果通过/debug/loop查看，延迟与阻塞次数同时记录在/metrics中。
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import anyio.to_thread
+
+from src import tokenizer
+from src.metrics import LOOP_LAG, SLOW_CALLBACKS
+
+logger = logging.getLogger("chatbot")
+
+LOOP_MONITOR_INTERVAL = float(os.getenv("CHATBOT_LOOP_MONITOR_INTERVAL", 0.05))
+SLOW_CALLBACK_THRESHOLD = float(os.getenv("CHATBOT_SLOW_CALLBACK_THRESHOLD", 0.2))
+SLOW_CALLBACK_HISTORY = 50
+STACK_LIMIT = 30
+
+
+def executor_stats(executor: Optional[ThreadPoolExecutor]) -> dict:
+    if executor is None:
+        return {"threads": 0, "max_workers": 0, "queued": 0}
+    return {
+        "threads": len(executor._threads),
+        "max_workers": executor._max_workers,
+        "queued": executor._work_queue.qsize(),
+    }
+
+
+class LoopMonitor:
+    def __init__(self, interval: float, threshold: float):
+        self.interval = interval
+        self.threshold = threshold
+        self.heartbeat = time.monotonic()
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.slow_callbacks: deque[dict] = deque(maxlen=SLOW_CALLBACK_HISTORY)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread_id: Optional[int] = None
+        self._stalled: Optional[dict] = None
+        self._stop = threading.Event()
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+        self._stop.clear()
+        watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        watchdog.start()
+        try:
+            while True:
+                start = time.monotonic()
+                await asyncio.sleep(self.interval)
+                self.heartbeat = time.monotonic()
+                lag = max(0.0, self.heartbeat - start - self.interval)
+                self.last_lag = lag
+                self.max_lag = max(self.max_lag, lag)
+                LOOP_LAG.observe(lag)
+                if self._stalled is not None:
+                    self._stalled["duration"] = lag
+                    self._stalled = None
+        finally:
+            self._stop.set()
+
+    def _watch(self):
+        """在独立线程中运行，事件循环被阻塞时抓取其调用栈"""
+        while not self._stop.wait(self.threshold / 4):
+            heartbeat = self.heartbeat
+            blocked = time.monotonic() - heartbeat - self.interval
+            if blocked < self.threshold or self._stalled is not None:
+                continue
+            frames = sys._current_frames()
+            frame = frames.pop(self._thread_id, None)  # type: ignore
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame, limit=STACK_LIMIT))
+            record = {"time": time.time(), "blocked": blocked, "duration": None, "stack": stack}
+            # 事件循环停在select中说明没有回调在执行，延迟来自其他线程占用GIL或进程没有获得CPU，
+            # 此时记录其他线程的调用栈
+            kind = "callback"
+            if frame.f_code.co_filename.endswith("selectors.py"):
+                kind = "gil"
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                record["threads"] = {
+                    names.get(ident, str(ident)): "".join(traceback.format_stack(f, limit=5))
+                    for ident, f in frames.items()
+                    if ident != threading.get_ident()
+                }
+            record["kind"] = kind
+            # 事件循环恢复前只记录一次
+            self._stalled = record
+            self.slow_callbacks.append(record)
+            SLOW_CALLBACKS.inc(kind)
+            logger.warning(f"Event loop blocked for more than {blocked:.3f}s ({kind})\n{stack}")
+
+    def threadpools(self) -> dict:
+        pools = {
+            "asyncio": executor_stats(getattr(self._loop, "_default_executor", None)),
+            "tokenizer": executor_stats(tokenizer.executor),
+        }
+        try:
+            limiter = anyio.to_thread.current_default_thread_limiter()
+            pools["anyio"] = {
+                "threads": limiter.borrowed_tokens,
+                "max_workers": limiter.total_tokens,
+                "queued": limiter.statistics().tasks_waiting,
+            }
+        except (RuntimeError, LookupError):  # 不在事件循环中调用时无法获取
+            pass
+        return pools
+
+    def stats(self) -> dict:
+        return {
+            "interval": self.interval,
+            "threshold": self.threshold,
+            "lag": {"last": self.last_lag, "max": self.max_lag},
+            "threadpools": self.threadpools(),
+            "slow_callbacks": list(reversed(self.slow_callbacks)),
+        }
+
+
+loop_monitor = LoopMonitor(LOOP_MONITOR_INTERVAL, SLOW_CALLBACK_THRESHOLD)
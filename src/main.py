@@ -1,7 +1,10 @@
 # coding:utf-8
+import asyncio
 import logging
 import time
+from contextlib import asynccontextmanager
 from pathlib import Path
+from typing import Union
 
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
@@ -10,28 +13,78 @@ from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 from uvicorn.protocols.utils import get_path_with_query_string
 
+from src import tokenizer
+from src.accounting import QuotaExceeded, accountant, current_caller, request_caller
+from src.clients import CLIENTS, ServiceUnavailable
+from src.images import image_pipeline
+from src.jobs import JobRunner, job_store
+from src.loop_monitor import loop_monitor
+from src.metrics import (
+    METRICS_DIR,
+    METRICS_FLUSH_INTERVAL,
+    REQUEST_LATENCY,
+    flush_periodically,
+    registry,
+)
 from src.routes.completion import router as completion_router
+from src.routes.debug import router as debug_router
 from src.routes.deprecated import router as deprecated_router
+from src.routes.jobs import router as jobs_router
+from src.routes.metrics import router as metrics_router
 from src.routes.models import router as models_router
+from src.routes.openai_compat import router as openai_router
+from src.routes.usage import router as usage_router
 from src.routes.vector import router as vec_router
+from src.transport import transports
 
 access_logger = logging.getLogger("chatbot.access")
 
 doc_dir = Path(__file__).parent.parent / "docs"
 api_doc = doc_dir / "api_docs.md"
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    CLIENTS.prepare()
+    await transports.prewarm()
+    await asyncio.to_thread(tokenizer.preload)
+    tasks = [asyncio.create_task(loop_monitor.run())]
+    if METRICS_DIR:
+        tasks.append(asyncio.create_task(flush_periodically(METRICS_DIR, METRICS_FLUSH_INTERVAL)))
+    if job_store:
+        tasks.append(asyncio.create_task(JobRunner(job_store).run()))
+    if accountant.store:
+        tasks.append(asyncio.create_task(accountant.flush_periodically()))
+    yield
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if METRICS_DIR:
+        # 退出前写入最后的快照，master随后将其归档
+        registry.flush(METRICS_DIR)
+    await accountant.flush()
+    await transports.aclose()
+    image_pipeline.shutdown()
+
+
 app = FastAPI(
     title="大模型调用平台",
     summary="大模型调用平台",
     version="1.0.0",
     description=api_doc.read_text(),
     docs_url=None,
+    lifespan=lifespan,
 )
 
 app.include_router(models_router)
 app.include_router(completion_router)
 app.include_router(vec_router)
 app.include_router(deprecated_router)
+app.include_router(debug_router)
+app.include_router(metrics_router)
+app.include_router(jobs_router)
+app.include_router(openai_router)
+app.include_router(usage_router)
 
 origins = []
 
@@ -47,8 +100,16 @@ app.add_middleware(
 @app.middleware("http")
 async def add_process_time_header(request: Request, call_next):
     start = time.perf_counter()
+    current_caller.set(request_caller(request.headers))
     response = await call_next(request)
     duration = (time.perf_counter() - start) * 1000
+    route = request.scope.get("route")
+    REQUEST_LATENCY.observe(
+        duration / 1000,
+        getattr(route, "path", "unmatched"),
+        request.method,
+        str(response.status_code),
+    )
     client = ""
     if request.scope.get("client"):
         client = "{}:{}".format(*request.scope["client"])
@@ -70,6 +131,14 @@ async def add_process_time_header(request: Request, call_next):
 app.mount("/static", StaticFiles(directory=doc_dir / "static"), name="static")
 
 
+@app.exception_handler(QuotaExceeded)
+@app.exception_handler(ServiceUnavailable)
+async def known_exception_handler(request: Request, exc: Union[QuotaExceeded, ServiceUnavailable]):
+    return JSONResponse(
+        status_code=exc.status_code, content={"reply": "", "status": "error", "error": str(exc)}
+    )
+
+
 @app.exception_handler(Exception)
 async def exception_handler(request: Request, exc: Exception):
     return JSONResponse(
@@ -0,0 +1,326 @@
+"""
+Prometheus格式的监控指标。
+
+每个worker在内存中累计指标，设置CHATBOT_METRICS_DIR后会定期把快照写入该目录下的{pid}-{随机id}.json，
+/metrics读取目录下所有快照合并：Counter与Histogram按标签求和，Gauge只保留存活worker的值并附加worker标签。
+未设置目录时只返回当前worker的指标。
+worker退出时gunicorn master把其Counter与Histogram并入archive.json并删除快照，已退出worker的累计值得以保留，
+目录也不会随worker回收无限增长；master启动时清空目录。
+"""
+
+import asyncio
+import fcntl
+import json
+import os
+import time
+import uuid
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Iterable, Optional
+
+from src.client_wrapper import cached_tokens
+
+METRICS_DIR = os.getenv("CHATBOT_METRICS_DIR", "")
+METRICS_FLUSH_INTERVAL = float(os.getenv("CHATBOT_METRICS_FLUSH_INTERVAL", 5))
+ARCHIVE_FILE = "archive.json"
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+Labels = tuple[str, ...]
+
+
+class Metric(ABC):
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: Labels = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+
+    @abstractmethod
+    def snapshot(self) -> dict:
+        """{以|连接的标签值: 值}，需可JSON序列化"""
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Labels = ()):
+        super().__init__(name, help, labels)
+        self.values: dict[Labels, float] = {}
+
+    def inc(self, *labels: str, value: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def snapshot(self) -> dict:
+        return {"|".join(k): v for k, v in self.values.items()}
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Labels = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # 每个标签组合: [各桶计数..., +Inf计数, 总和]
+        self.values: dict[Labels, list[float]] = {}
+
+    def observe(self, value: float, *labels: str):
+        counts = self.values.setdefault(labels, [0] * (len(self.buckets) + 2))
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def snapshot(self) -> dict:
+        return {"|".join(k): list(v) for k, v in self.values.items()}
+
+
+class Gauge(Metric):
+    """采集时通过回调读取当前值，回调返回{标签元组: 值}"""
+
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Labels, collect: Callable[[], dict]):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def snapshot(self) -> dict:
+        return {"|".join(k): v for k, v in self.collect().items()}
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+        self._new_worker()
+        # gunicorn预加载应用时在master中创建，fork后每个worker使用自己的快照文件
+        os.register_at_fork(after_in_child=self._new_worker)
+
+    def _new_worker(self):
+        # PID可能被新worker复用，文件名附加随机id，避免覆盖已退出worker的累计值
+        self.worker = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+    def register(self, metric: Metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Labels = ()) -> Counter:
+        return self.register(Counter(name, help, labels))  # type: ignore
+
+    def histogram(self, name: str, help: str, labels: Labels = (), **kwargs) -> Histogram:
+        return self.register(Histogram(name, help, labels, **kwargs))  # type: ignore
+
+    def gauge(self, name: str, help: str, labels: Labels, collect: Callable[[], dict]) -> Gauge:
+        return self.register(Gauge(name, help, labels, collect))  # type: ignore
+
+    def snapshot(self) -> dict:
+        return {
+            "pid": os.getpid(),
+            "time": time.time(),
+            "metrics": {
+                name: metric.snapshot()
+                for name, metric in self.metrics.items()
+                if not isinstance(metric, Gauge)
+            },
+            "gauges": {
+                name: metric.snapshot()
+                for name, metric in self.metrics.items()
+                if isinstance(metric, Gauge)
+            },
+        }
+
+    def flush(self, directory: str, snapshot: Optional[dict] = None):
+        path = Path(directory) / f"{self.worker}.json"
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(snapshot or self.snapshot()))
+        os.replace(tmp, path)
+
+    def load(self, snapshot: dict, directory: Optional[str]) -> list[dict]:
+        if not directory:
+            return [snapshot]
+        self.flush(directory, snapshot)
+        # 与archive互斥，避免同一worker的值在归档文件与快照中各读到一次
+        with locked(directory, fcntl.LOCK_SH):
+            return [s for path in Path(directory).glob("*.json") if (s := read(path))]
+
+    def render(self, snapshot: dict, directory: Optional[str] = None) -> str:
+        """snapshot为当前进程的指标，需要在事件循环中获取；
+        读写各worker的快照文件与合并可以在线程中进行"""
+        snapshots = self.load(snapshot, directory)
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            if isinstance(metric, Gauge):
+                for snapshot in snapshots:
+                    if name not in snapshot.get("gauges", {}) or not pid_alive(snapshot["pid"]):
+                        continue
+                    for key, value in snapshot["gauges"][name].items():
+                        values = (*split(key), str(snapshot["pid"]))
+                        labels = label_str(metric.labels + ("worker",), values)
+                        lines.append(f"{name}{labels} {value}")
+                continue
+            merged = merge(snapshot["metrics"].get(name, {}) for snapshot in snapshots)
+            for key, value in merged.items():
+                values = split(key)
+                if isinstance(metric, Histogram):
+                    cumulative = 0
+                    for bound, count in zip((*metric.buckets, "+Inf"), value[:-1]):
+                        cumulative += count
+                        labels = label_str(metric.labels + ("le",), (*values, str(bound)))
+                        lines.append(f"{name}_bucket{labels} {cumulative}")
+                    labels = label_str(metric.labels, values)
+                    lines.append(f"{name}_sum{labels} {value[-1]}")
+                    lines.append(f"{name}_count{labels} {cumulative}")
+                else:
+                    lines.append(f"{name}{label_str(metric.labels, values)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def merge(values: Iterable[dict]) -> dict[str, Any]:
+    """按标签求和，Histogram的值为列表，逐项相加"""
+    merged: dict[str, Any] = {}
+    for items in values:
+        for key, value in items.items():
+            if isinstance(value, list):
+                total = merged.setdefault(key, [0] * len(value))
+                merged[key] = [a + b for a, b in zip(total, value)]
+            else:
+                merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+@contextmanager
+def locked(directory: str, operation: int):
+    with open(Path(directory) / ".lock", "a") as file:
+        fcntl.flock(file, operation)
+        yield
+
+
+def read(path: Path) -> Optional[dict]:
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def archive(directory: str, pid: int):
+    """worker退出后由gunicorn master调用：把其Counter与Histogram并入归档文件并删除其快照"""
+    paths = list(Path(directory).glob(f"{pid}-*.json"))
+    if not paths:
+        return
+    archive_path = Path(directory) / ARCHIVE_FILE
+    with locked(directory, fcntl.LOCK_EX):
+        snapshots = [s for path in (archive_path, *paths) if (s := read(path))]
+        names = {name for snapshot in snapshots for name in snapshot["metrics"]}
+        metrics = {
+            name: merge(snapshot["metrics"].get(name, {}) for snapshot in snapshots)
+            for name in names
+        }
+        tmp = archive_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"pid": None, "time": time.time(), "metrics": metrics}))
+        os.replace(tmp, archive_path)
+        for path in paths:
+            path.unlink(missing_ok=True)
+
+
+def reset(directory: str):
+    """gunicorn master启动时调用，清除上次运行留下的快照"""
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    for path in Path(directory).glob("*.json"):
+        path.unlink(missing_ok=True)
+
+
+def split(key: str) -> tuple[str, ...]:
+    return tuple(key.split("|")) if key else ()
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def label_str(names: Labels, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{escape(str(v))}"' for n, v in zip(names, values)) + "}"
+
+
+def pid_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+async def flush_periodically(directory: str, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        registry.flush(directory)
+
+
+registry = Registry()
+
+REQUEST_LATENCY = registry.histogram(
+    "chatbot_request_duration_seconds", "HTTP请求耗时", ("route", "method", "status")
+)
+UPSTREAM_LATENCY = registry.histogram(
+    "chatbot_upstream_duration_seconds", "上游服务商调用耗时", ("service", "model")
+)
+UPSTREAM_TTFT = registry.histogram(
+    "chatbot_upstream_ttft_seconds", "流式调用首个token的耗时", ("service", "model")
+)
+UPSTREAM_REQUESTS = registry.counter(
+    "chatbot_upstream_requests_total",
+    "上游服务商调用次数，status为ok、HTTP状态码或异常类型",
+    ("service", "model", "status"),
+)
+TOKENS = registry.counter(
+    "chatbot_tokens_total",
+    "消耗的token数，type为prompt、completion或cached（prompt中命中前缀缓存的部分）",
+    ("service", "model", "type"),
+)
+CACHE_REQUESTS = registry.counter(
+    "chatbot_cache_requests_total", "缓存查询次数", ("cache", "result")
+)
+LOOP_LAG = registry.histogram("chatbot_event_loop_lag_seconds", "事件循环延迟", buckets=LAG_BUCKETS)
+SLOW_CALLBACKS = registry.counter(
+    "chatbot_slow_callbacks_total",
+    "事件循环被阻塞超过阈值的次数，kind为callback或gil（见/debug/loop）",
+    ("kind",),
+)
+QUOTA_REJECTED = registry.counter(
+    "chatbot_quota_rejected_total", "超出配额被拒绝的请求数", ("caller", "reason")
+)
+
+
+@contextmanager
+def track_upstream(service: str, model: str):
+    """记录一次上游调用的耗时与结果"""
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException as e:
+        status = str(getattr(e, "status_code", None) or type(e).__name__)
+        raise
+    finally:
+        UPSTREAM_LATENCY.observe(time.perf_counter() - start, service, model)
+        UPSTREAM_REQUESTS.inc(service, model, status)
+
+
+def record_usage(service: str, model: str, usage: Any):
+    if not usage:
+        return
+    if not isinstance(usage, dict):
+        usage = usage.model_dump()
+    for type in ("prompt_tokens", "completion_tokens"):
+        if usage.get(type):
+            TOKENS.inc(service, model, type.split("_")[0], value=usage[type])
+    if cached := cached_tokens(usage):
+        TOKENS.inc(service, model, "cached", value=cached)
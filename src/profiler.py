@@ -0,0 +1,121 @@
+"""
+采样分析器，用于在线上worker中定位CPU消耗。
+
+独立线程以固定频率读取各线程的调用栈（sys._current_frames），不需要插桩，开销与采样频率成正比。
+可选同时在事件循环中低频采样所有asyncio任务正在等待的位置（以"asyncio-tasks"为根），
+用于分析请求卡在哪些await上。
+
+结果格式：
+- collapsed：每行"线程;外层函数;...;内层函数 次数"，可直接用于flamegraph.pl或导入speedscope
+- speedscope：speedscope的JSON文件格式，每个线程一个profile
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+TASK_SAMPLE_HZ = 10
+TASKS_ROOT = "asyncio-tasks"
+
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def frame_stack(frame) -> list[str]:
+    """从最外层到最内层的函数名列表"""
+    stack = []
+    while frame is not None:
+        stack.append(frame_name(frame))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+class SamplingProfiler:
+    def __init__(self, hz: int = 100, all_threads: bool = True):
+        self.hz = hz
+        self.all_threads = all_threads
+        self.samples: Counter[tuple[str, ...]] = Counter()
+        self.duration = 0.0
+
+    def _sample_threads(self, target: Optional[int], stop: threading.Event):
+        me = threading.get_ident()
+        interval = 1 / self.hz
+        while not stop.wait(interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me or (not self.all_threads and ident != target):
+                    continue
+                thread = names.get(ident, str(ident))
+                self.samples[(thread, *frame_stack(frame))] += 1
+
+    def _sample_tasks(self):
+        current = asyncio.current_task()
+        for task in asyncio.all_tasks():
+            if task is current:
+                continue
+            # get_stack只返回协程链最内层的帧，逐层追溯被await的协程
+            stack, coro = [TASKS_ROOT], task.get_coro()
+            while coro is not None and getattr(coro, "cr_frame", None) is not None:
+                stack.append(frame_name(coro.cr_frame))
+                coro = coro.cr_await
+            self.samples[tuple(stack)] += 1
+
+    async def run(self, seconds: float, tasks: bool = False):
+        """采样seconds秒。采样线程之外，tasks为true时在事件循环中采样asyncio任务"""
+        stop = threading.Event()
+        sampler = threading.Thread(
+            target=self._sample_threads,
+            args=(threading.get_ident(), stop),
+            name="profiler",
+            daemon=True,
+        )
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            deadline = start + seconds
+            while (now := time.perf_counter()) < deadline:
+                if tasks:
+                    self._sample_tasks()
+                await asyncio.sleep(min(1 / TASK_SAMPLE_HZ, deadline - now))
+        finally:
+            stop.set()
+            await asyncio.to_thread(sampler.join)
+            self.duration = time.perf_counter() - start
+
+    def collapsed(self) -> str:
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in self.samples.items())
+
+    def speedscope(self, name: str) -> dict:
+        frames: dict[str, int] = {}
+        profiles: dict[str, dict] = {}
+        for (root, *stack), count in self.samples.items():
+            hz = TASK_SAMPLE_HZ if root == TASKS_ROOT else self.hz
+            profile = profiles.setdefault(
+                root,
+                {
+                    "type": "sampled",
+                    "name": root,
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": 0,
+                    "samples": [],
+                    "weights": [],
+                },
+            )
+            profile["samples"].append([frames.setdefault(frame, len(frames)) for frame in stack])
+            profile["weights"].append(count / hz)
+            profile["endValue"] += count / hz
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "chatbot_api",
+            "shared": {"frames": [{"name": frame} for frame in frames]},
+            "profiles": list(profiles.values()),
+        }
@@ -1,10 +1,23 @@
-from typing import Optional, Union
+import hashlib
+import json
+import time
+from typing import AsyncIterator, Optional, Union
 
 from openai import NOT_GIVEN
-from openai.types.chat import ChatCompletionMessageParam
+from openai.types.chat import ChatCompletion, ChatCompletionChunk, ChatCompletionMessageParam
 
+from src.accounting import accountant, approximate_usage, set_caller
+from src.cache import SINGLE_FLIGHT, cache_key, response_cache, single_flight
+from src.client_wrapper import PROMPT_CACHE_MIN_CHARS, normalize_usage
 from src.clients import CLIENTS
-from src.schema import ResponseFormat, ServiceProvider
+from src.embedding import embedding_batcher
+from src.images import image_pipeline
+from src.limiter import limiter
+from src.metrics import UPSTREAM_TTFT, record_usage, track_upstream
+from src.retry import is_retryable, with_retry
+from src.routing import NoBackendAvailable, model_router
+from src.scheduler import scheduler
+from src.schema import ResponseFormat, RoutedServiceProvider, ServiceProvider
 from src.utils import log_completion_info
 
 
@@ -30,28 +43,189 @@ async def chatbot_gpt4_turbo(text):
     return contents
 
 
+def prompt_cache_params(service: ServiceProvider, messages: list) -> dict:
+    """openai按prompt_cache_key和前缀哈希路由到同一台机器，系统提示词相同的请求使用相同的key可以提高缓存命中率。
+    deepseek、豆包的前缀缓存是自动的，只需保持系统提示词在消息开头不变"""
+    if service != "openai":
+        return {}
+    system = [m["content"] for m in messages if m["role"] == "system"]
+    text = json.dumps(system, ensure_ascii=False)
+    if not system or len(text) < PROMPT_CACHE_MIN_CHARS:
+        return {}
+    return {"prompt_cache_key": hashlib.sha256(text.encode()).hexdigest()[:32]}
+
+
+async def complete(
+    service: ServiceProvider,
+    model: str,
+    messages: list[ChatCompletionMessageParam],
+    hedge: bool = False,
+    **params,
+) -> ChatCompletion:
+    """调用指定服务商，包含图片预处理、额度调度、并发限制与重试"""
+    messages = await image_pipeline.preprocess(messages, model)  # type: ignore
+    params = prompt_cache_params(service, messages) | params
+
+    async def create():
+        async with limiter.slot(service, model):
+            with track_upstream(service, model):
+                return await CLIENTS[service].chat.completions.create(
+                    model=model, messages=messages, **params
+                )
+
+    max_tokens = params.get("max_tokens")
+    # 先按调用方的配额排队，再占用服务商的额度
+    async with accountant.charge(service, model, messages, max_tokens) as charge:
+        async with scheduler.reserve(service, model, messages, max_tokens) as reservation:
+            response = await with_retry(service, model, create, hedge=hedge)
+            usage = normalize_usage(response.usage)
+            reservation.record(usage)
+            charge.record(usage)
+    record_usage(service, model, response.usage)
+    return response
+
+
+def backend_response_format(service: ServiceProvider, response_format: ResponseFormat):
+    # json模式仅支持openai
+    return response_format if service == "openai" else NOT_GIVEN
+
+
 @log_completion_info("messages", "model", "service", "info")
 async def chatbot_openai(
     messages: list[ChatCompletionMessageParam],
     model: str,
-    service: ServiceProvider,
+    service: RoutedServiceProvider,
     temperature: Optional[float] = None,
     seed: Optional[int] = None,
     response_format: ResponseFormat = NOT_GIVEN,
     **extra_params,
 ):
-    extra_params.pop("info", None)  # 'info'不需要传递给create函数，仅用作日志记录
-    response = await CLIENTS[service].chat.completions.create(
-        model=model,
-        messages=messages,
-        temperature=temperature,
-        seed=seed,
-        response_format=response_format,
-        **extra_params,
-    )
-    contents = response.choices[0].message.content
-    assert contents, response
-    return contents, response.usage
+    # 'info'不需要传递给create函数，仅用作日志记录与确定调用方
+    set_caller(extra_params.pop("info", None))
+    hedge = extra_params.pop("hedge", False)
+    use_cache = extra_params.pop("cache", False) and response_cache.enabled
+    key = None
+    # 确定性请求：相同的请求使用缓存的结果，或合并到正在进行中的相同请求上
+    if use_cache or (SINGLE_FLIGHT and temperature == 0):
+        key = cache_key(service, model, messages, response_format, temperature, seed, extra_params)
+    if use_cache:
+        cached = await response_cache.get(key)
+        if cached is not None:
+            return *cached, True
+    params = {"temperature": temperature, "seed": seed, "hedge": hedge, **extra_params}
+
+    async def call():
+        if service == "auto":
+            response = await model_router.call(
+                model,
+                lambda backend, backend_model: complete(
+                    backend,
+                    backend_model,
+                    messages,
+                    response_format=backend_response_format(backend, response_format),
+                    **params,
+                ),
+            )
+        else:
+            response = await complete(
+                service, model, messages, response_format=response_format, **params  # type: ignore
+            )
+        contents = response.choices[0].message.content
+        assert contents, response
+        if use_cache:
+            await response_cache.set(key, contents, response.usage)  # type: ignore
+        return contents, response.usage
+
+    if key is None:
+        return *await call(), False
+    # 合并的调用方没有消耗额外的token，与命中缓存一样标记为cached
+    (contents, usage), shared = await single_flight.do(key, call)
+    return contents, usage, shared
+
+
+# 支持stream_options.include_usage的服务商, 其余服务商流式响应中不一定返回usage
+STREAM_USAGE_SERVICES = ("openai", "dpsk", "deepseek", "doubao")
+
+
+@log_completion_info("messages", "model", "service", "info")
+async def chatbot_openai_stream(
+    messages: list[ChatCompletionMessageParam],
+    model: str,
+    service: RoutedServiceProvider,
+    temperature: Optional[float] = None,
+    seed: Optional[int] = None,
+    response_format: ResponseFormat = NOT_GIVEN,
+    **extra_params,
+) -> AsyncIterator[ChatCompletionChunk]:
+    set_caller(extra_params.pop("info", None))
+    extra_params.pop("hedge", None)  # 流式响应不支持对冲
+    backend = None
+    if service == "auto":
+        # 开始输出后无法切换服务商，只选择一个可用的后端（半开状态时作为试探请求）
+        backend = next((b for b in model_router.candidates(model) if b.allow()), None)
+        if backend is None:
+            raise NoBackendAvailable(f"模型{model}没有可用的服务商")
+        service, model = backend.service, backend.model
+        response_format = backend_response_format(service, response_format)
+    if service in STREAM_USAGE_SERVICES:
+        extra_params.setdefault("stream_options", {"include_usage": True})
+    messages = await image_pipeline.preprocess(messages, model)  # type: ignore
+    extra_params = prompt_cache_params(service, messages) | extra_params
+    # 流式响应在整个输出期间占用并发名额
+    max_tokens = extra_params.get("max_tokens")
+    started = False
+    # 已输出的内容，服务商没有返回usage时用于估算用量
+    output: list[str] = []
+    try:
+        async with accountant.charge(service, model, messages, max_tokens) as charge:
+            try:
+                async with scheduler.reserve(service, model, messages, max_tokens) as reservation:
+                    async with limiter.slot(service, model):
+                        # 只重试建立连接，开始输出后出错不再重试
+                        start = time.perf_counter()
+                        stream = await with_retry(
+                            service,
+                            model,
+                            lambda: CLIENTS[service].chat.completions.create(
+                                model=model,
+                                messages=messages,
+                                temperature=temperature,
+                                seed=seed,
+                                response_format=response_format,
+                                stream=True,
+                                **extra_params,
+                            ),
+                        )
+                        with track_upstream(service, model):
+                            async for chunk in stream:
+                                content = chunk.choices[0].delta.content if chunk.choices else None
+                                if content:
+                                    if not output:
+                                        UPSTREAM_TTFT.observe(
+                                            time.perf_counter() - start, service, model
+                                        )
+                                    output.append(content)
+                                if chunk.usage:
+                                    reservation.record(normalize_usage(chunk.usage))
+                                    charge.record(reservation.usage)
+                                started = True
+                                yield chunk
+                    record_usage(service, model, reservation.usage)
+            finally:
+                # 不支持返回usage的服务商，或客户端在最后的usage之前断开，按已输出的内容估算
+                if started and not charge.usage:
+                    charge.record(approximate_usage(messages, "".join(output)))
+    except Exception as e:
+        # 开始输出前的连接失败、429、5xx计入熔断；开始输出后的错误不再归因于服务商
+        if backend is not None and not started and is_retryable(e):
+            backend.failure()
+        raise
+    finally:
+        # 非重试错误或客户端在开始输出前断开（GeneratorExit）时同样释放试探名额
+        if backend is not None:
+            backend.release()
+    if backend is not None:
+        backend.success(time.perf_counter() - start)
 
 
 async def chatbot_openai_hispreadnlp(text, model):
@@ -73,16 +247,11 @@ async def vec(
     if service not in ("openai", "azure"):
         raise Exception(f"服务{service}不可用")
     assert model != "text-embedding-ada-002" or dimensions is None, "ada不支持dimensions"
-    kwargs = {"model": model, "input": words_list}
-    if dimensions:
-        kwargs["dimensions"] = dimensions
-
-    client = CLIENTS[service]
-    res = await client.embeddings.create(**kwargs)
-    embeddings = [embedding.embedding for embedding in res.data]
+    texts = [words_list] if isinstance(words_list, str) else words_list
+    embeddings = await embedding_batcher.embed(service, model, dimensions, texts)
     if isinstance(words_list, str):
-        embeddings = embeddings[0]
-    return embeddings
+        return embeddings[0].tolist()
+    return [embedding.tolist() for embedding in embeddings]
 
 
 async def azure(text):
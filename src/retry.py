@@ -0,0 +1,143 @@
+"""
+上游调用的重试与对冲请求（hedged request）。
+
+- 重试：指数退避 + 完全随机抖动（full jitter），如果响应带有Retry-After则至少等待该时长
+- 对冲：请求超过该服务商/模型近期p95延迟仍未返回时，再发送一个相同的请求，先返回的结果生效，另一个被取消
+
+配置（环境变量CHATBOT_RETRY，JSON格式），键为服务商：
+    {"minimax": {"max_attempts": 5, "base_delay": 1, "max_delay": 30}}
+"""
+
+import asyncio
+import json
+import os
+import random
+import time
+from collections import deque
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from anthropic import APIConnectionError as AnthropicConnectionError
+from openai import APIConnectionError
+
+from src.clients import ServiceUnavailable
+from src.schema import ServiceProvider
+
+T = TypeVar("T")
+
+RETRY_CONFIG: dict[str, dict] = json.loads(os.getenv("CHATBOT_RETRY", "{}"))
+# 可重试的状态码
+RETRY_STATUS = (408, 409, 429, 500, 502, 503, 504, 529)
+CONNECTION_ERRORS = (APIConnectionError, AnthropicConnectionError, asyncio.TimeoutError)
+
+
+@dataclass
+class RetryPolicy:
+    max_attempts: int = 3
+    base_delay: float = 0.5
+    max_delay: float = 20.0
+    # 没有足够的延迟样本时使用的对冲等待时间（秒）
+    hedge_delay: float = 3.0
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+
+def get_policy(service: ServiceProvider) -> RetryPolicy:
+    return RetryPolicy(**RETRY_CONFIG.get(service, {}))
+
+
+def is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, ServiceUnavailable):  # 服务商未配置，重试与故障转移都无济于事
+        return False
+    return isinstance(exc, CONNECTION_ERRORS) or getattr(exc, "status_code", None) in RETRY_STATUS
+
+
+def retry_after(exc: BaseException) -> Optional[float]:
+    response = getattr(exc, "response", None)
+    if response is None:
+        return None
+    if value := response.headers.get("retry-after-ms"):
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    if value := response.headers.get("retry-after"):
+        try:
+            return float(value)
+        except ValueError:
+            try:
+                return parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                pass
+    return None
+
+
+class LatencyTracker:
+    """记录各服务商/模型近期成功请求的延迟，用于计算对冲等待时间"""
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.size = size
+        self.min_samples = min_samples
+        self.samples: dict[str, deque[float]] = {}
+
+    def record(self, key: str, latency: float):
+        self.samples.setdefault(key, deque(maxlen=self.size)).append(latency)
+
+    def p95(self, key: str) -> Optional[float]:
+        samples = self.samples.get(key)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        return sorted(samples)[int(len(samples) * 0.95) - 1]
+
+
+latency_tracker = LatencyTracker()
+
+
+async def hedged(call: Callable[[], Awaitable[T]], delay: float) -> T:
+    """先发送一个请求，delay秒后仍未返回则再发送一个，返回先成功的结果并取消另一个"""
+    tasks = {asyncio.ensure_future(call())}
+    error: Optional[BaseException] = None
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            tasks.add(asyncio.ensure_future(call()))
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error  # type: ignore
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def with_retry(
+    service: ServiceProvider,
+    model: str,
+    call: Callable[[], Awaitable[T]],
+    hedge: bool = False,
+) -> T:
+    policy = get_policy(service)
+    key = f"{service}/{model}"
+    for attempt in range(policy.max_attempts):
+        start = time.perf_counter()
+        try:
+            if hedge:
+                result = await hedged(call, latency_tracker.p95(key) or policy.hedge_delay)
+            else:
+                result = await call()
+        except Exception as e:
+            if attempt + 1 >= policy.max_attempts or not is_retryable(e):
+                raise
+            await asyncio.sleep(policy.backoff(attempt, retry_after(e)))
+            continue
+        latency_tracker.record(key, time.perf_counter() - start)
+        return result
+    raise AssertionError("unreachable")
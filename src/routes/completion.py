@@ -1,48 +1,42 @@
+import asyncio
+import json
 import logging
+import os
 import re
-from asyncio.locks import Semaphore
-from typing import Optional, Union
+from typing import AsyncIterator, Optional, Union
 
-import tiktoken
 from fastapi import APIRouter, Body
+from fastapi.responses import StreamingResponse
 from openai import NOT_GIVEN, APIError
 from openai.types.shared_params.response_format_json_schema import JSONSchema
 from pydantic import BaseModel, Field, field_validator, model_validator
 from tqdm.asyncio import tqdm
 
-from src.retrieve_text import chatbot_openai
-from src.schema import ResponseFormat, ServiceProvider
+from src.accounting import QuotaExceeded
+from src.clients import ServiceUnavailable
+from src.responses import FastJSONResponse, dumps
+from src.retrieve_text import chatbot_openai, chatbot_openai_stream
+from src.routing import model_router
+from src.schema import ResponseFormat, RoutedServiceProvider
+from src.tokenizer import count_tokens
 
 router = APIRouter(tags=["基础文本"])
 
 logger = logging.getLogger("chatbot")
 
 
-# lock作为全局变量，在python3.9中会导致Semaphore挂载到不同的loop中，使用延迟加载的方式解决
-class Lock:
-    def __init__(self, max_num: int):
-        self.max_num = max_num
-        self._lock = None
-
-    async def __aenter__(self):
-        if self._lock is None:
-            self._lock = Semaphore(self.max_num)
-        return await self._lock.__aenter__()
-
-    async def __aexit__(self, *args):
-        if self._lock is None:
-            return
-        return await self._lock.__aexit__(*args)
-
-
-lock = Lock(100)
+# 流式批量请求中同时创建的任务数，实际并发由src.limiter按服务商和模型控制
+BATCH_WINDOW = int(os.getenv("CHATBOT_BATCH_WINDOW", 500))
 
 
 class BaseCompletionReq(BaseModel):
     model_config = {"arbitrary_types_allowed": True, "extra": "allow"}
 
     model: str = Body(description="模型名称, 可用模型取决于选择的服务商")
-    service: ServiceProvider = Body(default="openai", description="LLM服务供应商")
+    service: RoutedServiceProvider = Body(
+        default="openai",
+        description="LLM服务供应商。auto表示model为逻辑模型名，按路由配置自动选择服务商并故障转移",
+    )
     api_key: str = Body(
         default="",
         alias="OPENAI_API_KEY",
@@ -50,7 +44,12 @@ class BaseCompletionReq(BaseModel):
         description="OpenAI API Key",
     )
     temperature: float = Body(0, description="温度参数，默认为0", ge=0, le=1)
-    info: dict = Body(default_factory=dict, description="需要记录到日志中的一些元数据")
+    info: dict = Body(
+        default_factory=dict,
+        description="需要记录到日志中的一些元数据。其中的caller为调用方（团队或服务名），"
+        "用于统计用量与执行配额，未指定时使用请求头X-Caller。"
+        "配置了CHATBOT_CALLER_KEYS时调用方由API key确定，caller与X-Caller不生效",
+    )
     seed: Optional[int] = Body(default=None, description="随机种子，仅支持openai")
     json_mode: Union[bool, JSONSchema] = Body(
         None,
@@ -58,9 +57,31 @@ class BaseCompletionReq(BaseModel):
         "文档：https://platform.openai.com/docs/api-reference/chat/create",
     )
 
+    cache: bool = Body(
+        default=False,
+        description="是否使用响应缓存, 仅在temperature为0时生效。"
+        "服务商、模型、消息及其他参数完全相同的请求会直接返回缓存的结果",
+    )
+
+    hedge: bool = Body(
+        default=False,
+        description="是否启用对冲请求：超过近期p95延迟仍未返回时再发送一个相同的请求，"
+        "先返回的结果生效。适用于对延迟敏感的调用，会增加token消耗",
+    )
+
+    compact: bool = Body(
+        default=False,
+        description="精简响应：只返回status, reply, usage, cached，不回显请求参数（如prompts、pic），"
+        "适用于大批量或带图片的请求",
+    )
+
+    @property
+    def use_cache(self) -> bool:
+        return self.cache and self.temperature == 0
+
     @property
     def response_format(self) -> ResponseFormat:
-        if self.service != "openai":
+        if self.service not in ("openai", "auto"):
             return NOT_GIVEN
         if not self.json_mode:
             return NOT_GIVEN
@@ -68,10 +89,28 @@ class BaseCompletionReq(BaseModel):
             return {"type": "json_object"}
         return {"type": "json_schema", "json_schema": self.json_mode}
 
+    def completion_params(self) -> dict:
+        """传给chatbot_openai的参数（不含messages）"""
+        return {
+            "model": self.model,
+            "service": self.service,
+            "temperature": self.temperature,
+            "seed": self.seed,
+            "response_format": self.response_format,
+            "info": self.info,
+            "cache": self.use_cache,
+            "hedge": self.hedge,
+            **(self.__pydantic_extra__ or {}),
+        }
+
     @model_validator(mode="after")
     def compatible_client(self):
         if self.api_key.startswith("sk-"):
             self.service = "openai"
+        if self.service == "auto" and self.model not in model_router:
+            raise ValueError(
+                f"模型{self.model}未配置路由, 可用的逻辑模型: {list(model_router.routes)}"
+            )
         if self.service == "minimax" and self.temperature == 0:
             self.temperature = 1e-5
         # o1-模型预览版本温度参数只能设置为1
@@ -99,6 +138,10 @@ class CompletionReq(BaseCompletionReq):
         description="复杂消息或多轮对话可以使用此参数。 如果为空，会自动将text, system, pic参数解析为message列表。"
         "如果不为空，会忽略text, system, pic参数。",
     )
+    stream: bool = Body(
+        default=False,
+        description="是否使用SSE流式返回, 每个事件为openai格式的ChatCompletionChunk, 以[DONE]结束",
+    )
 
     @field_validator("pic")
     @classmethod
@@ -130,6 +173,7 @@ class BatchCompletionReq(BaseCompletionReq):
     messages_list: list[list[dict]] = Body(
         default_factory=list, description="复杂消息或多轮对话可以使用此参数。"
     )
+    stream: bool = Body(default=False, description="是否以NDJSON格式逐条返回已完成的结果")
 
     @model_validator(mode="after")
     def compatible_message(self):
@@ -147,18 +191,39 @@ class BatchCompletionReq(BaseCompletionReq):
     description="基础问答功能，可以输入图片。除了scheme中的参数外，其他请求参数也会转发给对应的服务。",
 )
 async def gpt_openai(body: CompletionReq):
-    data = body.model_dump() | {"status": "ok"}
-    data["reply"], data["usage"] = await chatbot_openai(
-        body.messages,  # type: ignore
-        body.model,
-        body.service,
-        temperature=body.temperature,
-        seed=body.seed,
-        response_format=body.response_format,
-        info=body.info,
-        **body.__pydantic_extra__ or {},
+    if body.stream:
+        return StreamingResponse(
+            sse_stream(body),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+    data = {"status": "ok"} if body.compact else body.model_dump() | {"status": "ok"}
+    data["reply"], data["usage"], data["cached"] = await chatbot_openai(
+        body.messages, **body.completion_params()  # type: ignore
     )
-    return data
+    return FastJSONResponse(data)
+
+
+async def sse_stream(body: CompletionReq) -> AsyncIterator[str]:
+    try:
+        async for chunk in chatbot_openai_stream(
+            body.messages,  # type: ignore
+            body.model,
+            body.service,
+            temperature=body.temperature,
+            seed=body.seed,
+            response_format=body.response_format,
+            info=body.info,
+            **body.__pydantic_extra__ or {},
+        ):
+            yield f"data: {chunk.model_dump_json(exclude_unset=True)}\n\n"
+    except Exception as e:
+        # 响应头已发送，错误只能通过事件返回
+        logger.error(f"Stream completion error: {e}")
+        error = {"reply": "", "status": "error", "error": str(e)}
+        yield f"event: error\ndata: {json.dumps(error, ensure_ascii=False)}\n\n"
+        return
+    yield "data: [DONE]\n\n"
 
 
 @router.post("/gpt_openai_v2", deprecated=True, description="指向'/gpt_openai', 但服务商为azure")
@@ -167,44 +232,122 @@ async def gpt_openai_v2(body: CompletionReq):
     return await gpt_openai(body)
 
 
-@router.post("/gpt_openai_fast", description="批量调用文本补全")
+async def batch_result(body: BatchCompletionReq, messages: list[dict]):
+    try:
+        return "ok", *await chatbot_openai(messages, **body.completion_params())  # type: ignore
+    except APIError as e:
+        logger.error(f"Batch completion error: {e}")
+        return "error", e.message, None, False
+    except (QuotaExceeded, ServiceUnavailable) as e:
+        return "error", str(e), None, False
+    except Exception as e:
+        # 其他错误（如空回复）也只标记该条，不能中断整个批次
+        logger.exception(f"Batch completion error: {e}")
+        return "error", str(e), None, False
+
+
+def dedupe(body: BatchCompletionReq) -> list[tuple[list[dict], list[int]]]:
+    """temperature为0时合并批次中相同的消息，返回[(消息, 使用该消息的index列表)]"""
+    if body.temperature != 0:
+        return [(messages, [index]) for index, messages in enumerate(body.messages_list)]
+    groups: dict[str, tuple[list[dict], list[int]]] = {}
+    for index, messages in enumerate(body.messages_list):
+        key = json.dumps(messages, sort_keys=True, ensure_ascii=False)
+        groups.setdefault(key, (messages, []))[1].append(index)
+    return list(groups.values())
+
+
+def fan_out(indices: list[int], result: tuple):
+    """重复的条目与第一条共用结果，没有消耗额外的token，标记为cached"""
+    status, reply, usage, cached = result
+    for i, index in enumerate(indices):
+        yield index, (status, reply, usage, cached or i > 0)
+
+
+async def ndjson_stream(body: BatchCompletionReq) -> AsyncIterator[bytes]:
+    """按完成顺序逐行输出结果，同时在途的任务数不超过BATCH_WINDOW，避免一次性创建上万个任务"""
+
+    async def grouped_result(indices: list[int], messages: list[dict]):
+        return indices, await batch_result(body, messages)
+
+    groups_iter = iter(dedupe(body))
+    pending: set[asyncio.Task] = set()
+    try:
+        while True:
+            for messages, indices in groups_iter:
+                pending.add(asyncio.create_task(grouped_result(indices, messages)))
+                if len(pending) >= BATCH_WINDOW:
+                    break
+            if not pending:
+                break
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                for index, (status, reply, usage, cached) in fan_out(*task.result()):
+                    line = {
+                        "index": index,
+                        "status": status,
+                        "reply": reply,
+                        "usage": usage,
+                        "cached": cached,
+                    }
+                    yield dumps(line) + b"\n"
+    finally:
+        # 客户端断开时取消剩余任务
+        for task in pending:
+            task.cancel()
+
+
+@router.post(
+    "/gpt_openai_fast",
+    description="批量调用文本补全。stream为true时以NDJSON格式逐行返回，"
+    "每行包含index, status, reply, usage，按完成顺序输出。",
+)
 async def gpt_openai_fast(body: BatchCompletionReq):
-    data = body.model_dump()
-
-    async def get_result(messages: list[dict]):
-        try:
-            async with lock:
-                return "ok", await chatbot_openai(
-                    messages,  # type: ignore
-                    model=body.model,
-                    service=body.service,
-                    temperature=body.temperature,
-                    seed=body.seed,
-                    response_format=body.response_format,
-                    info=body.info,
-                    **body.__pydantic_extra__ or {},
-                )
-        except APIError as e:
-            logger.error(f"Batch completion error: {e}")
-            return "error", e.message
-
-    results = await tqdm.gather(*[get_result(messages) for messages in body.messages_list])
+    if body.stream:
+        return StreamingResponse(
+            ndjson_stream(body),
+            media_type="application/x-ndjson",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+    data = {} if body.compact else body.model_dump()
+    groups = dedupe(body)
+    grouped = await tqdm.gather(*[batch_result(body, messages) for messages, _ in groups])
+    results: list = [None] * len(body.messages_list)
+    for (_, indices), result in zip(groups, grouped):
+        for index, item in fan_out(indices, result):
+            results[index] = item
     data["status"] = [result[0] for result in results]
-    data["reply"] = [result[1][0] for result in results]
-    data["usage"] = [result[1][1] for result in results]
-    return data
+    data["reply"] = [result[1] for result in results]
+    data["usage"] = [result[2] for result in results]
+    data["cached"] = [result[3] for result in results]
+    return FastJSONResponse(data)
 
 
-@router.post("/get_token_num", description="获取文本token数量")
-def bot_token_num(
+@router.post(
+    "/get_token_num",
+    description="获取文本token数量。tiktoken不支持的模型使用cl100k_base近似计数，"
+    "此时approximate为true。",
+)
+async def bot_token_num(
     text: Union[str, list[str]] = Body(description="输入文本或文本列表"),
     model: str = Body(default="gpt-3.5-turbo", description="模型名称"),
+    count_only: bool = Body(
+        default=False,
+        description="只返回总token数，不返回输入文本与每条文本的token数。只减小响应体积，计数的开销不变",
+    ),
 ):
-    result = {"text": text, "status": "ok", "reply": 0}
-    if not isinstance(text, list):
-        text = [text]
-    encoding = tiktoken.encoding_for_model(model)
-    result["reply"] = [len(token) for token in encoding.encode_batch(text)]
-    if len(text) == 1:
-        result["reply"] = result["reply"][0]
+    texts = text if isinstance(text, list) else [text]
+    counts, encoding, approximate = await count_tokens(texts, model)
+    result = {
+        "status": "ok",
+        # 与之前的版本一致：只有一条文本时（包括只有一个元素的列表）返回数字
+        "reply": counts[0] if len(texts) == 1 else counts,
+        "total": sum(counts),
+        "encoding": encoding.name,
+        "approximate": approximate,
+    }
+    if count_only:
+        del result["reply"]
+    else:
+        result["text"] = text
     return result
@@ -0,0 +1,92 @@
+import os
+import secrets
+from typing import Literal, Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+from src.limiter import limiter
+from src.log_handler import BackgroundHandler
+from src.loop_monitor import loop_monitor
+from src.profiler import SamplingProfiler
+from src.routing import model_router
+from src.scheduler import scheduler
+from src.transport import transports
+
+# 所有调试接口都需要在X-Admin-Token中提供该值，未设置时接口不可用
+ADMIN_TOKEN = os.getenv("CHATBOT_ADMIN_TOKEN")
+MAX_PROFILE_SECONDS = 60
+# 同一worker同时只运行一个性能分析，避免采样开销叠加
+profiling = False
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(404, "未配置CHATBOT_ADMIN_TOKEN，接口不可用")
+    if x_admin_token is None or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(403, "X-Admin-Token错误")
+
+
+# 以下接口读取的状态只在事件循环中修改，均为async接口，避免在线程池中遍历时被并发修改
+router = APIRouter(tags=["调试"], prefix="/debug", dependencies=[Depends(require_admin)])
+
+
+@router.get("/transport", summary="各服务商连接池的使用情况与连接复用率")
+async def transport_stats():
+    return transports.stats()
+
+
+@router.get("/limits", summary="各服务商/模型的并发上限、额度与路由状态")
+async def limit_stats():
+    return {
+        "concurrency": limiter.stats(),
+        "rate": scheduler.stats(),
+        "routes": model_router.stats(),
+    }
+
+
+@router.get("/logging", summary="后台日志队列的积压与丢弃数量")
+async def logging_stats():
+    return [handler.stats() for handler in BackgroundHandler.instances]
+
+
+@router.get(
+    "/loop",
+    summary="事件循环延迟、最近阻塞事件循环的调用栈与线程池排队情况",
+)
+async def loop_stats():
+    return loop_monitor.stats()
+
+
+@router.get(
+    "/profile",
+    summary="对处理该请求的worker采样分析若干秒，返回火焰图所需的调用栈",
+    description=(
+        "collapsed格式可直接用于flamegraph.pl或导入speedscope，speedscope格式为speedscope的JSON文件。"
+        "tasks为true时同时采样asyncio任务正在等待的位置。"
+        "多worker部署时只分析处理该请求的worker，响应头X-Worker-Pid为其进程号"
+    ),
+)
+async def profile(
+    seconds: float = Query(10, gt=0, le=MAX_PROFILE_SECONDS, description="采样时长，秒"),
+    hz: int = Query(100, ge=1, le=1000, description="采样频率"),
+    format: Literal["collapsed", "speedscope"] = Query("collapsed"),
+    tasks: bool = Query(False, description="是否同时采样asyncio任务"),
+    all_threads: bool = Query(True, description="为false时只采样事件循环线程"),
+):
+    global profiling
+    if profiling:
+        raise HTTPException(409, "该worker正在进行性能分析")
+    profiling = True
+    try:
+        profiler = SamplingProfiler(hz, all_threads)
+        await profiler.run(seconds, tasks)
+    finally:
+        profiling = False
+    pid = os.getpid()
+    headers = {"X-Worker-Pid": str(pid)}
+    if format == "speedscope":
+        filename = f"profile-{pid}.speedscope.json"
+        headers["Content-Disposition"] = f"attachment; filename={filename}"
+        return JSONResponse(profiler.speedscope(f"chatbot worker {pid}"), headers=headers)
+    return PlainTextResponse(profiler.collapsed(), headers=headers)
@@ -0,0 +1,134 @@
+import asyncio
+
+from fastapi import APIRouter, Body, HTTPException, Query, Request
+from pydantic import ValidationError, model_validator
+
+from src.accounting import CALLER_KEYS, current_caller
+from src.batch_api import BATCH_BACKENDS
+from src.jobs import JobStore, job_store
+from src.responses import FastJSONResponse
+from src.routes.completion import BaseCompletionReq, BatchCompletionReq, CompletionReq
+
+router = APIRouter(tags=["批量任务"], prefix="/jobs")
+
+
+def get_store() -> JobStore:
+    if job_store is None:
+        raise HTTPException(503, "未配置CHATBOT_JOB_DB，批量任务不可用")
+    return job_store
+
+
+def check_native(service: str):
+    if service not in BATCH_BACKENDS:
+        raise ValueError(f"服务商{service}不支持Batch API, 可用: {list(BATCH_BACKENDS)}")
+
+
+class JobReq(BatchCompletionReq):
+    native_batch: bool = Body(
+        default=False,
+        description="是否通过服务商的Batch API执行，价格更低但通常在24小时内完成，"
+        "仅支持openai, azure, claude",
+    )
+
+    @model_validator(mode="after")
+    def native_service(self):
+        if self.native_batch:
+            check_native(self.service)
+        return self
+
+
+def job_params(body: BaseCompletionReq) -> dict:
+    params = body.completion_params()
+    params["response_format"] = params["response_format"] or None
+    # 任务在后台执行，提交时记录调用方；调用方由API key确定时不允许被info覆盖
+    caller = {"caller": current_caller.get()}
+    params["info"] = params["info"] | caller if CALLER_KEYS else caller | params["info"]
+    return params
+
+
+def parse_jsonl(content: bytes, native_batch: bool) -> list[dict]:
+    requests = []
+    for lineno, line in enumerate(content.decode().splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            body = CompletionReq.model_validate_json(line)
+            if native_batch:
+                check_native(body.service)
+        except (ValidationError, ValueError) as e:
+            raise HTTPException(422, f"第{lineno}行格式错误: {e}")
+        requests.append(job_params(body) | {"messages": body.messages})
+    return requests
+
+
+@router.post(
+    "",
+    description="提交批量任务，参数与/gpt_openai_fast相同，立即返回job_id。"
+    "native_batch为true时通过服务商的Batch API执行。"
+    "任务在后台执行，通过/jobs/{job_id}查询进度，/jobs/{job_id}/results分页获取结果",
+)
+async def create_job(body: JobReq):
+    store = get_store()
+    params = job_params(body)
+    if body.native_batch:
+        params["native_batch"] = True
+    requests = [{"messages": messages} for messages in body.messages_list]
+    job_id = await asyncio.to_thread(store.create, params, requests)
+    return {"status": "ok", "job_id": job_id, "total": len(requests)}
+
+
+@router.post(
+    "/jsonl",
+    description="以JSONL格式提交批量任务，每行为一个/gpt_openai的请求体，可以使用不同的模型和参数。"
+    "结果中的index为行号（忽略空行，从0开始）",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {"application/x-ndjson": {"schema": {"type": "string"}}},
+        }
+    },
+)
+async def create_jsonl_job(
+    request: Request,
+    native_batch: bool = Query(False, description="是否通过服务商的Batch API执行"),
+):
+    store = get_store()
+    requests = await asyncio.to_thread(parse_jsonl, await request.body(), native_batch)
+    params = {"native_batch": True} if native_batch else {}
+    job_id = await asyncio.to_thread(store.create, params, requests)
+    return {"status": "ok", "job_id": job_id, "total": len(requests)}
+
+
+@router.get("/{job_id}", description="查询任务状态与进度")
+async def get_job(job_id: str):
+    job = await asyncio.to_thread(get_store().get, job_id)
+    if job is None:
+        raise HTTPException(404, f"任务{job_id}不存在")
+    return {"status": "ok"} | job
+
+
+@router.get(
+    "/{job_id}/results",
+    description="按index顺序分页获取结果，未完成的条目status为pending。"
+    "next_offset为null表示已到末尾",
+)
+async def get_job_results(
+    job_id: str,
+    offset: int = Query(0, ge=0, description="起始index"),
+    limit: int = Query(1000, ge=1, le=10000, description="每页条数"),
+):
+    store = get_store()
+    results = await asyncio.to_thread(store.results, job_id, offset, limit)
+    if not results and await asyncio.to_thread(store.get, job_id) is None:
+        raise HTTPException(404, f"任务{job_id}不存在")
+    next_offset = results[-1]["index"] + 1 if len(results) == limit else None
+    return FastJSONResponse(
+        {"status": "ok", "job_id": job_id, "results": results, "next_offset": next_offset}
+    )
+
+
+@router.delete("/{job_id}", description="取消未完成的任务，已完成的结果仍可获取")
+async def cancel_job(job_id: str):
+    if not await asyncio.to_thread(get_store().cancel, job_id):
+        raise HTTPException(404, f"任务{job_id}不存在或已结束")
+    return {"status": "ok", "job_id": job_id}
@@ -0,0 +1,47 @@
+import asyncio
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from src.limiter import limiter
+from src.loop_monitor import loop_monitor
+from src.metrics import METRICS_DIR, registry
+from src.transport import transports
+
+router = APIRouter(tags=["监控"])
+
+registry.gauge(
+    "chatbot_limiter_in_flight",
+    "各服务商/模型正在进行的上游调用数",
+    ("key",),
+    lambda: {(key,): stats["in_flight"] for key, stats in limiter.stats().items()},
+)
+registry.gauge(
+    "chatbot_limiter_limit",
+    "各服务商/模型当前的自适应并发上限",
+    ("key",),
+    lambda: {(key,): stats["limit"] for key, stats in limiter.stats().items()},
+)
+registry.gauge(
+    "chatbot_threadpool_queued",
+    "各线程池排队等待的任务数",
+    ("pool",),
+    lambda: {(name,): stats["queued"] for name, stats in loop_monitor.threadpools().items()},
+)
+registry.gauge(
+    "chatbot_pool_saturation",
+    "各连接池在途请求数与最大连接数之比",
+    ("pool",),
+    lambda: {(name,): stats["saturation"] for name, stats in transports.stats().items()},
+)
+
+
+@router.get(
+    "/metrics",
+    response_class=PlainTextResponse,
+    description="Prometheus格式的监控指标，合并所有gunicorn worker的数据",
+)
+async def metrics():
+    # 指标与回调读取的状态只在事件循环中修改，在线程中遍历会与请求处理冲突
+    text = await asyncio.to_thread(registry.render, registry.snapshot(), METRICS_DIR)
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -1,9 +1,13 @@
+import os
+
 from fastapi import APIRouter, Body
 from pydantic import BaseModel, Field
 
 from src.ark_sign import ark_model_list
+from src.cache import RefreshingCache
 from src.clients import CLIENTS
-from src.schema import ServiceProvider
+from src.routing import model_router
+from src.schema import RoutedServiceProvider, ServiceProvider
 
 router = APIRouter(tags=["模型列表"], prefix="/models")
 
@@ -42,18 +46,35 @@ ModelList: dict[ServiceProvider, list[ModelInfo]] = {
 }
 
 
-@router.post("/list", summary="获取各服务商可用的模型列表", response_model=list[ModelInfo])
-async def model_list(service: ServiceProvider = Body(embed=True)):
+# 远程模型列表的缓存时间（秒），过期后先返回旧数据并在后台刷新
+MODEL_LIST_TTL = float(os.getenv("CHATBOT_MODEL_LIST_TTL", 600))
+MODEL_LIST_MAX_STALE = float(os.getenv("CHATBOT_MODEL_LIST_MAX_STALE", 24 * 3600))
+model_catalog: RefreshingCache[list[ModelInfo]] = RefreshingCache(
+    MODEL_LIST_TTL, MODEL_LIST_MAX_STALE
+)
+
+
+async def fetch_model_list(service: ServiceProvider) -> list[ModelInfo]:
     if service in ("openai", "moonshot"):
-        return (await CLIENTS[service].models.list()).data
-    elif service == "doubao":
-        models = await ark_model_list()
+        return [ModelInfo(id=model.id) for model in (await CLIENTS[service].models.list()).data]
+    models = await ark_model_list()
+    return [
+        ModelInfo(
+            id=model["Id"],
+            model=f"{model['ModelReference']['FoundationModel']['Name']}/"
+            f"{model['ModelReference']['FoundationModel']['ModelVersion']}",
+        )
+        for model in models
+    ]
+
+
+@router.post("/list", summary="获取各服务商可用的模型列表", response_model=list[ModelInfo])
+async def model_list(service: RoutedServiceProvider = Body(embed=True)):
+    if service == "auto":
         return [
-            {
-                "id": model["Id"],
-                "model": f"{model['ModelReference']['FoundationModel']['Name']}/"
-                f"{model['ModelReference']['FoundationModel']['ModelVersion']}",
-            }
-            for model in models
+            ModelInfo(id=name, model=",".join(f"{b.service}/{b.model}" for b in backends))
+            for name, backends in model_router.routes.items()
         ]
+    if service in ("openai", "moonshot", "doubao"):
+        return await model_catalog.get(service, lambda: fetch_model_list(service))
     return ModelList[service]
@@ -0,0 +1,174 @@
+"""
+OpenAI兼容接口，可以直接使用OpenAI的SDK调用（base_url设置为本服务的/v1）。
+
+服务商通过请求头X-Service或模型名前缀指定，如"claude/claude-3-haiku-20240307"、"auto/gpt-4o"，
+都未指定时使用openai。请求体只解析一次JSON后原样转发，不经过CompletionReq的校验与转换，
+额度调度、并发限制、重试与监控与/gpt_openai相同。
+"""
+
+import asyncio
+import json
+import logging
+import time
+from typing import AsyncIterator, Optional, get_args
+
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from openai import NOT_GIVEN, APIStatusError
+
+from src.accounting import QuotaExceeded, accountant, current_caller
+from src.clients import CLIENTS, ServiceUnavailable
+from src.embedding import create_embeddings
+from src.retrieve_text import backend_response_format, chatbot_openai_stream, complete
+from src.routes.models import model_list
+from src.routing import model_router
+from src.schema import ServiceProvider
+
+router = APIRouter(tags=["OpenAI兼容"], prefix="/v1")
+
+logger = logging.getLogger("chatbot")
+
+SERVICES = get_args(ServiceProvider)
+
+
+def error_response(status_code: int, message: str, type: str = "invalid_request_error"):
+    return JSONResponse(
+        status_code=status_code, content={"error": {"message": message, "type": type}}
+    )
+
+
+def resolve(request: Request, model: str) -> tuple[str, str]:
+    """返回(服务商, 模型名)"""
+    service = request.headers.get("x-service")
+    prefix, _, name = model.partition("/")
+    if name and prefix in (*SERVICES, "auto"):
+        return service or prefix, name
+    return service or "openai", model
+
+
+async def read_body(request: Request) -> dict:
+    body = json.loads(await request.body())
+    if not isinstance(body, dict) or not isinstance(body.get("model"), str):
+        raise ValueError("请求体必须是包含model的JSON对象")
+    return body
+
+
+def upstream_error(e: Exception) -> JSONResponse:
+    if isinstance(e, QuotaExceeded):
+        return error_response(429, str(e), "rate_limit_error")
+    if isinstance(e, ServiceUnavailable):
+        return error_response(503, str(e), "service_unavailable")
+    if isinstance(e, APIStatusError):
+        # 保留上游的状态码与错误内容，便于SDK按原样处理
+        body = e.body if isinstance(e.body, dict) and "error" in e.body else {"error": e.body}
+        return JSONResponse(status_code=e.status_code, content=body)
+    return error_response(502, str(e), "upstream_error")
+
+
+@router.post("/chat/completions", description="与OpenAI的Chat Completions接口一致，支持stream")
+async def chat_completions(request: Request):
+    try:
+        body = await read_body(request)
+        messages = body.pop("messages")
+    except (ValueError, KeyError) as e:
+        return error_response(400, str(e))
+    service, model = resolve(request, body.pop("model"))
+    if service != "auto" and service not in CLIENTS:
+        return error_response(400, f"未知的服务商: {service}")
+    if service == "auto" and model not in model_router:
+        return error_response(404, f"模型{model}未配置路由", "not_found_error")
+    if body.pop("stream", False):
+        return StreamingResponse(
+            sse_stream(service, model, messages, body),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    start = time.perf_counter()
+    try:
+        if service == "auto":
+            response_format = body.pop("response_format", NOT_GIVEN)
+            response = await model_router.call(
+                model,
+                lambda backend, backend_model: complete(
+                    backend,
+                    backend_model,
+                    messages,
+                    response_format=backend_response_format(backend, response_format),
+                    **body,
+                ),
+            )
+        else:
+            response = await complete(service, model, messages, **body)  # type: ignore
+    except Exception as e:
+        logger.error(f"Passthrough completion error: {e}")
+        return upstream_error(e)
+    logger.info(
+        "Passthrough completion",
+        extra={
+            "duration": (time.perf_counter() - start) * 1000,
+            "service": service,
+            "model": model,
+            **dict(response.usage or {}),
+        },
+    )
+    return Response(response.model_dump_json(exclude_unset=True), media_type="application/json")
+
+
+async def sse_stream(service: str, model: str, messages: list, body: dict) -> AsyncIterator[str]:
+    try:
+        async for chunk in chatbot_openai_stream(
+            messages,
+            model,
+            service,  # type: ignore
+            temperature=body.pop("temperature", None),
+            seed=body.pop("seed", None),
+            response_format=body.pop("response_format", NOT_GIVEN),
+            **body,
+        ):
+            yield f"data: {chunk.model_dump_json(exclude_unset=True)}\n\n"
+    except Exception as e:
+        logger.error(f"Passthrough stream error: {e}")
+        error = {"error": {"message": str(e), "type": "upstream_error"}}
+        yield f"data: {json.dumps(error, ensure_ascii=False)}\n\n"
+        return
+    yield "data: [DONE]\n\n"
+
+
+@router.post("/embeddings", description="与OpenAI的Embeddings接口一致")
+async def embeddings(request: Request):
+    try:
+        body = await read_body(request)
+    except ValueError as e:
+        return error_response(400, str(e))
+    service, body["model"] = resolve(request, body["model"])
+    if service not in CLIENTS:
+        return error_response(400, f"服务商{service}不支持embeddings")
+    caller = current_caller.get()
+    try:
+        accountant.check(caller)
+        response = await create_embeddings(service, **body)  # type: ignore
+    except Exception as e:
+        logger.error(f"Passthrough embedding error: {e}")
+        return upstream_error(e)
+    accountant.record(caller, service, body["model"], response.usage)
+    return Response(response.model_dump_json(exclude_unset=True), media_type="application/json")
+
+
+@router.get("/models", description="所有服务商的模型列表，id带有服务商前缀，可直接用于model参数")
+async def models():
+    async def service_models(service: str) -> Optional[list]:
+        try:
+            return await model_list(service)  # type: ignore
+        except Exception as e:  # 单个服务商失败不影响其他服务商
+            logger.warning(f"List models of {service} failed: {e}")
+            return None
+
+    services = [service for service in SERVICES if service != "deepseek"] + ["auto"]
+    results = await asyncio.gather(*[service_models(service) for service in services])
+    data = [
+        {"id": f"{service}/{model.id}", "object": "model", "created": 0, "owned_by": service}
+        for service, models in zip(services, results)
+        for model in models or []
+    ]
+    return {"object": "list", "data": data}
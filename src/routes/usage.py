@@ -0,0 +1,57 @@
+from typing import Literal, Optional
+
+from fastapi import APIRouter, Query
+
+from src.accounting import FIELDS, accountant, current_caller, merge, today
+
+router = APIRouter(tags=["用量统计"], prefix="/usage")
+
+GroupField = Literal["day", "caller", "service", "model"]
+GROUP_FIELDS = ("day", "caller", "service", "model")
+
+
+@router.get("", description="按日期范围汇总用量与费用，日期格式为YYYY-MM-DD，默认为当天")
+async def usage_summary(
+    start: Optional[str] = Query(None, description="开始日期（包含）"),
+    end: Optional[str] = Query(None, description="结束日期（包含）"),
+    caller: Optional[str] = Query(None, description="只统计指定的调用方"),
+    group_by: list[GroupField] = Query(["caller", "service", "model"], description="分组字段"),
+):
+    start = start or today()
+    end = end or today()
+    rows = await accountant.summary(start, end)
+    grouped: dict = {}
+    total: dict = {}
+    for key, values in rows.items():
+        if caller is not None and key[1] != caller:
+            continue
+        fields = dict(zip(GROUP_FIELDS, key))
+        merge(grouped, tuple(fields[field] for field in group_by), values)
+        merge(total, (), values)
+    return {
+        "status": "ok",
+        "start": start,
+        "end": end,
+        "rows": [
+            dict(zip(group_by, key)) | dict(zip(FIELDS, values)) for key, values in grouped.items()
+        ],
+        "total": dict(zip(FIELDS, total.get((), [0] * len(FIELDS)))),
+    }
+
+
+@router.get("/quota", description="调用方的配额与当日已用量，未指定caller时为当前请求的调用方")
+async def usage_quota(caller: Optional[str] = Query(None, description="调用方")):
+    caller = caller or current_caller.get()
+    accountant.rollover()
+    quota = accountant.quota(caller)
+    tokens, cost = accountant.totals.get(caller, (0, 0.0))
+    used = {"daily_tokens": tokens, "daily_cost": cost}
+    return {
+        "status": "ok",
+        "caller": caller,
+        "quota": quota,
+        "used": used,
+        "remaining": {
+            name: max(quota[name] - value, 0) for name, value in used.items() if quota.get(name)
+        },
+    }
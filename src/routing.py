@@ -0,0 +1,138 @@
+"""
+逻辑模型到多个服务商的故障转移路由。
+
+请求的service为"auto"时，model为逻辑模型名，按CHATBOT_ROUTES中配置的后端列表依次尝试：
+    {"gpt-4o": [["openai", "gpt-4o"], ["azure", "gpt-4o-0806"]]}
+- 每个后端有独立的熔断器：连续失败FAILURE_THRESHOLD次后熔断OPEN_SECONDS秒，之后放行一个试探请求
+- 在未熔断的后端中按配置顺序和近期延迟加权随机选择，越靠前、越快的后端被选中的概率越大
+"""
+
+import json
+import os
+import random
+import time
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from src.clients import CLIENTS, ServiceUnavailable
+from src.retry import is_retryable
+from src.schema import ServiceProvider
+
+T = TypeVar("T")
+
+ROUTES: dict[str, list[tuple[ServiceProvider, str]]] = {
+    name: [tuple(backend) for backend in backends]  # type: ignore
+    for name, backends in json.loads(os.getenv("CHATBOT_ROUTES", "{}")).items()
+}
+FAILURE_THRESHOLD = 5
+OPEN_SECONDS = 30.0
+# 配置中每靠后一位，权重乘以该系数
+PRIORITY_DECAY = 0.5
+
+
+class NoBackendAvailable(ServiceUnavailable):
+    """逻辑模型的所有后端均已熔断或未配置"""
+
+
+class Backend:
+    def __init__(self, service: ServiceProvider, model: str):
+        self.service = service
+        self.model = model
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial = False
+        # 延迟的指数加权平均（秒）
+        self.latency = 1.0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < OPEN_SECONDS:
+            return "open"
+        return "half_open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "half_open" and not self.trial:
+            self.trial = True
+            return True
+        return state == "closed"
+
+    def success(self, latency: float):
+        self.latency = 0.8 * self.latency + 0.2 * latency
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def failure(self):
+        self.failures += 1
+        self.trial = False
+        if self.failures >= FAILURE_THRESHOLD or self.opened_at is not None:
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        """请求结束时调用：非重试错误或被取消时也释放试探名额，否则半开的后端不会再被选中"""
+        self.trial = False
+
+    def stats(self) -> dict:
+        return {"state": self.state, "failures": self.failures, "latency": self.latency}
+
+
+class ModelRouter:
+    def __init__(self, routes: dict[str, list[tuple[ServiceProvider, str]]]):
+        self.routes = {
+            name: [Backend(service, model) for service, model in backends]
+            for name, backends in routes.items()
+        }
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.routes
+
+    def candidates(self, name: str) -> list[Backend]:
+        """未熔断且已配置的后端，按权重随机排序"""
+        backends = [
+            backend
+            for backend in self.routes[name]
+            if backend.state != "open" and CLIENTS.configured(backend.service)
+        ]
+        weights = [
+            PRIORITY_DECAY ** self.routes[name].index(backend) / backend.latency
+            for backend in backends
+        ]
+        ordered = []
+        while backends:
+            (backend,) = random.choices(backends, weights)
+            index = backends.index(backend)
+            ordered.append(backends.pop(index))
+            weights.pop(index)
+        return ordered
+
+    async def call(self, name: str, call: Callable[[ServiceProvider, str], Awaitable[T]]) -> T:
+        error: Optional[Exception] = None
+        for backend in self.candidates(name):
+            if not backend.allow():
+                continue
+            start = time.perf_counter()
+            try:
+                result = await call(backend.service, backend.model)
+            except Exception as e:
+                # 请求本身有误时换服务商也无济于事
+                if not is_retryable(e):
+                    raise
+                backend.failure()
+                error = e
+                continue
+            finally:
+                backend.release()
+            backend.success(time.perf_counter() - start)
+            return result
+        raise error or NoBackendAvailable(f"模型{name}没有可用的服务商")
+
+    def stats(self) -> dict[str, dict]:
+        return {
+            name: {f"{b.service}/{b.model}": b.stats() for b in backends}
+            for name, backends in self.routes.items()
+        }
+
+
+model_router = ModelRouter(ROUTES)
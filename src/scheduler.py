@@ -0,0 +1,174 @@
+"""
+按服务商额度（每分钟token数TPM、每分钟请求数RPM）调度请求。
+
+请求发出前用tiktoken估算token消耗（在tokenizer的线程池中进行，不阻塞事件循环），
+在令牌桶中预留额度，额度不足时排队等待；
+返回usage后按实际消耗修正预留的数量。
+
+配置（环境变量CHATBOT_RATE_LIMITS，JSON格式），键为服务商或"服务商/模型"：
+    {"openai/gpt-4o": {"tpm": 800000, "rpm": 5000}, "minimax": {"rpm": 120}}
+未配置的服务商和模型不做调度，也不会估算token。
+"""
+
+import asyncio
+import json
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Optional
+
+from src import tokenizer
+from src.schema import ServiceProvider
+from src.tokenizer import get_encoding
+
+RATE_LIMITS: dict[str, dict] = json.loads(os.getenv("CHATBOT_RATE_LIMITS", "{}"))
+# 未指定max_tokens时预估的输出token数
+DEFAULT_COMPLETION_TOKENS = int(os.getenv("CHATBOT_DEFAULT_COMPLETION_TOKENS", 512))
+# 每条消息的格式开销以及每张图片的预估token数
+MESSAGE_OVERHEAD_TOKENS = 4
+IMAGE_TOKENS = 765
+
+
+def estimate_tokens(messages: list[dict], model: str, max_tokens: Optional[int] = None) -> int:
+    encoding = get_encoding(model)
+    tokens = 0
+    for message in messages:
+        tokens += MESSAGE_OVERHEAD_TOKENS
+        content = message.get("content") or ""
+        if isinstance(content, str):
+            tokens += len(encoding.encode(content, disallowed_special=()))
+            continue
+        for part in content:
+            if part.get("type") == "text":
+                tokens += len(encoding.encode(part["text"], disallowed_special=()))
+            else:
+                tokens += IMAGE_TOKENS
+    return tokens + (max_tokens or DEFAULT_COMPLETION_TOKENS)
+
+
+class TokenBucket:
+    """每分钟补充capacity个令牌的令牌桶，余额可以为负（实际消耗超过预估时）"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        self.refill()
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount: float):
+        self.refill()
+        self.level -= amount
+
+
+class Reservation:
+    def __init__(self, estimated: int):
+        self.estimated = estimated
+        self.usage: Any = None
+
+    def record(self, usage: Any):
+        self.usage = usage
+
+    @property
+    def actual(self) -> Optional[int]:
+        if not self.usage:
+            return None
+        if isinstance(self.usage, dict):
+            return self.usage.get("total_tokens")
+        return getattr(self.usage, "total_tokens", None)
+
+
+class RateScheduler:
+    def __init__(self, limits: dict[str, dict]):
+        self.limits = limits
+        self.buckets: dict[str, tuple[Optional[TokenBucket], Optional[TokenBucket]]] = {}
+        # 按key排队，保证先到的请求先获得额度；延迟创建以避免python3.9中挂载到错误的loop
+        self._locks: dict[str, asyncio.Lock] = {}
+
+    def _key(self, service: ServiceProvider, model: str) -> Optional[str]:
+        for key in (f"{service}/{model}", service):
+            if key in self.limits:
+                return key
+        return None
+
+    def _buckets(self, key: str):
+        if key not in self.buckets:
+            config = self.limits[key]
+            self.buckets[key] = (
+                TokenBucket(config["tpm"]) if config.get("tpm") else None,
+                TokenBucket(config["rpm"]) if config.get("rpm") else None,
+            )
+            self._locks[key] = asyncio.Lock()
+        return self.buckets[key]
+
+    async def acquire(self, key: str, tokens: int):
+        tpm, rpm = self._buckets(key)
+        async with self._locks[key]:
+            while True:
+                wait = max(
+                    tpm.wait_time(tokens) if tpm else 0.0,
+                    rpm.wait_time(1) if rpm else 0.0,
+                )
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            if tpm:
+                tpm.take(tokens)
+            if rpm:
+                rpm.take(1)
+
+    def correct(self, key: str, reservation: Reservation):
+        tpm, _ = self._buckets(key)
+        actual = reservation.actual
+        if tpm and actual is not None:
+            tpm.take(actual - reservation.estimated)
+
+    @asynccontextmanager
+    async def reserve(
+        self, service: ServiceProvider, model: str, messages: list, max_tokens: Optional[int]
+    ):
+        """预留额度，调用方通过reservation.record(usage)记录实际消耗，退出时修正"""
+        async with self.reserve_key(self._key(service, model), model, messages, max_tokens) as r:
+            yield r
+
+    @asynccontextmanager
+    async def reserve_key(
+        self, key: Optional[str], model: str, messages: list, max_tokens: Optional[int]
+    ):
+        """按limits中的key预留额度，key为None时不做调度"""
+        if key is None:
+            yield Reservation(0)
+            return
+        estimated = 0
+        if self.limits[key].get("tpm"):
+            # 长提示词分词耗时较长，首次使用编码器时还可能需要下载编码表
+            estimated = await asyncio.get_running_loop().run_in_executor(
+                tokenizer.executor, estimate_tokens, messages, model, max_tokens
+            )
+        reservation = Reservation(estimated)
+        await self.acquire(key, estimated)
+        try:
+            yield reservation
+        finally:
+            self.correct(key, reservation)
+
+    def stats(self) -> dict[str, dict]:
+        stats = {}
+        for key, (tpm, rpm) in self.buckets.items():
+            stats[key] = {}
+            for name, bucket in (("tpm", tpm), ("rpm", rpm)):
+                if bucket:
+                    bucket.refill()
+                    stats[key][f"{name}_available"] = int(bucket.level)
+        return stats
+
+
+scheduler = RateScheduler(RATE_LIMITS)
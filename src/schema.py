@@ -7,4 +7,6 @@ from openai.types.shared_params.response_format_json_schema import ResponseForma
 ServiceProvider = Literal[
     "openai", "azure", "dpsk", "deepseek", "doubao", "claude", "minimax", "moonshot"
 ]
+# auto表示model为逻辑模型名，由src.routing按配置选择服务商
+RoutedServiceProvider = Union[ServiceProvider, Literal["auto"]]
 ResponseFormat = Union[ResponseFormatJSONObject, ResponseFormatJSONSchema, NotGiven]
@@ -0,0 +1,64 @@
+"""
+token计数。
+
+- 编码器按模型缓存，CHATBOT_TOKENIZER_PRELOAD（逗号分隔的模型名，默认覆盖o200k_base与cl100k_base）
+  中的模型在启动时预先加载。gunicorn预加载应用时在master中加载一次，worker通过fork共享
+- 大批量文本按CHUNK_SIZE分块，在共享线程池中并行编码（tiktoken编码时会释放GIL），
+  每块只保留计数，不保留token数组
+- tiktoken不认识的模型（claude、minimax等）使用cl100k_base近似计数，返回结果中标注approximate
+"""
+
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+
+import tiktoken
+
+logger = logging.getLogger("chatbot")
+
+PRELOAD_MODELS = [m for m in os.getenv("CHATBOT_TOKENIZER_PRELOAD", "gpt-4o,gpt-4").split(",") if m]
+THREADS = int(os.getenv("CHATBOT_TOKENIZER_THREADS", min(8, os.cpu_count() or 1)))
+CHUNK_SIZE = int(os.getenv("CHATBOT_TOKENIZER_CHUNK_SIZE", 1000))
+FALLBACK_ENCODING = "cl100k_base"
+
+executor = ThreadPoolExecutor(THREADS, thread_name_prefix="tokenizer")
+
+
+@cache
+def get_tokenizer(model: str) -> tuple[tiktoken.Encoding, bool]:
+    """返回(编码器, 是否为近似计数)"""
+    try:
+        return tiktoken.encoding_for_model(model), False
+    except KeyError:
+        return tiktoken.get_encoding(FALLBACK_ENCODING), True
+
+
+def get_encoding(model: str) -> tiktoken.Encoding:
+    return get_tokenizer(model)[0]
+
+
+def count_chunk(encoding: tiktoken.Encoding, texts: list[str]) -> list[int]:
+    return [len(encoding.encode_ordinary(text)) for text in texts]
+
+
+async def count_tokens(texts: list[str], model: str) -> tuple[list[int], tiktoken.Encoding, bool]:
+    """并行计算每条文本的token数，返回(计数列表, 编码器, 是否为近似计数)"""
+    loop = asyncio.get_running_loop()
+    encoding, approximate = await loop.run_in_executor(executor, get_tokenizer, model)
+    chunks = await asyncio.gather(
+        *[
+            loop.run_in_executor(executor, count_chunk, encoding, texts[i : i + CHUNK_SIZE])
+            for i in range(0, len(texts), CHUNK_SIZE)
+        ]
+    )
+    return [count for chunk in chunks for count in chunk], encoding, approximate
+
+
+def preload(models: list[str] = PRELOAD_MODELS):
+    for model in models:
+        try:
+            get_tokenizer(model)
+        except Exception as e:  # 加载失败时在首次请求时再尝试
+            logger.warning(f"Preload tokenizer for {model} failed: {e}")
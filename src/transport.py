@@ -0,0 +1,154 @@
+"""
+各服务商独立的HTTP连接池。
+
+每个服务商使用单独的httpx.AsyncClient，避免openai与claude等共用一个代理连接池互相抢占。
+配置（环境变量CHATBOT_TRANSPORT，JSON格式），键为服务商：
+    {"openai": {"max_connections": 300, "max_keepalive": 100, "http2": true, "prewarm": 10}}
+- max_connections / max_keepalive / keepalive_expiry: 连接池大小与空闲连接保持时间
+- http2: 是否启用HTTP/2，需要安装h2（pip install httpx[http2]），未安装时自动降级为HTTP/1.1
+- prewarm: worker启动时预先建立的连接数
+"""
+
+import asyncio
+import importlib.util
+import json
+import logging
+import os
+from typing import AsyncIterator, Callable, Optional
+
+import httpx
+
+logger = logging.getLogger("chatbot")
+
+DEFAULT_TRANSPORT = {
+    "max_connections": 200,
+    "max_keepalive": 100,
+    "keepalive_expiry": 60,
+    "http2": False,
+    "prewarm": 0,
+}
+TRANSPORT_CONFIG: dict[str, dict] = json.loads(os.getenv("CHATBOT_TRANSPORT", "{}"))
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+class TrackedStream(httpx.AsyncByteStream):
+    """响应体关闭时调用on_close，只调用一次"""
+
+    def __init__(self, stream: httpx.AsyncByteStream, on_close: Callable[[], None]):
+        self.stream = stream
+        self.on_close: Optional[Callable[[], None]] = on_close
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            if self.on_close is not None:
+                self.on_close()
+                self.on_close = None
+
+
+class InstrumentedTransport(httpx.AsyncHTTPTransport):
+    """统计连接池的使用情况：在途请求数、新建连接数与连接复用率"""
+
+    def __init__(self, max_connections: int, **kwargs):
+        super().__init__(**kwargs)
+        self.max_connections = max_connections
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.new_connections = 0
+        self._seen: set[int] = set()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.in_flight += 1
+        self.requests += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            response = await super().handle_async_request(request)
+        except BaseException:
+            self._done()
+            raise
+        finally:
+            self._count_connections()
+        # 流式响应在读取完并关闭之前一直占用连接
+        response.stream = TrackedStream(response.stream, self._done)  # type: ignore
+        return response
+
+    def _done(self):
+        self.in_flight -= 1
+
+    def _count_connections(self):
+        connections = {id(connection) for connection in self._pool.connections}
+        self.new_connections += len(connections - self._seen)
+        self._seen = connections
+
+    def stats(self) -> dict:
+        connections = self._pool.connections
+        return {
+            "max_connections": self.max_connections,
+            "connections": len(connections),
+            "idle_connections": sum(connection.is_idle() for connection in connections),
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "saturation": self.in_flight / self.max_connections,
+            "requests": self.requests,
+            "new_connections": self.new_connections,
+            "reuse_ratio": 1 - self.new_connections / self.requests if self.requests else 0.0,
+        }
+
+
+class TransportRegistry:
+    def __init__(self, config: dict[str, dict]):
+        self.config = config
+        self.clients: dict[str, tuple[httpx.AsyncClient, InstrumentedTransport, str]] = {}
+
+    def build(self, name: str, base_url: str, proxy: Optional[str] = None) -> httpx.AsyncClient:
+        """创建名为name的连接池，base_url用于预热连接"""
+        config = DEFAULT_TRANSPORT | self.config.get(name, {})
+        http2 = config["http2"]
+        if http2 and not HTTP2_AVAILABLE:
+            logger.warning(f"h2 is not installed, {name} falls back to HTTP/1.1")
+            http2 = False
+        limits = httpx.Limits(
+            max_connections=config["max_connections"],
+            max_keepalive_connections=config["max_keepalive"],
+            keepalive_expiry=config["keepalive_expiry"],
+        )
+        transport = InstrumentedTransport(
+            config["max_connections"], limits=limits, http2=http2, proxy=proxy
+        )
+        client = httpx.AsyncClient(transport=transport)
+        self.clients[name] = (client, transport, base_url)
+        return client
+
+    def prewarm_count(self, name: str) -> int:
+        return (DEFAULT_TRANSPORT | self.config.get(name, {}))["prewarm"]
+
+    async def prewarm(self):
+        """并发发送HEAD请求提前建立TLS连接，失败不影响启动"""
+
+        async def _warm(client: httpx.AsyncClient, base_url: str):
+            try:
+                await client.head(base_url, timeout=10)
+            except httpx.HTTPError as e:
+                logger.warning(f"Prewarm {base_url} failed: {e}")
+
+        tasks = []
+        for name, (client, _, base_url) in self.clients.items():
+            if not base_url:
+                continue
+            tasks.extend(_warm(client, base_url) for _ in range(self.prewarm_count(name)))
+        await asyncio.gather(*tasks)
+
+    async def aclose(self):
+        await asyncio.gather(*[client.aclose() for client, _, _ in self.clients.values()])
+
+    def stats(self) -> dict[str, dict]:
+        return {name: transport.stats() for name, (_, transport, _) in self.clients.items()}
+
+
+transports = TransportRegistry(TRANSPORT_CONFIG)
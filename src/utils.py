@@ -4,6 +4,8 @@ import time
 from functools import cache, wraps
 from typing import Callable
 
+from src.client_wrapper import cached_tokens
+
 logger = logging.getLogger("chatbot")
 
 
@@ -27,48 +29,65 @@ def log_completion_info(*record_params):
     日志包括以下信息：
     - Duration：装饰函数完成所花费的时间，以毫秒为单位。
     - Reply：装饰函数返回的回复。
+    - Cached：回复是否来自缓存，命中缓存时日志以"Cached reply"开头。
+    - cached_tokens：输入中命中服务商前缀缓存的token数。
+    - TTFT：仅流式（异步生成器）函数记录，首个token返回所花费的时间，以毫秒为单位。
     - record_params：其他记录的值。
+    - Prompt：messages参数由日志格式化时（JsonFormatter）拼接为字符串。
     日志使用logger.info()方法写入。
     """
 
+    def _log(func, args, kwargs, reply, usage, extra):
+        extra["reply"] = reply
+        parameters = get_parameter(func)
+
+        def _filter(x):
+            return x[0] in record_params
+
+        # 更新位置参数
+        extra.update(dict(filter(_filter, zip(parameters, args))))
+        # 更新关键字参数
+        extra.update(dict(filter(_filter, kwargs.items())))
+        # 命中缓存的回复单独标记，usage即为节省的token
+        log_message = "Cached reply: {reply}" if extra.get("cached") else "Reply: {reply}"
+        if "messages" in extra:
+            # prompt由JsonFormatter拼接，避免在事件循环中处理大段文本
+            log_message = "Prompt: {prompt}\n" + log_message
+        if usage:
+            extra.update(dict(usage))
+            extra["cached_tokens"] = cached_tokens(usage)
+        logger.info(log_message, extra=extra)
+
     def _inner(func):
+        if inspect.isasyncgenfunction(func):
+            # 流式输出：逐个转发chunk，结束后汇总回复与usage再记录日志
+            @wraps(func)
+            async def stream_wrapper(*args, **kwargs):
+                start = time.time()
+                first_token = None
+                reply, usage = [], None
+                async for chunk in func(*args, **kwargs):
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if first_token is None:
+                            first_token = time.time()
+                        reply.append(chunk.choices[0].delta.content)
+                    if chunk.usage:
+                        usage = chunk.usage
+                    yield chunk
+                extra = {"duration": (time.time() - start) * 1000, "stream": True}
+                if first_token is not None:
+                    extra["ttft"] = (first_token - start) * 1000
+                _log(func, args, kwargs, "".join(reply), usage, extra)
+
+            return stream_wrapper
+
         @wraps(func)
         async def wrapper(*args, **kwargs):
             start = time.time()
             res = await func(*args, **kwargs)
-            reply, usage = res
-            extra = {"duration": (time.time() - start) * 1000, "reply": reply}
-            parameters = get_parameter(func)
-
-            def _filter(x):
-                return x[0] in record_params
-
-            # 更新位置参数
-            extra.update(dict(filter(_filter, zip(parameters, args))))
-            # 更新关键字参数
-            extra.update(dict(filter(_filter, kwargs.items())))
-            log_message = "Reply: {reply}"
-            if "messages" in extra:
-                messages = extra.pop("messages")
-                if len(messages) == 1:
-                    extra["prompt"] = messages[0]["content"]
-                else:
-                    messages_str = []
-                    for message in messages:
-                        content = message["content"]
-                        if isinstance(content, list):
-                            content = "\n".join(
-                                f"[({content['type']})]{content[content['type']]}"
-                                for content in content
-                            )
-                        elif not isinstance(content, str):
-                            content = str(content)
-
-                        messages_str.append(f"<{message['role']}>: {content}")
-                    extra["prompt"] = "\n".join(messages_str)
-                log_message = "Prompt: {prompt}\n" + log_message
-            extra.update(dict(usage))
-            logger.info(log_message, extra=extra)
+            reply, usage, cached = res
+            extra = {"duration": (time.time() - start) * 1000, "cached": cached}
+            _log(func, args, kwargs, reply, usage, extra)
             return res
 
         return wrapper
@@ -1,14 +1,54 @@
+import asyncio
+import json
+import logging.handlers
+import os
+import subprocess
+import tempfile
+import threading
+import time
 import unittest
-from unittest.mock import AsyncMock, patch
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, PropertyMock, patch
 
+import httpcore
+import httpx
+from anthropic import Anthropic, RateLimitError
+from anthropic.types import Message, TextBlock, Usage
 from fastapi.testclient import TestClient
-from openai import NOT_GIVEN
+from openai import NOT_GIVEN, APIStatusError, BadRequestError, OpenAI
 from openai.resources.chat import AsyncCompletions
 from openai.resources.embeddings import AsyncEmbeddings
+from openai.types import CreateEmbeddingResponse
+from openai.types.chat import ChatCompletion
+from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
+from openai.types.chat.chat_completion_chunk import Choice as ChunkChoice
+from openai.types.chat.chat_completion_chunk import ChoiceDelta
 from pydantic import BaseModel
 
-from src.client_wrapper import AsyncClaude
+from benchmarks.fake_upstream import FakeConfig, create_app
+from benchmarks.run import compare
+from src import metrics
+from src.accounting import Accountant, QuotaExceeded, UsageStore, accountant, current_caller
+from src.batch_api import BatchBackend, FakeBatchBackend, OpenAIBatchBackend
+from src.cache import RefreshingCache, SingleFlight
+from src.client_wrapper import AsyncClaude, cached_tokens, claude_messages
+from src.clients import ALIASES, CLIENTS, FACTORIES, ClientRegistry, ServiceUnavailable
+from src.embedding import EmbeddingBatcher
+from src.images import PILLOW_AVAILABLE, ImagePipeline
+from src.jobs import JobRunner, JobStore
+from src.limiter import AdaptiveLimiter, LimiterRegistry
+from src.log_handler import BackgroundHandler
+from src.loop_monitor import LoopMonitor
 from src.main import app
+from src.metrics import Registry
+from src.profiler import TASKS_ROOT, SamplingProfiler
+from src.retrieve_text import chatbot_openai_stream, prompt_cache_params
+from src.retry import hedged, with_retry
+from src.routing import FAILURE_THRESHOLD, OPEN_SECONDS, ModelRouter, NoBackendAvailable
+from src.scheduler import RateScheduler
+from src.tokenizer import count_tokens
+from src.transport import InstrumentedTransport
 
 client = TestClient(app)
 base_data = {"text": "How are you?"}
@@ -23,6 +63,20 @@ class FakeCompletion:
     usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
 
 
+def fake_chunks(*contents):
+    async def _stream():
+        for content in contents:
+            yield ChatCompletionChunk(
+                id="chunk",
+                choices=[ChunkChoice(index=0, delta=ChoiceDelta(content=content))],
+                created=0,
+                model="fake",
+                object="chat.completion.chunk",
+            )
+
+    return _stream()
+
+
 class FakeEmbedding:
     class embedding:
         embedding = [1] * 512
@@ -150,6 +204,335 @@ class TestChatBot(unittest.TestCase):
             response_format=NOT_GIVEN,
         )
 
+    def test_stream(self, mock_claude_create: AsyncMock, mock_openai_create: AsyncMock):
+        for service, mock_create in (
+            ("openai", mock_openai_create),
+            ("claude", mock_claude_create),
+        ):
+            with self.subTest(service=service):
+                mock_create.return_value = fake_chunks("Hello", ", ", "world")
+                response = client.post(
+                    "/gpt_openai",
+                    json=base_data | {"model": "gpt-4o", "service": service, "stream": True},
+                )
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(response.headers["content-type"].startswith("text/event-stream"))
+                events = [line[6:] for line in response.text.split("\n\n") if line]
+                self.assertEqual(events[-1], "[DONE]")
+                reply = "".join(
+                    ChatCompletionChunk.model_validate_json(event).choices[0].delta.content
+                    for event in events[:-1]
+                )
+                self.assertEqual(reply, "Hello, world")
+                self.assertTrue(mock_create.call_args.kwargs["stream"])
+                mock_create.return_value = FakeCompletion
+
+    def test_cache(self, _, mock_openai_create: AsyncMock):
+        data = base_data | {"model": "gpt-4o", "cache": True, "seed": 42}
+        mock_openai_create.reset_mock()
+        first = client.post("/gpt_openai", json=data).json()
+        second = client.post("/gpt_openai", json=data).json()
+        self.assertFalse(first["cached"])
+        self.assertTrue(second["cached"])
+        self.assertEqual(second["reply"], first["reply"])
+        self.assertEqual(mock_openai_create.call_count, 1)
+
+        # temperature不为0时不使用缓存
+        for _ in range(2):
+            response = client.post("/gpt_openai", json=data | {"temperature": 0.5})
+            self.assertFalse(response.json()["cached"])
+        self.assertEqual(mock_openai_create.call_count, 3)
+
+    def test_batch_stream(self, _, __):
+        prompts = [f"prompt {i}" for i in range(5)]
+        response = client.post(
+            "/gpt_openai_fast",
+            json={"prompts": prompts, "model": "gpt-4o", "stream": True},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("application/x-ndjson"))
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        self.assertEqual(sorted(line["index"] for line in lines), list(range(len(prompts))))
+        for line in lines:
+            self.assertEqual(line["status"], "ok")
+            self.assertEqual(line["reply"], FakeCompletion.Choice.message.content)
+
+    def test_batch_item_error(self, _, __):
+        async def fake_chatbot(messages, **kwargs):
+            if messages[-1]["content"] == "b":
+                raise AssertionError("empty reply")
+            return messages[-1]["content"], None, False
+
+        with patch("src.routes.completion.chatbot_openai", fake_chatbot):
+            response = client.post(
+                "/gpt_openai_fast",
+                json={"prompts": ["a", "b", "c"], "model": "gpt-4o", "stream": True},
+            )
+            lines = sorted(
+                (json.loads(line) for line in response.text.splitlines()),
+                key=lambda line: line["index"],
+            )
+            self.assertEqual([line["status"] for line in lines], ["ok", "error", "ok"])
+            self.assertEqual(lines[1]["reply"], "empty reply")
+            response = client.post(
+                "/gpt_openai_fast", json={"prompts": ["a", "b", "c"], "model": "gpt-4o"}
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()["status"], ["ok", "error", "ok"])
+
+    def test_compact(self, _, __):
+        response = client.post("/gpt_openai", json=base_data | {"model": "gpt-4o", "compact": True})
+        self.assertEqual(set(response.json()), {"status", "reply", "usage", "cached"})
+        response = client.post(
+            "/gpt_openai_fast", json={"prompts": ["a", "b"], "model": "gpt-4o", "compact": True}
+        )
+        data = response.json()
+        self.assertEqual(set(data), {"status", "reply", "usage", "cached"})
+        self.assertEqual(data["reply"], [FakeCompletion.Choice.message.content] * 2)
+
+    def test_batch_dedupe(self, _, mock_openai_create: AsyncMock):
+        mock_openai_create.reset_mock()
+        response = client.post(
+            "/gpt_openai_fast", json={"prompts": ["a", "b", "a", "a"], "model": "gpt-4o"}
+        )
+        data = response.json()
+        self.assertEqual(mock_openai_create.call_count, 2)
+        self.assertEqual(data["reply"], [FakeCompletion.Choice.message.content] * 4)
+        self.assertEqual(data["cached"], [False, False, True, True])
+
+    def test_job_resume(self, _, mock_openai_create: AsyncMock):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = JobStore(f"{tmp}/jobs.db")
+            with patch("src.routes.jobs.job_store", store):
+                response = client.post(
+                    "/jobs", json={"prompts": ["a", "b", "c"], "model": "gpt-4o"}
+                )
+                job_id = response.json()["job_id"]
+                # 模拟中断前已完成的条目
+                store.save(job_id, [(0, "ok", "done before restart", None, False)])
+                runner = JobRunner(store)
+                self.assertEqual(store.claim(runner.owner), job_id)
+                mock_openai_create.reset_mock()
+                asyncio.run(runner.process(job_id))
+                self.assertEqual(mock_openai_create.call_count, 2)
+
+                job = client.get(f"/jobs/{job_id}").json()
+                self.assertEqual(job["job_status"], "completed")
+                self.assertEqual(job["progress"], {"pending": 0, "ok": 3, "error": 0})
+                results = client.get(f"/jobs/{job_id}/results", params={"limit": 2}).json()
+                self.assertEqual(results["next_offset"], 2)
+                self.assertEqual(results["results"][0]["reply"], "done before restart")
+                self.assertEqual(
+                    results["results"][1]["reply"], FakeCompletion.Choice.message.content
+                )
+
+    def test_native_batch_job(self, _, mock_openai_create: AsyncMock):
+        response = client.post(
+            "/jobs",
+            json={
+                "prompts": ["a"],
+                "model": "deepseek-chat",
+                "service": "dpsk",
+                "native_batch": True,
+            },
+        )
+        self.assertEqual(response.status_code, 422)
+
+        backend = FakeBatchBackend()
+        with tempfile.TemporaryDirectory() as tmp:
+            store = JobStore(f"{tmp}/jobs.db")
+            with (
+                patch("src.routes.jobs.job_store", store),
+                patch.dict("src.jobs.BATCH_BACKENDS", {"openai": backend, "claude": backend}),
+            ):
+                prompts = ["a", "b", "c"]
+                response = client.post(
+                    "/jobs", json={"prompts": prompts, "model": "gpt-4o", "native_batch": True}
+                )
+                job_id = response.json()["job_id"]
+                runner = JobRunner(store)
+                store.claim(runner.owner)
+                mock_openai_create.reset_mock()
+                asyncio.run(runner.process(job_id))
+                mock_openai_create.assert_not_called()
+                results = client.get(f"/jobs/{job_id}/results").json()["results"]
+                self.assertEqual([r["index"] for r in results], [0, 1, 2])
+                self.assertTrue(all(r["reply"] == FakeBatchBackend.REPLY for r in results))
+                self.assertEqual(store.open_batches(job_id), [])
+
+        # openai批量输出文件中的成功与失败行
+        body = {
+            "choices": [{"message": {"content": "hi"}}],
+            "usage": {"prompt_tokens": 3, "completion_tokens": 1, "total_tokens": 4},
+        }
+        ok = {"custom_id": "7", "response": {"status_code": 200, "body": body}}
+        self.assertEqual(OpenAIBatchBackend.parse(ok), (7, "ok", "hi", body["usage"], False))
+        error = {"custom_id": "8", "response": None, "error": {"message": "invalid model"}}
+        self.assertEqual(OpenAIBatchBackend.parse(error)[:3], (8, "error", "invalid model"))
+
+    def test_batch_endpoint(self, _, __):
+        openai = AsyncMock()
+        openai.files.create.return_value = SimpleNamespace(id="file-1")
+        openai.batches.create.return_value = SimpleNamespace(id="batch-1")
+        backend = OpenAIBatchBackend("azure", "/chat/completions", {"api-version": "2024-10-21"})
+        with patch.object(OpenAIBatchBackend, "client", new_callable=PropertyMock) as prop:
+            prop.return_value = openai
+            self.assertEqual(asyncio.run(backend.submit([(0, {"model": "gpt-4o"})])), "batch-1")
+        self.assertEqual(openai.batches.create.call_args.kwargs["endpoint"], "/chat/completions")
+        with self.assertRaises(TypeError):
+            BatchBackend()  # type: ignore
+
+    def test_openai_compat(self, mock_claude_create: AsyncMock, mock_openai_create: AsyncMock):
+        sdk = OpenAI(api_key="sk-", base_url="http://testserver/v1", http_client=client)
+        completion = ChatCompletion(
+            id="chat",
+            choices=[
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": "Hello from claude"},
+                }
+            ],
+            created=0,
+            model="claude-3-haiku-20240307",
+            object="chat.completion",
+        )
+        mock_claude_create.return_value = completion
+        messages = [{"role": "user", "content": "hi"}]
+        response = sdk.chat.completions.create(
+            model="claude/claude-3-haiku-20240307", messages=messages, max_tokens=10
+        )
+        self.assertEqual(response.choices[0].message.content, "Hello from claude")
+        kwargs = mock_claude_create.call_args.kwargs
+        self.assertEqual(kwargs["model"], "claude-3-haiku-20240307")
+        self.assertEqual(kwargs["max_tokens"], 10)
+        mock_claude_create.return_value = FakeCompletion
+
+        mock_openai_create.return_value = fake_chunks("Hello", " world")
+        stream = sdk.chat.completions.create(model="gpt-4o", messages=messages, stream=True)
+        self.assertEqual("".join(chunk.choices[0].delta.content for chunk in stream), "Hello world")
+        mock_openai_create.return_value = FakeCompletion
+
+        embedding = CreateEmbeddingResponse(
+            data=[{"embedding": [0.5, 0.25], "index": 0, "object": "embedding"}],
+            model="text-embedding-3-small",
+            object="list",
+            usage={"prompt_tokens": 1, "total_tokens": 1},
+        )
+        unavailable = APIStatusError(
+            "unavailable",
+            response=httpx.Response(503, request=httpx.Request("POST", "/")),
+            body=None,
+        )
+        create = AsyncMock(side_effect=[unavailable, embedding])
+        with patch.object(AsyncEmbeddings, "create", create):
+            response = sdk.embeddings.create(
+                model="text-embedding-3-small", input="hi", encoding_format="float"
+            )
+        self.assertEqual(response.data[0].embedding, [0.5, 0.25])
+        # 与/vec_openai一样经过重试
+        self.assertEqual(create.call_count, 2)
+
+        with self.assertRaises(BadRequestError):
+            sdk.chat.completions.create(model="gpt-4o", messages=messages, extra_body={"model": 1})
+
+    def test_metrics(self, _, __):
+        client.post("/gpt_openai", json=base_data | {"model": "gpt-4o"})
+        response = client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            'chatbot_upstream_requests_total{service="openai",model="gpt-4o",status="ok"}',
+            response.text,
+        )
+        self.assertIn('chatbot_request_duration_seconds_count{route="/gpt_openai"', response.text)
+        # 在事件循环中采集，可以读取anyio线程池的状态
+        self.assertIn('chatbot_threadpool_queued{pool="anyio"', response.text)
+
+    def test_usage_quota(self, _, mock_openai_create: AsyncMock):
+        class Completion(FakeCompletion):
+            usage = {"prompt_tokens": 600, "completion_tokens": 400, "total_tokens": 1000}
+
+        mock_openai_create.return_value = Completion
+        quotas = {"team-a": {"daily_tokens": 1500}}
+        prices = {"gpt-4o": {"input": 2.5, "output": 10}}
+        with patch.multiple(accountant, quotas=quotas, prices=prices, pending={}, totals={}):
+            data = base_data | {"model": "gpt-4o", "info": {"caller": "team-a"}}
+            self.assertEqual(client.post("/gpt_openai", json=data).status_code, 200)
+            resp = client.post(
+                "/gpt_openai", json=base_data | {"model": "gpt-4o"}, headers={"X-Caller": "team-a"}
+            )
+            self.assertEqual(resp.status_code, 200)
+            resp = client.post("/gpt_openai", json=data)
+            self.assertEqual(resp.status_code, 429)
+            self.assertEqual(mock_openai_create.await_count, 2)
+
+            resp = client.get("/usage", params={"caller": "team-a"}).json()
+            self.assertEqual(
+                resp["rows"],
+                [
+                    {
+                        "caller": "team-a",
+                        "service": "openai",
+                        "model": "gpt-4o",
+                        "requests": 2,
+                        "prompt_tokens": 1200,
+                        "completion_tokens": 800,
+                        "cached_tokens": 0,
+                        "cost": 0.011,
+                    }
+                ],
+            )
+            resp = client.get("/usage/quota", headers={"X-Caller": "team-a"}).json()
+            self.assertEqual(resp["used"]["daily_tokens"], 2000)
+            self.assertEqual(resp["remaining"], {"daily_tokens": 0})
+
+    def test_token_num(self, _, __):
+        counts = AsyncMock(return_value=([3], SimpleNamespace(name="fake"), False))
+        with patch("src.routes.completion.count_tokens", counts):
+            for text in ("abc", ["abc"]):
+                response = client.post("/get_token_num", json={"text": text}).json()
+                self.assertEqual((response["reply"], response["text"]), (3, text))
+            counts.return_value = ([3, 5], SimpleNamespace(name="fake"), False)
+            response = client.post(
+                "/get_token_num", json={"text": ["abc", "defgh"], "count_only": True}
+            ).json()
+            self.assertEqual(response["total"], 8)
+            self.assertNotIn("reply", response)
+
+    def test_caller_keys(self, _, __):
+        with (
+            patch.dict("src.accounting.CALLER_KEYS", {"sk-a": "team-a"}),
+            patch.multiple(accountant, pending={}, totals={}),
+        ):
+            data = base_data | {"model": "gpt-4o", "info": {"caller": "team-b"}}
+            headers = {"Authorization": "Bearer sk-a", "X-Caller": "team-b"}
+            self.assertEqual(
+                client.post("/gpt_openai", json=data, headers=headers).status_code, 200
+            )
+            # 未知的key记为anonymous，自行声明的调用方不生效
+            client.post("/gpt_openai", json=data, headers={"X-Api-Key": "sk-b"})
+            self.assertEqual(
+                sorted(caller for _, caller, _, _ in accountant.pending), ["anonymous", "team-a"]
+            )
+
+    def test_stream_usage_on_disconnect(self, _, mock_openai_create: AsyncMock):
+        async def consume_first():
+            stream = chatbot_openai_stream(
+                [{"role": "user", "content": "hi"}], "gpt-4o", "openai", info={"caller": "team-a"}
+            )
+            await stream.__anext__()
+            await stream.aclose()
+
+        mock_openai_create.return_value = fake_chunks("Hello", " world")
+        with patch.multiple(accountant, pending={}, totals={}):
+            asyncio.run(consume_first())
+            ((key, values),) = accountant.pending.items()
+            self.assertEqual(key[1:], ("team-a", "openai", "gpt-4o"))
+            # 服务商返回usage之前断开，按已输出的内容估算
+            self.assertEqual(values[0], 1)
+            self.assertGreater(values[2], 0)
+        mock_openai_create.return_value = FakeCompletion
+
     @patch.object(AsyncEmbeddings, "create", new_callable=AsyncMock, return_value=FakeEmbedding)
     def test_api(self, mock_embedding_create, mock_claude_create, mock_openai_create):
 
@@ -192,5 +575,746 @@ class TestChatBot(unittest.TestCase):
                 self.assertEqual(response.json()["reply"], expected_resp)
 
 
+class TestEmbeddingBatcher(unittest.IsolatedAsyncioTestCase):
+    async def test_batch_and_cache(self):
+        async def fake_create(model, input, **kwargs):
+            return SimpleNamespace(
+                data=[SimpleNamespace(embedding=[len(t)] * 4) for t in input], usage=None
+            )
+
+        batcher = EmbeddingBatcher(cache_size=100, batch_size=10, max_wait=0.01)
+        with patch.object(AsyncEmbeddings, "create", side_effect=fake_create) as mock_create:
+            results = await asyncio.gather(
+                *[batcher.embed("openai", "m", None, [text]) for text in ("a", "bb", "a")]
+            )
+            self.assertEqual([r[0].tolist() for r in results], [[1] * 4, [2] * 4, [1] * 4])
+            self.assertEqual(mock_create.call_count, 1)
+            self.assertEqual(mock_create.call_args.kwargs["input"], ["a", "bb"])
+
+            # 命中缓存的文本不再请求上游
+            result = await batcher.embed("openai", "m", None, ["bb", "ccc"])
+            self.assertEqual([r.tolist() for r in result], [[2] * 4, [3] * 4])
+            self.assertEqual(mock_create.call_args.kwargs["input"], ["ccc"])
+
+    async def test_usage_by_caller(self):
+        async def fake_create(model, input, **kwargs):
+            return SimpleNamespace(
+                data=[SimpleNamespace(embedding=[1] * 4) for _ in input],
+                usage={"prompt_tokens": 10, "total_tokens": 10},
+            )
+
+        async def embed(caller: str, texts: list[str]):
+            current_caller.set(caller)
+            return await batcher.embed("openai", "m", None, texts)
+
+        batcher = EmbeddingBatcher(cache_size=0, batch_size=10, max_wait=0.01)
+        with (
+            patch.object(AsyncEmbeddings, "create", side_effect=fake_create) as mock_create,
+            patch.multiple(accountant, quotas={"team-c": {"daily_tokens": 1}}, pending={}),
+            patch.dict(accountant.totals, {"team-c": [1, 0.0]}),
+        ):
+            await asyncio.gather(embed("team-a", ["a" * 30]), embed("team-b", ["b" * 60]))
+            self.assertEqual(mock_create.call_count, 1)
+            usage = {key[1]: values[1] for key, values in accountant.pending.items()}
+            self.assertEqual(usage, {"team-a": 3, "team-b": 7})
+            with self.assertRaises(QuotaExceeded):
+                await embed("team-c", ["c"])
+
+    async def test_split_failed_batch(self):
+        async def fake_create(model, input, **kwargs):
+            if "bad" in input:
+                raise BadRequestError(
+                    "input too long",
+                    response=httpx.Response(400, request=httpx.Request("POST", "/")),
+                    body=None,
+                )
+            return SimpleNamespace(
+                data=[SimpleNamespace(embedding=[len(t)] * 4) for t in input], usage=None
+            )
+
+        batcher = EmbeddingBatcher(cache_size=0, batch_size=10, max_wait=0.01, max_tokens=4)
+        with patch.object(AsyncEmbeddings, "create", side_effect=fake_create) as mock_create:
+            bad, good = await asyncio.gather(
+                batcher.embed("openai", "m", None, ["a", "bad"]),
+                batcher.embed("openai", "m", None, ["cc"]),
+                return_exceptions=True,
+            )
+            self.assertIsInstance(bad, BadRequestError)
+            self.assertEqual(good[0].tolist(), [2] * 4)
+            inputs = [call.kwargs["input"] for call in mock_create.call_args_list]
+            self.assertEqual(inputs, [["a", "bad", "cc"], ["a", "bad"], ["cc"]])
+
+            # 超过估算token上限时分为多批
+            await batcher.embed("openai", "m", None, ["x" * 6, "y" * 6])
+            self.assertEqual(mock_create.call_count, 5)
+
+
+class TestJobRunner(unittest.IsolatedAsyncioTestCase):
+    async def test_failing_job(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = JobStore(f"{tmp}/jobs.db")
+            job_id = store.create({"model": "gpt-4o"}, [{"messages": []}])
+            runner = JobRunner(store)
+            process = AsyncMock(side_effect=RuntimeError("submit failed"))
+            with (
+                patch.object(runner, "process", process),
+                patch("src.jobs.POLL_INTERVAL", 0.05),
+                patch("src.jobs.JOB_MAX_ATTEMPTS", 3),
+            ):
+                # 依次在0、0.1、0.3秒左右执行
+                task = asyncio.create_task(runner.run())
+                await asyncio.sleep(0.05)
+                # 失败后租约延后，不会立即被重新认领
+                self.assertEqual(process.call_count, 1)
+                self.assertIsNone(store.claim("other"))
+                await asyncio.sleep(0.45)
+                task.cancel()
+            self.assertEqual(process.call_count, 3)
+            job = store.get(job_id)
+            self.assertEqual((job["job_status"], job["error"]), ("failed", "submit failed"))
+
+    async def test_lease_heartbeat(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = JobStore(f"{tmp}/jobs.db")
+            job_id = store.create({"model": "gpt-4o"}, [{"messages": []}])
+            runner = JobRunner(store)
+            cancelled = asyncio.Event()
+
+            async def slow(job_id):
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    cancelled.set()
+                    raise
+
+            with patch.object(runner, "process", slow), patch("src.jobs.LEASE_SECONDS", 0.3):
+                task = asyncio.create_task(runner.run())
+                # 没有条目完成，租约仍由心跳续期，不会被其他worker认领
+                await asyncio.sleep(0.6)
+                self.assertIsNone(store.claim("other"))
+                # 任务被取消后心跳续约失败，停止处理
+                store.cancel(job_id)
+                await asyncio.wait_for(cancelled.wait(), 1)
+                self.assertFalse(task.done())
+                task.cancel()
+
+            # 保存结果时失败次数清零
+            job_id = store.create({"model": "gpt-4o"}, [{"messages": []}])
+            self.assertEqual(store.claim(runner.owner), job_id)
+            attempts = "SELECT attempts FROM jobs WHERE id = ?"
+            store.fail(job_id, runner.owner, "x")
+            self.assertEqual(store._conn.execute(attempts, (job_id,)).fetchone()[0], 1)
+            store.save(job_id, [])
+            self.assertEqual(store._conn.execute(attempts, (job_id,)).fetchone()[0], 0)
+
+
+class TestRefreshingCache(unittest.IsolatedAsyncioTestCase):
+    async def test_coalesce_and_stale(self):
+        cache = RefreshingCache(ttl=0.05, max_stale=10)
+        calls = []
+
+        async def load():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return len(calls)
+
+        results = await asyncio.gather(*[cache.get("openai", load) for _ in range(10)])
+        self.assertEqual(results, [1] * 10)
+        self.assertEqual(len(calls), 1)
+
+        await asyncio.sleep(0.06)
+        # 过期后先返回旧值，后台刷新
+        self.assertEqual(await cache.get("openai", load), 1)
+        await asyncio.sleep(0.02)
+        self.assertEqual(await cache.get("openai", load), 2)
+
+
+class TestSingleFlight(unittest.IsolatedAsyncioTestCase):
+    async def test_share_and_cancel(self):
+        flight = SingleFlight()
+        calls = 0
+
+        async def call():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.05)
+            return "result"
+
+        results = await asyncio.gather(*[flight.do("key", call) for _ in range(3)])
+        self.assertEqual(calls, 1)
+        self.assertEqual([shared for _, shared in results], [False, True, True])
+        self.assertEqual(len(flight), 0)
+
+        # 一个调用方取消不影响其他调用方，全部取消时才取消底层任务
+        first = asyncio.ensure_future(flight.do("key", call))
+        second = asyncio.ensure_future(flight.do("key", call))
+        await asyncio.sleep(0)
+        first.cancel()
+        self.assertEqual(await second, ("result", True))
+        third = asyncio.ensure_future(flight.do("other", call))
+        await asyncio.sleep(0)
+        (task, _) = flight._calls["other"]
+        third.cancel()
+        await asyncio.sleep(0.01)
+        self.assertTrue(task.cancelled())
+
+
+class TestLimiter(unittest.IsolatedAsyncioTestCase):
+    async def test_aimd(self):
+        limiter = AdaptiveLimiter(initial=4, min=1, max=8, cooldown=0)
+        for _ in range(4):
+            await limiter.acquire()
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        self.assertFalse(waiter.done())
+
+        rate_limited = APIStatusError(
+            "rate limited",
+            response=httpx.Response(429, request=httpx.Request("POST", "/")),
+            body=None,
+        )
+        limiter.release(rate_limited)
+        self.assertEqual(limiter.stats(), {"limit": 2, "in_flight": 3})
+        await asyncio.sleep(0)
+        self.assertFalse(waiter.done())
+        limiter.release(ValueError())  # 非过载错误不调整上限
+        limiter.release()
+        await asyncio.wait_for(waiter, 1)
+        self.assertGreater(limiter.limit, 2)
+
+    async def test_global_budget(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            registry = LimiterRegistry({"openai": {"initial": 10, "global": 1}}, tmp)
+            async with registry.slot("openai", "gpt-4o"):
+                second = asyncio.create_task(registry.slot("openai", "gpt-4o").__aenter__())
+                await asyncio.sleep(0.1)
+                self.assertFalse(second.done())
+            await asyncio.wait_for(second, 1)
+
+    async def test_saturated_model(self):
+        registry = LimiterRegistry({"minimax": {"initial": 10}, "minimax/slow": {"initial": 2}}, "")
+        release = asyncio.Event()
+
+        async def call(model: str):
+            async with registry.slot("minimax", model):
+                await release.wait()
+
+        slow = [asyncio.create_task(call("slow")) for _ in range(20)]
+        await asyncio.sleep(0.01)
+        # 排队中的slow请求不占用服务商的名额
+        self.assertEqual(registry.limiters["minimax"].in_flight, 2)
+        fast = asyncio.create_task(call("fast"))
+        await asyncio.sleep(0.01)
+        self.assertEqual(registry.limiters["minimax"].in_flight, 3)
+        release.set()
+        await asyncio.wait_for(asyncio.gather(fast, *slow), 1)
+
+
+class TestTransport(unittest.IsolatedAsyncioTestCase):
+    async def test_stats(self):
+        response = [b"HTTP/1.1 200 OK\r\n", b"Content-Length: 2\r\n\r\n", b"ok"]
+        transport = InstrumentedTransport(10)
+        # 每个连接依次读取两个响应
+        transport._pool = httpcore.AsyncConnectionPool(
+            max_connections=10, network_backend=httpcore.AsyncMockBackend(response * 2)
+        )
+        async with httpx.AsyncClient(transport=transport) as client:
+            async with client.stream("GET", "http://upstream/") as stream:
+                # 响应体读取完之前仍在途
+                self.assertEqual(transport.stats()["in_flight"], 1)
+                await stream.aread()
+            self.assertEqual(transport.stats()["in_flight"], 0)
+            await client.get("http://upstream/")
+        stats = transport.stats()
+        self.assertEqual((stats["requests"], stats["new_connections"]), (2, 1))
+        self.assertEqual(stats["reuse_ratio"], 0.5)
+        self.assertEqual(stats["peak_in_flight"], 1)
+
+
+class TestRateScheduler(unittest.IsolatedAsyncioTestCase):
+    async def test_rpm(self):
+        scheduler = RateScheduler({"minimax": {"rpm": 600}})
+        start = time.monotonic()
+        for _ in range(602):
+            async with scheduler.reserve("minimax", "abab6.5s-chat", [], None):
+                pass
+        # 初始额度600，之后每0.1秒补充1个
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+
+    async def test_correct(self):
+        scheduler = RateScheduler({"openai/gpt-4o": {"tpm": 6000}})
+        threads = []
+
+        def estimate(*args):
+            threads.append(threading.current_thread().name)
+            return 1000
+
+        with patch("src.scheduler.estimate_tokens", side_effect=estimate):
+            async with scheduler.reserve("openai", "gpt-4o", [], None) as reservation:
+                reservation.record({"total_tokens": 3000})
+        # 分词不在事件循环中进行
+        self.assertTrue(threads[0].startswith("tokenizer"))
+        tpm, rpm = scheduler.buckets["openai/gpt-4o"]
+        self.assertIsNone(rpm)
+        self.assertAlmostEqual(tpm.level, 3000, delta=10)
+
+
+class TestTokenizer(unittest.IsolatedAsyncioTestCase):
+    async def test_chunked_count(self):
+        encoding = SimpleNamespace(name="fake", encode_ordinary=str.split)
+        texts = [" ".join(["word"] * i) for i in range(7)]
+        with (
+            patch("src.tokenizer.get_tokenizer", return_value=(encoding, True)),
+            patch("src.tokenizer.CHUNK_SIZE", 2),
+        ):
+            counts, _, approximate = await count_tokens(texts, "claude-3-haiku-20240307")
+        self.assertEqual(counts, list(range(7)))
+        self.assertTrue(approximate)
+
+
+class TestPromptCache(unittest.IsolatedAsyncioTestCase):
+    async def test_claude_cache_control(self):
+        claude = AsyncClaude(api_key="sk-")
+        message = Message(
+            id="msg",
+            content=[TextBlock(type="text", text="ok")],
+            model="claude-3-5-sonnet-20240620",
+            role="assistant",
+            stop_reason="end_turn",
+            type="message",
+            usage=Usage(
+                input_tokens=10,
+                output_tokens=5,
+                cache_read_input_tokens=3000,
+                cache_creation_input_tokens=0,
+            ),
+        )
+        system = "You are a chatbot. " * 200
+        with patch.object(claude.client.messages, "create", AsyncMock(return_value=message)) as m:
+            response = await claude.create(
+                model="claude-3-5-sonnet-20240620",
+                messages=[
+                    {"role": "system", "content": system},
+                    {"role": "user", "content": "hi"},
+                ],
+            )
+        kwargs = m.call_args.kwargs
+        self.assertEqual(kwargs["system"][0]["cache_control"], {"type": "ephemeral"})
+        self.assertEqual(kwargs["messages"], [{"role": "user", "content": "hi"}])
+        self.assertEqual(response.usage.prompt_tokens, 3010)
+        self.assertEqual(cached_tokens(response.usage), 3000)
+
+    def test_openai_prompt_cache_key(self):
+        long_system = [{"role": "system", "content": "You are a chatbot. " * 200}]
+        key = prompt_cache_params("openai", long_system)["prompt_cache_key"]
+        self.assertEqual(key, prompt_cache_params("openai", long_system)["prompt_cache_key"])
+        self.assertEqual(prompt_cache_params("openai", [{"role": "system", "content": "hi"}]), {})
+        self.assertEqual(prompt_cache_params("dpsk", long_system), {})
+        self.assertEqual(cached_tokens({"prompt_cache_hit_tokens": 128}), 128)
+
+
+@unittest.skipUnless(PILLOW_AVAILABLE, "Pillow is not installed")
+class TestImagePipeline(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.pipeline = ImagePipeline(workers=1, cache_size=10)
+        preprocess = patch("src.images.IMAGE_PREPROCESS", True)
+        preprocess.start()
+        self.addCleanup(preprocess.stop)
+
+    async def asyncTearDown(self):
+        self.pipeline.shutdown()
+
+    @staticmethod
+    def image(size: tuple[int, int]) -> bytes:
+        import io
+
+        from PIL import Image
+
+        buffer = io.BytesIO()
+        Image.new("RGBA", size, (255, 0, 0, 128)).save(buffer, "PNG")
+        return buffer.getvalue()
+
+    async def test_downscale_and_cache(self):
+        import base64
+        import io
+
+        from PIL import Image
+
+        url = "data:image/png;base64," + base64.b64encode(self.image((4000, 1000))).decode()
+        messages = [
+            {"role": "system", "content": "You are a chatbot"},
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": "What is in the image?"},
+                    {"type": "image_url", "image_url": {"url": url, "detail": "low"}},
+                ],
+            },
+        ]
+        processed = await self.pipeline.preprocess(messages, "gpt-4o")
+        self.assertEqual(messages[1]["content"][1]["image_url"]["url"], url)
+        self.assertEqual(processed[0], messages[0])
+        image_url = processed[1]["content"][1]["image_url"]
+        self.assertEqual(image_url["detail"], "low")
+        header, _, data = image_url["url"].partition(",")
+        self.assertEqual(header, "data:image/jpeg;base64")
+        self.assertEqual(Image.open(io.BytesIO(base64.b64decode(data))).size, (1568, 392))
+
+        # 命中缓存时不再使用进程池
+        with patch.object(ImagePipeline, "pool", new_callable=PropertyMock, side_effect=OSError):
+            again = await self.pipeline.preprocess(messages, "gpt-4o")
+        self.assertEqual(again, processed)
+
+        with patch.object(self.pipeline, "fetch", AsyncMock(return_value=self.image((100, 100)))):
+            remote = {"type": "image_url", "image_url": {"url": "https://example.com/a.png"}}
+            for _ in range(2):
+                result = await self.pipeline.preprocess(
+                    [{"role": "user", "content": [remote]}], "m"
+                )
+            self.pipeline.fetch.assert_awaited_once()
+        self.assertTrue(result[0]["content"][0]["image_url"]["url"].startswith("data:image/"))
+
+        with patch.object(self.pipeline, "fetch", AsyncMock(side_effect=httpx.ConnectError("x"))):
+            broken = {"type": "image_url", "image_url": {"url": "https://example.com/b.png"}}
+            result = await self.pipeline.preprocess([{"role": "user", "content": [broken]}], "m")
+        self.assertEqual(result[0]["content"][0], broken)
+
+        claude = claude_messages(processed[1:])[0]["content"][1]
+        self.assertEqual(claude["source"]["type"], "base64")
+        self.assertEqual(claude["source"]["media_type"], "image/jpeg")
+
+    async def test_fetch_too_large(self):
+        chunks = []
+
+        async def body():
+            for _ in range(100):
+                chunks.append(b"x" * 1024)
+                yield chunks[-1]
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            if request.url.path == "/declared.png":
+                return httpx.Response(200, headers={"Content-Length": str(1 << 30)})
+            if request.url.path == "/small.png":
+                return httpx.Response(200, content=b"png")
+            return httpx.Response(200, content=body())
+
+        self.pipeline._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        with patch("src.images.MAX_IMAGE_BYTES", 10 * 1024):
+            with self.assertRaises(ValueError):
+                await self.pipeline.fetch("https://example.com/declared.png")
+            with self.assertRaises(ValueError):
+                await self.pipeline.fetch("https://example.com/streamed.png")
+            # 超过限制后立即停止读取
+            self.assertEqual(len(chunks), 11)
+            self.assertEqual(await self.pipeline.fetch("https://example.com/small.png"), b"png")
+
+
+class TestAccountant(unittest.IsolatedAsyncioTestCase):
+    async def test_flush(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = UsageStore(f"{tmp}/usage.db")
+            workers = [Accountant(store, {}, {}) for _ in range(2)]
+            usage = {"prompt_tokens": 10, "completion_tokens": 5}
+            for worker in workers:
+                worker.record("team-a", "openai", "gpt-4o", usage)
+                await worker.flush()
+            # 写入后重新读取当日总量，包含其他worker的用量
+            self.assertEqual(workers[1].totals["team-a"], [30, 0.0])
+            workers[1].record("team-a", "claude", "claude-3-haiku", usage)
+            rows = await workers[1].summary(workers[1].day, workers[1].day)
+            self.assertEqual(rows[(workers[1].day, "team-a", "openai", "gpt-4o")][:3], [2, 20, 10])
+            self.assertEqual(len(rows), 2)
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_fake_upstream(self):
+        config = FakeConfig(latency=0, chunks=3, chunk_interval=0)
+        upstream = TestClient(create_app(config))
+        openai = OpenAI(api_key="x", base_url="http://testserver/v1", http_client=upstream)
+        messages = [{"role": "user", "content": "hi"}]
+        response = openai.chat.completions.create(model="fake", messages=messages)  # type: ignore
+        self.assertEqual(response.choices[0].message.content, "token0 token1 token2 ")
+        stream = openai.chat.completions.create(
+            model="fake",
+            messages=messages,  # type: ignore
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        chunks = list(stream)
+        self.assertEqual(chunks[-1].usage.completion_tokens, config.completion_tokens)
+
+        claude = Anthropic(api_key="x", base_url="http://testserver", http_client=upstream)
+        with claude.messages.stream(model="fake", messages=messages, max_tokens=10) as events:
+            self.assertEqual(events.get_final_text(), "token0 token1 token2 ")
+
+        config.rate_limit_rate = 1
+        with self.assertRaises(RateLimitError):
+            claude.with_options(max_retries=0).messages.create(
+                model="fake", messages=messages, max_tokens=10  # type: ignore
+            )
+        self.assertEqual(upstream.get("/stats").json()["status_429"], 1)
+
+    def test_compare(self):
+        baseline = [
+            {"scenario": "a", "concurrency": 8, "rps": 100, "added_p50": 0.01, "added_p99": 0.05}
+        ]
+        same = [baseline[0] | {"rps": 90, "added_p99": 0.06}]
+        self.assertEqual(compare(same, baseline, 0.2), [])
+        slower = [baseline[0] | {"rps": 70, "added_p99": 0.1}]
+        self.assertEqual(len(compare(slower, baseline, 0.2)), 2)
+
+
+class TestLoopMonitor(unittest.IsolatedAsyncioTestCase):
+    async def test_slow_callback(self):
+        monitor = LoopMonitor(interval=0.01, threshold=0.05)
+        task = asyncio.create_task(monitor.run())
+        await asyncio.sleep(0.05)
+        time.sleep(0.2)  # 阻塞事件循环
+        await asyncio.sleep(0.05)
+        task.cancel()
+        stats = monitor.stats()
+        self.assertEqual(len(stats["slow_callbacks"]), 1)
+        record = stats["slow_callbacks"][0]
+        self.assertIn("test_slow_callback", record["stack"])
+        self.assertEqual(record["kind"], "callback")
+        self.assertGreater(record["duration"], 0.15)
+        self.assertGreater(stats["lag"]["max"], 0.15)
+        self.assertEqual(stats["threadpools"]["anyio"]["queued"], 0)
+
+
+class TestProfiler(unittest.IsolatedAsyncioTestCase):
+    async def test_profile(self):
+        def busy():
+            deadline = time.perf_counter() + 0.2
+            while time.perf_counter() < deadline:
+                pass
+
+        async def spin():
+            await asyncio.sleep(0.05)
+            busy()
+
+        task = asyncio.create_task(spin())
+        profiler = SamplingProfiler(hz=200)
+        await profiler.run(0.4, tasks=True)
+        await task
+        lines = profiler.collapsed().splitlines()
+        self.assertTrue(any("busy (test_api.py" in line for line in lines))
+        self.assertTrue(any(line.startswith(f"{TASKS_ROOT};spin") for line in lines))
+        for line in lines:
+            self.assertGreater(int(line.rsplit(" ", 1)[1]), 0)
+
+        speedscope = profiler.speedscope("test")
+        frames = speedscope["shared"]["frames"]
+        self.assertIn(TASKS_ROOT, [profile["name"] for profile in speedscope["profiles"]])
+        for profile in speedscope["profiles"]:
+            self.assertEqual(len(profile["samples"]), len(profile["weights"]))
+            self.assertTrue(all(i < len(frames) for stack in profile["samples"] for i in stack))
+
+    def test_admin_only(self):
+        paths = ["/debug/transport", "/debug/limits", "/debug/logging", "/debug/loop"]
+        with patch("src.routes.debug.ADMIN_TOKEN", None):
+            for path in [*paths, "/debug/profile"]:
+                self.assertEqual(client.get(path).status_code, 404)
+        with patch("src.routes.debug.ADMIN_TOKEN", "secret"):
+            for path in [*paths, "/debug/profile"]:
+                response = client.get(path, headers={"X-Admin-Token": "wrong"})
+                self.assertEqual(response.status_code, 403)
+            for path in paths:
+                response = client.get(path, headers={"X-Admin-Token": "secret"})
+                self.assertEqual(response.status_code, 200)
+            response = client.get(
+                "/debug/profile",
+                params={"seconds": 0.1, "format": "speedscope"},
+                headers={"X-Admin-Token": "secret"},
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                response.json()["name"], f"chatbot worker {response.headers['x-worker-pid']}"
+            )
+
+
+class TestRetry(unittest.IsolatedAsyncioTestCase):
+    async def test_retry_after(self):
+        response = httpx.Response(
+            429, headers={"retry-after": "0.05"}, request=httpx.Request("POST", "/")
+        )
+        call = AsyncMock(
+            side_effect=[APIStatusError("rate limited", response=response, body=None), "ok"]
+        )
+        start = time.monotonic()
+        self.assertEqual(await with_retry("openai", "gpt-4o", call), "ok")
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+        self.assertEqual(call.call_count, 2)
+
+        call = AsyncMock(side_effect=ValueError("bad request"))
+        with self.assertRaises(ValueError):
+            await with_retry("openai", "gpt-4o", call)
+        self.assertEqual(call.call_count, 1)
+
+    async def test_hedged(self):
+        delays = [1, 0]
+
+        async def call():
+            await asyncio.sleep(delays.pop(0))
+            return "fast"
+
+        start = time.monotonic()
+        self.assertEqual(await hedged(call, 0.05), "fast")
+        self.assertLess(time.monotonic() - start, 0.5)
+
+
+class TestModelRouter(unittest.IsolatedAsyncioTestCase):
+    @patch("src.routing.random.choices", side_effect=lambda population, weights: population[:1])
+    async def test_failover(self, _):
+        router = ModelRouter({"gpt-4o": [("openai", "gpt-4o"), ("azure", "gpt-4o-deploy")]})
+        unavailable = APIStatusError(
+            "unavailable",
+            response=httpx.Response(503, request=httpx.Request("POST", "/")),
+            body=None,
+        )
+
+        async def call(service, model):
+            if service == "openai":
+                raise unavailable
+            return model
+
+        for _ in range(FAILURE_THRESHOLD):
+            self.assertEqual(await router.call("gpt-4o", call), "gpt-4o-deploy")
+        # openai熔断后不再尝试
+        self.assertEqual(router.stats()["gpt-4o"]["openai/gpt-4o"]["state"], "open")
+        self.assertEqual([b.service for b in router.candidates("gpt-4o")], ["azure"])
+
+        with self.assertRaises(ValueError):
+            await router.call("gpt-4o", AsyncMock(side_effect=ValueError("bad request")))
+
+    async def test_stream_circuit_breaker(self):
+        router = ModelRouter({"gpt-4o": [("openai", "gpt-4o")]})
+        unavailable = APIStatusError(
+            "unavailable",
+            response=httpx.Response(503, request=httpx.Request("POST", "/")),
+            body=None,
+        )
+
+        async def consume():
+            async for _ in chatbot_openai_stream(
+                [{"role": "user", "content": "hi"}], "gpt-4o", "auto"
+            ):
+                pass
+
+        with (
+            patch("src.retrieve_text.model_router", router),
+            patch("src.retrieve_text.with_retry", AsyncMock(side_effect=unavailable)),
+        ):
+            for _ in range(FAILURE_THRESHOLD):
+                with self.assertRaises(APIStatusError):
+                    await consume()
+            self.assertEqual(router.stats()["gpt-4o"]["openai/gpt-4o"]["state"], "open")
+            with self.assertRaisesRegex(NoBackendAvailable, "没有可用的服务商"):
+                await consume()
+
+        # 半开状态下的试探请求遇到非重试错误后，仍然可以再次试探
+        (backend,) = router.routes["gpt-4o"]
+        backend.opened_at = time.monotonic() - OPEN_SECONDS
+        with (
+            patch("src.retrieve_text.model_router", router),
+            patch("src.retrieve_text.with_retry", AsyncMock(side_effect=ValueError("bad request"))),
+        ):
+            with self.assertRaises(ValueError):
+                await consume()
+        self.assertFalse(backend.trial)
+        self.assertTrue(backend.allow())
+
+    async def test_trial_released(self):
+        router = ModelRouter({"gpt-4o": [("openai", "gpt-4o")]})
+        (backend,) = router.routes["gpt-4o"]
+        backend.opened_at = time.monotonic() - OPEN_SECONDS
+        self.assertEqual(backend.state, "half_open")
+        with self.assertRaises(ValueError):
+            await router.call("gpt-4o", AsyncMock(side_effect=ValueError("bad request")))
+        task = asyncio.create_task(router.call("gpt-4o", lambda *_: asyncio.sleep(10)))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertEqual(await router.call("gpt-4o", AsyncMock(return_value="ok")), "ok")
+        self.assertEqual(backend.state, "closed")
+
+        backend.opened_at = time.monotonic()
+        with self.assertRaises(NoBackendAvailable):
+            await router.call("gpt-4o", AsyncMock(return_value="ok"))
+
+
+class TestClients(unittest.TestCase):
+    def test_lazy_and_disabled(self):
+        registry = ClientRegistry(FACTORIES, ALIASES)
+        self.assertEqual(registry.clients, {})
+        self.assertIs(registry["dpsk"], registry["deepseek"])
+        self.assertEqual(list(registry.clients), ["deepseek"])
+        self.assertIn("dpsk", registry)
+        self.assertNotIn("unknown", registry)
+        with patch.dict(os.environ, {"MOONSHOT_API_KEY": ""}):
+            self.assertFalse(registry.configured("moonshot"))
+            with self.assertRaises(ServiceUnavailable):
+                registry["moonshot"]
+
+    def test_unconfigured_service(self):
+        with patch.dict(os.environ, {"MOONSHOT_API_KEY": ""}), patch.dict(CLIENTS.clients):
+            CLIENTS.clients.pop("moonshot", None)
+            response = client.post(
+                "/v1/chat/completions",
+                json={
+                    "model": "moonshot/moonshot-v1-8k",
+                    "messages": [{"role": "user", "content": "hi"}],
+                },
+            )
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()["error"]["type"], "service_unavailable")
+
+
+class TestMetrics(unittest.TestCase):
+    def test_archive_exited_workers(self):
+        def worker(worker_id: str, value: int) -> Registry:
+            registry = Registry()
+            registry.counter("requests", "requests").inc(value=value)
+            registry.gauge("in_flight", "in flight", (), lambda: {(): value})
+            registry.worker = worker_id
+            return registry
+
+        exited = subprocess.Popen(["true"])
+        exited.wait()
+        with tempfile.TemporaryDirectory() as tmp:
+            current = worker("current", 1)
+            worker(f"{exited.pid}-old", 10).flush(tmp)
+            self.assertIn("requests 11", current.render(current.snapshot(), tmp))
+
+            metrics.archive(tmp, exited.pid)
+            self.assertEqual(
+                sorted(path.name for path in Path(tmp).glob("*.json")),
+                ["archive.json", "current.json"],
+            )
+            # PID被新worker复用时不会覆盖已退出worker的累计值
+            worker(f"{exited.pid}-new", 100).flush(tmp)
+            self.assertIn("requests 111", current.render(current.snapshot(), tmp))
+
+            metrics.reset(tmp)
+            self.assertEqual(list(Path(tmp).glob("*.json")), [])
+
+
+class TestBackgroundHandler(unittest.TestCase):
+    def test_drop_when_full(self):
+        target = logging.handlers.BufferingHandler(100)
+        handler = BackgroundHandler(target, maxsize=2)
+        handler.listener.stop()  # 停止消费，模拟写入阻塞
+        record = logging.makeLogRecord({"msg": "hello", "levelno": logging.INFO})
+        for _ in range(5):
+            handler.handle(record)
+        self.assertEqual(handler.stats()["dropped"], 3)
+        handler.listener.start()
+        handler.listener.stop()
+        self.assertEqual(len(target.buffer), 2)
+        handler.close()
+        BackgroundHandler.instances.remove(handler)
+
+
 if __name__ == "__main__":
     unittest.main()